@@ -0,0 +1,12 @@
+#--- IOT_Server - asgi --------------------------------------------------------
+#ASGI entry point, e.g. uvicorn IOT_Server.asgi:application --host 0.0.0.0 --port 8000
+
+import os
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "IOT_Server.settings")
+django.setup(set_prefix=False)
+
+from api.asgi import ASGIApplication
+
+application = ASGIApplication()
@@ -0,0 +1,123 @@
+#--- IOT_Server - api app time bucket aggregation -----------------------------
+
+from datetime import datetime
+from django.db.models import BigIntegerField, Func, Avg, Count, Max, Min, Sum
+from django.utils import timezone
+from rest_framework import serializers
+
+#Bucket widths in seconds by interval parameter
+INTERVALS = {
+    '1m': 60,
+    '5m': 300,
+    '1h': 3600,
+    '1d': 86400,
+}
+
+FUNCTIONS = ('min', 'max', 'avg', 'count', 'last')
+
+#IotData value field and allowed functions by ValueTypes.type
+VALUE_FIELDS = {
+    'int': 'value_int',
+    'dec': 'value_dec',
+    'bool': 'value_bool',
+    'string': 'value_text',
+}
+NUMERIC_TYPES = ('int', 'dec')
+
+#Numeric WeatherData fields that can be aggregated
+WEATHER_FIELDS = ('temperature', 'dewpoint', 'wind_speed', 'wind_gust', 'wind_dir', 'pressure')
+
+
+class EpochBucket(Func):
+    """
+    Start of the fixed width interval containing a timestamp, in seconds since the epoch (UTC).
+    Works on naive UTC columns (MySQL, SQLite with USE_TZ) and timestamptz (PostgreSQL),
+    the only backends the aggregate endpoints and rollups support.
+    """
+    output_field = BigIntegerField()
+
+    def __init__(self, expression, seconds, **extra):
+        #seconds is inlined in the SQL, only accept whole numbers
+        super().__init__(expression, seconds=int(seconds), **extra)
+
+    def as_mysql(self, compiler, connection, **extra_context):
+        template = "FLOOR(TIMESTAMPDIFF(SECOND, '1970-01-01 00:00:00', %(expressions)s) / %(seconds)s) * %(seconds)s"
+        return self.as_sql(compiler, connection, template=template, **extra_context)
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        template = "(CAST(strftime('%%%%s', %(expressions)s) AS INTEGER) / %(seconds)s) * %(seconds)s"
+        return self.as_sql(compiler, connection, template=template, **extra_context)
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        template = "FLOOR(EXTRACT(EPOCH FROM %(expressions)s) / %(seconds)s) * %(seconds)s"
+        return self.as_sql(compiler, connection, template=template, **extra_context)
+
+
+def bucket_datetime(epoch_seconds):
+    return datetime.fromtimestamp(int(epoch_seconds), tz=timezone.utc)
+
+
+def parse_interval(value):
+    #Returns bucket width in seconds for an interval parameter
+    if value not in INTERVALS:
+        raise serializers.ValidationError({'Invalid interval': value, 'Valid intervals are': list(INTERVALS)})
+    return INTERVALS[value]
+
+
+def parse_functions(value, allowed=FUNCTIONS):
+    #Returns list of aggregate functions from a comma separated parameter
+    if not value:
+        return list(allowed)
+    functions = value.split(',')
+    invalid = [f for f in functions if f not in allowed]
+    if invalid:
+        raise serializers.ValidationError({'Invalid functions': invalid, 'Valid functions are': list(allowed)})
+    return functions
+
+
+def aggregate_buckets(queryset, seconds, fields, functions, max_buckets):
+    """
+    Groups the records of queryset into buckets of the given width in the database.
+    Returns a list of (bucket epoch seconds, {field: {function: value}}) of the most
+    recent max_buckets buckets (all when None), ordered by bucket.
+    Besides FUNCTIONS 'sum' is accepted, it is used by the rollups.
+    'last' is the value of the most recent record in the bucket and costs one extra query.
+    """
+    aggregates = {}
+    for field in fields:
+        if 'min' in functions:
+            aggregates[f'{field}__min'] = Min(field)
+        if 'max' in functions:
+            aggregates[f'{field}__max'] = Max(field)
+        if 'avg' in functions:
+            aggregates[f'{field}__avg'] = Avg(field)
+        if 'count' in functions:
+            aggregates[f'{field}__count'] = Count(field)
+        if 'sum' in functions:
+            aggregates[f'{field}__sum'] = Sum(field)
+    if 'last' in functions:
+        aggregates['last_timestamp'] = Max('timestamp')
+
+    rows = queryset.annotate(bucket=EpochBucket('timestamp', seconds)).values('bucket')
+    rows = list(rows.annotate(**aggregates).order_by('-bucket')[:max_buckets])
+    rows.reverse()
+
+    last_values = {}
+    if 'last' in functions and rows:
+        #Value of every field at the last timestamp of each bucket, highest id wins on a tie
+        last_records = queryset.filter(timestamp__in=[row['last_timestamp'] for row in rows])
+        for record in last_records.order_by('timestamp', 'pk').values('timestamp', *fields):
+            last_values[record['timestamp']] = record
+
+    buckets = []
+    for row in rows:
+        values = {}
+        for field in fields:
+            values[field] = {}
+            for function in functions:
+                if function == 'last':
+                    values[field]['last'] = last_values.get(row['last_timestamp'], {}).get(field)
+                else:
+                    values[field][function] = row[f'{field}__{function}']
+        buckets.append((row['bucket'], values))
+    return buckets
@@ -0,0 +1,248 @@
+#--- IOT_Server - api app history archive -------------------------------------
+#Compressed columnar archive of tag history, one block per tag and UTC day
+
+import struct
+import zlib
+from datetime import datetime, timedelta
+from decimal import Decimal
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from api.models import IotData, IotDataArchive
+from api.aggregation import VALUE_FIELDS
+
+FORMAT_VERSION = 1
+TYPE_CODES = {'int': 1, 'dec': 2, 'bool': 3, 'string': 4}
+TYPES = {code: tag_type for tag_type, code in TYPE_CODES.items()}
+HEADER = struct.Struct('<BBI')
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+#Archived records are read in chunks of this many when deleted from IotData
+DELETE_CHUNK = 1000
+
+
+class MixedValues(Exception):
+    pass
+
+
+def get_archive_after():
+    return timedelta(days=getattr(settings, 'IOT_ARCHIVE_AFTER_DAYS', 90))
+
+
+def _write_varints(numbers, out):
+    #Appends signed integers to out as zigzag varints
+    for number in numbers:
+        number = number << 1 if number >= 0 else (-number << 1) - 1
+        while number > 0x7f:
+            out.append(number & 0x7f | 0x80)
+            number >>= 7
+        out.append(number)
+
+
+def _read_varints(data, offset, count):
+    #Returns count signed integers read from data at offset and the offset after them
+    numbers = []
+    for i in range(count):
+        number = shift = 0
+        while True:
+            byte = data[offset]
+            offset += 1
+            number |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        numbers.append(number >> 1 if not number & 1 else -((number + 1) >> 1))
+    return numbers, offset
+
+
+def _deltas(numbers):
+    previous = 0
+    for number in numbers:
+        yield number - previous
+        previous = number
+
+
+def _undeltas(deltas):
+    numbers = []
+    previous = 0
+    for delta in deltas:
+        previous += delta
+        numbers.append(previous)
+    return numbers
+
+
+def _decimal_scale():
+    return 10 ** IotData._meta.get_field('value_dec').decimal_places
+
+
+#Block = HEADER + zlib of: ids and microsecond timestamps as delta zigzag varints, a present byte per record,
+#the non null values (int / dec as delta varints, bool bytes, strings length prefixed)
+def encode_block(tag_type, rows):
+    #rows = [(id, timestamp, value)] ordered by timestamp, id. Returns the block bytes
+    out = bytearray()
+    _write_varints(_deltas([row[0] for row in rows]), out)
+    _write_varints(_deltas([(row[1] - EPOCH) // timedelta(microseconds=1) for row in rows]), out)
+    out += bytes(0 if row[2] is None else 1 for row in rows)
+
+    values = [row[2] for row in rows if row[2] is not None]
+    if tag_type == 'int':
+        _write_varints(_deltas(values), out)
+    elif tag_type == 'dec':
+        scale = _decimal_scale()
+        _write_varints(_deltas([int(Decimal(value) * scale) for value in values]), out)
+    elif tag_type == 'bool':
+        out += bytes(1 if value else 0 for value in values)
+    else:
+        for value in values:
+            encoded = str(value).encode()
+            _write_varints([len(encoded)], out)
+            out += encoded
+    return HEADER.pack(FORMAT_VERSION, TYPE_CODES[tag_type], len(rows)) + zlib.compress(bytes(out), 6)
+
+
+def decode_block(data):
+    #Returns the value type and [(id, timestamp, value)] of a block
+    version, type_code, count = HEADER.unpack_from(data)
+    if version != FORMAT_VERSION:
+        raise ValueError(f'Unknown archive block version {version}')
+    tag_type = TYPES[type_code]
+    body = zlib.decompress(bytes(data[HEADER.size:]))
+
+    ids, offset = _read_varints(body, 0, count)
+    micros, offset = _read_varints(body, offset, count)
+    present = body[offset:offset + count]
+    offset += count
+    present_count = sum(present)
+
+    if tag_type == 'int':
+        values, offset = _read_varints(body, offset, present_count)
+        values = _undeltas(values)
+    elif tag_type == 'dec':
+        places = IotData._meta.get_field('value_dec').decimal_places
+        values, offset = _read_varints(body, offset, present_count)
+        values = [Decimal(value).scaleb(-places) for value in _undeltas(values)]
+    elif tag_type == 'bool':
+        values = [bool(byte) for byte in body[offset:offset + present_count]]
+    else:
+        values = []
+        for i in range(present_count):
+            (length,), offset = _read_varints(body, offset, 1)
+            values.append(body[offset:offset + length].decode())
+            offset += length
+
+    values = iter(values)
+    rows = []
+    for pk, micro, is_present in zip(_undeltas(ids), _undeltas(micros), present):
+        timestamp = EPOCH + timedelta(microseconds=micro)
+        rows.append((pk, timestamp, next(values) if is_present else None))
+    return tag_type, rows
+
+
+def archive_day(tag_id, tag_type, day):
+    """
+    Moves the IotData records of a tag on a UTC day into its archive block, merging with
+    records archived before. Returns the number of records archived.
+    A block holds values of one type, a day with values in another value field than that
+    of tag_type (the value type of the tag was changed) raises MixedValues and is left live.
+    """
+    field = VALUE_FIELDS[tag_type]
+    begin = datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+    other_values = Q()
+    for other_field in set(VALUE_FIELDS.values()) - {field}:
+        other_values |= Q(**{f'{other_field}__isnull': False})
+    with transaction.atomic():
+        live = IotData.objects.filter(tag_id=tag_id, timestamp__gte=begin, timestamp__lt=begin + timedelta(days=1))
+        if live.filter(other_values).exists():
+            raise MixedValues(f'{tag_id} has values of another type than {tag_type} on {day}.')
+        rows = list(live.order_by('timestamp', 'pk').values_list('pk', 'timestamp', field))
+        if not rows:
+            return 0
+        block = IotDataArchive.objects.select_for_update().filter(tag_id=tag_id, day=day).first()
+        merged = rows
+        if block is not None:
+            block_type, archived = decode_block(block.data)
+            if block_type != tag_type:
+                raise MixedValues(f'{tag_id} was archived as {block_type} on {day}, it is now {tag_type}.')
+            merged = sorted(archived + rows, key=lambda row: (row[1], row[0]))
+        else:
+            block = IotDataArchive(tag_id=tag_id, day=day)
+        block.data = encode_block(tag_type, merged)
+        block.count = len(merged)
+        block.first_timestamp = merged[0][1]
+        block.last_timestamp = merged[-1][1]
+        block.save()
+
+        pks = [row[0] for row in rows]
+        for i in range(0, len(pks), DELETE_CHUNK):
+            IotData.objects.filter(pk__in=pks[i:i + DELETE_CHUNK]).delete()
+    return len(rows)
+
+
+def _matches(timestamp, lookups):
+    #Applies timestamp__gte / gt / lte / lt lookups to a timestamp
+    for lookup, value in lookups.items():
+        if ((lookup == 'timestamp__gte' and timestamp < value) or
+                (lookup == 'timestamp__gt' and timestamp <= value) or
+                (lookup == 'timestamp__lte' and timestamp > value) or
+                (lookup == 'timestamp__lt' and timestamp >= value)):
+            return False
+    return True
+
+
+def _archive_blocks(tag, lookups, position=None):
+    #Archive blocks of a tag that can hold records matching lookups and position
+    blocks = IotDataArchive.objects.filter(tag=tag)
+    for lookup, value in lookups.items():
+        if lookup in ('timestamp__gte', 'timestamp__gt'):
+            blocks = blocks.filter(last_timestamp__gte=value)
+        else:
+            blocks = blocks.filter(first_timestamp__lte=value)
+    if position:
+        blocks = blocks.filter(last_timestamp__gte=position[0])
+    return blocks.order_by('day')
+
+
+def iter_archived_rows(tag, lookups, position=None):
+    """
+    Yields the value type and (id, timestamp, value) of the archived records of a tag ordered
+    by timestamp, id. lookups are timestamp__gte / gt / lte / lt filters, position is a
+    (timestamp, id) keyset cursor or None. One block is decoded at a time.
+    """
+    for data in _archive_blocks(tag, lookups, position).values_list('data', flat=True).iterator():
+        block_type, rows = decode_block(data)
+        for pk, timestamp, value in rows:
+            if not _matches(timestamp, lookups):
+                continue
+            if position and (timestamp, pk) <= position:
+                continue
+            yield block_type, (pk, timestamp, value)
+
+
+def last_archived(tag_ids):
+    #{tag_id: (value type, (id, timestamp, value))} of the newest archived record of the tags, one block decoded per tag
+    newest = {}
+    for tag_id, pk in IotDataArchive.objects.filter(tag_id__in=tag_ids).order_by('tag_id', '-day') \
+                                            .values_list('tag_id', 'pk'):
+        newest.setdefault(tag_id, pk)
+    last = {}
+    for tag_id, data in IotDataArchive.objects.filter(pk__in=newest.values()).values_list('tag_id', 'data'):
+        block_type, rows = decode_block(data)
+        last[tag_id] = (block_type, rows[-1])
+    return last
+
+
+def count_archived(tag, lookups):
+    #Number of archived records of a tag matching lookups, only blocks on the edges of the span are decoded
+    count = 0
+    edges = []
+    blocks = _archive_blocks(tag, lookups).values_list('pk', 'count', 'first_timestamp', 'last_timestamp')
+    for pk, block_count, first_timestamp, last_timestamp in blocks:
+        if _matches(first_timestamp, lookups) and _matches(last_timestamp, lookups):
+            count += block_count
+        else:
+            edges.append(pk)
+    for data in IotDataArchive.objects.filter(pk__in=edges).values_list('data', flat=True):
+        count += sum(1 for pk, timestamp, value in decode_block(data)[1] if _matches(timestamp, lookups))
+    return count
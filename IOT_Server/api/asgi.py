@@ -0,0 +1,279 @@
+#--- IOT_Server - api app ASGI application -------------------------------------
+#ASGI application for Django versions without an ASGI handler, Django work runs in a thread pool
+
+import asyncio
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from django.conf import settings
+from django.core.exceptions import DisallowedHost
+from django.core.handlers.wsgi import WSGIHandler, WSGIRequest
+from django.db import close_old_connections, connections
+from django.urls import Resolver404, resolve
+from api import metrics
+
+_executor = None
+_stream_slots = None
+_lock = threading.Lock()
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+def get_max_threads():
+    return getattr(settings, 'IOT_ASGI_THREADS', 8)
+
+
+def get_max_body_size():
+    #Largest request body read into memory, None for no limit
+    return getattr(settings, 'IOT_ASGI_MAX_BODY_SIZE', settings.DATA_UPLOAD_MAX_MEMORY_SIZE)
+
+
+def get_stream_slots():
+    #Semaphore bounding the threads sending streamed bodies, IOT_ASGI_STREAM_THREADS (default 100)
+    global _stream_slots
+    with _lock:
+        if _stream_slots is None:
+            _stream_slots = threading.BoundedSemaphore(getattr(settings, 'IOT_ASGI_STREAM_THREADS', 100))
+        return _stream_slots
+
+
+def get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=get_max_threads(), thread_name_prefix='iot-orm')
+        return _executor
+
+
+def _call(fn, args):
+    #Runs fn like a request of its own, DB connections past their age are closed before and after
+    close_old_connections()
+    try:
+        return fn(*args)
+    finally:
+        close_old_connections()
+
+
+async def run_sync(fn, *args):
+    #Runs blocking fn (ORM calls) in the thread pool
+    return await asyncio.get_event_loop().run_in_executor(get_executor(), _call, fn, args)
+
+
+async def run_thread(fn, *args):
+    #Runs blocking fn in a new thread, for long running work that must not hold a pool thread
+    #Callers bound the number of these threads, see get_stream_slots
+    loop = asyncio.get_event_loop()
+    future = loop.create_future()
+
+    def resolve(set_outcome, outcome):
+        if not future.done():
+            set_outcome(outcome)
+
+    def target():
+        try:
+            result = _call(fn, args)
+        except BaseException as e:
+            loop.call_soon_threadsafe(resolve, future.set_exception, e)
+        else:
+            loop.call_soon_threadsafe(resolve, future.set_result, result)
+        finally:
+            #The thread ends here, close its connections instead of leaving them to the database timeout
+            connections.close_all()
+
+    threading.Thread(target=target, name='iot-stream', daemon=True).start()
+    return await future
+
+
+async def read_body(scope, receive):
+    #Request body, None when the client disconnected first, BodyTooLarge past get_max_body_size()
+    limit = get_max_body_size()
+    if limit is not None:
+        for name, value in scope.get('headers', []):
+            if name == b'content-length' and value.isdigit() and int(value) > limit:
+                raise BodyTooLarge()
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunks.append(message.get('body', b''))
+        size += len(chunks[-1])
+        if limit is not None and size > limit:
+            raise BodyTooLarge()
+        if not message.get('more_body', False):
+            return b''.join(chunks)
+
+
+async def send_response(send, status, headers, body):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def get_environ(scope, body):
+    #WSGI environ of an ASGI http scope, see PEP 3333
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    client = scope.get('client')
+    if client:
+        environ['REMOTE_ADDR'] = client[0]
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1').upper().replace('-', '_')
+        if name == 'CONTENT_LENGTH':
+            continue
+        key = name if name == 'CONTENT_TYPE' else 'HTTP_' + name
+        value = value.decode('latin1')
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+def is_allowed_host(scope):
+    #Host header validation against ALLOWED_HOSTS as done by Django for the sync views
+    try:
+        WSGIRequest(get_environ(scope, b'')).get_host()
+    except DisallowedHost:
+        return False
+    return True
+
+
+class ASGIApplication:
+    def __init__(self):
+        from api.async_views import ASYNC_VIEWS
+        self.async_views = ASYNC_VIEWS
+        self.wsgi = WSGIHandler()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            raise ValueError(f"Unsupported ASGI scope type {scope['type']}")
+        try:
+            body = await read_body(scope, receive)
+        except BodyTooLarge:
+            await send_response(send, 413, [('Content-Type', 'text/plain')], b'Request body too large.')
+            return
+        if body is None:
+            return
+        if not await self.call_async_view(scope, body, send):
+            send_body = await run_sync(self.call_wsgi, asyncio.get_event_loop(), send, get_environ(scope, body))
+            if send_body is not None:
+                await run_thread(send_body)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def call_async_view(self, scope, body, send):
+        """
+        Answers with the async variant of the view, returns False when the sync view has to.
+        Async variants skip the middleware, a host not in ALLOWED_HOSTS is left to the sync view
+        so Django answers it with 400.
+        """
+        if not is_allowed_host(scope):
+            return False
+        try:
+            match = resolve(scope['path'])
+        except Resolver404:
+            return False
+        view_class = self.async_views.get(getattr(match.func, 'view_class', None))
+        if view_class is None:
+            return False
+        from api.async_views import AsyncRequest
+        start = time.perf_counter()
+        response = await view_class().dispatch(AsyncRequest(scope, body, match.kwargs))
+        if response is None:
+            return False
+        await send_response(send, *response)
+        if metrics.is_enabled():
+            metrics.record(match.route, scope['method'], response[0], time.perf_counter() - start,
+                           metrics.RequestRecorder())
+        return True
+
+    def call_wsgi(self, loop, send, environ):
+        """
+        Runs the Django WSGI handler in a pool thread and sends the response from it.
+        For a streamed response a function sending its body is returned instead, to be run
+        in a thread of its own, or 503 is sent when IOT_ASGI_STREAM_THREADS bodies are already
+        being sent. The body is sent chunk by chunk, waiting for each send, so it
+        follows the pace of the client and a streamed body keeps its DB connection and cursor
+        on the one thread iterating it (generators only start querying when first iterated).
+        """
+        def send_sync(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = headers
+
+        response = self.wsgi(environ, start_response)
+        streaming = getattr(response, 'streaming', False)
+        if streaming and not get_stream_slots().acquire(blocking=False):
+            response.close()
+            send_sync({'type': 'http.response.start', 'status': 503,
+                       'headers': [(b'content-type', b'text/plain'), (b'retry-after', b'1')]})
+            send_sync({'type': 'http.response.body', 'body': b'Too many streamed responses, retry later.'})
+            return None
+        try:
+            send_sync({
+                'type': 'http.response.start',
+                'status': started['status'],
+                'headers': [(name.lower().encode('latin1'), value.encode('latin1'))
+                            for name, value in started['headers']],
+            })
+        except BaseException:
+            response.close()
+            if streaming:
+                get_stream_slots().release()
+            raise
+        if streaming:
+            return lambda: self.send_stream(send_sync, response)
+        self.send_body(send_sync, response)
+        return None
+
+    def send_stream(self, send_sync, response):
+        try:
+            self.send_body(send_sync, response)
+        finally:
+            get_stream_slots().release()
+
+    def send_body(self, send_sync, response):
+        try:
+            for chunk in response:
+                if chunk:
+                    send_sync({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            send_sync({'type': 'http.response.body', 'body': b''})
+        finally:
+            #Fires request_finished, so connections are closed on the thread that used them
+            response.close()
@@ -0,0 +1,164 @@
+#--- IOT_Server - api app async views ------------------------------------------
+#Async variants of the device facing views for api.asgi, None hands the request to the sync view
+
+import asyncio
+import sys
+from django.core.handlers.exception import response_for_exception
+from django.core.handlers.wsgi import WSGIRequest
+from django.http import QueryDict
+from django.utils.datastructures import CaseInsensitiveMapping
+from rest_framework import serializers, status
+from api import views, latest, live
+from api.asgi import get_environ, run_sync
+from api.authentication import get_cached_token_user, get_token_user
+from api.parsers import loads
+from api.renderers import FastJSONRenderer
+
+
+class AsyncRequest:
+    #The parts of a request used by the async views and the ingest serializers
+    def __init__(self, scope, body, kwargs):
+        self.scope = scope
+        self.method = scope['method']
+        self.path = scope['path']
+        self.body = body
+        self.kwargs = kwargs
+        self.headers = CaseInsensitiveMapping({name.decode('latin1'): value.decode('latin1')
+                                               for name, value in scope.get('headers', [])})
+        self.query_params = QueryDict(scope.get('query_string', b'').decode('latin1'))
+        self.user = None
+
+
+def render(data, status_code=status.HTTP_200_OK, headers=()):
+    #(status, headers, body) of a JSON response rendered like the sync views
+    return status_code, [('Content-Type', 'application/json')] + list(headers), FastJSONRenderer().render(data)
+
+
+def render_response(response):
+    #(status, headers, body) of a DRF Response
+    headers = [(name, value) for name, value in response.items() if name.lower() != 'content-type']
+    return render(response.data, response.status_code, headers)
+
+
+def server_error(request):
+    #(status, headers, body) Django answers the exception being handled with, it is also logged and signalled
+    response = response_for_exception(WSGIRequest(get_environ(request.scope, request.body)), sys.exc_info()[1])
+    return response.status_code, list(response.items()), response.content
+
+
+async def read_latest(fn, *args):
+    #A latest value store in process memory is read on the event loop, a shared cache in the thread pool
+    if latest.is_process_local():
+        return fn(*args)
+    return await run_sync(fn, *args)
+
+
+class LoopEvent:
+    #live.hub watcher waking a coroutine, set() is called from any thread
+    def __init__(self):
+        self.loop = asyncio.get_event_loop()
+        self.event = asyncio.Event()
+
+    def set(self):
+        self.loop.call_soon_threadsafe(self.event.set)
+
+    async def wait(self, timeout):
+        #True when set within timeout seconds
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+
+class AsyncAPIView:
+    async def dispatch(self, request):
+        handler = getattr(self, request.method.lower(), None)
+        if handler is None:
+            return None
+        try:
+            request.user = await self.authenticate(request)
+            if request.user is None:
+                return None
+            return await handler(request)
+        except Exception:
+            return server_error(request)
+
+    async def authenticate(self, request):
+        #User of a token authorization header, None when the sync view has to authenticate
+        keyword, separator, key = request.headers.get('authorization', '').partition(' ')
+        if keyword.lower() != 'token' or not key or ' ' in key:
+            return None
+        user = get_cached_token_user(key)
+        if user is None:
+            user = await run_sync(get_token_user, key)
+        return user
+
+
+class AsyncTagData(AsyncAPIView):
+    async def post(self, request):
+        if not request.headers.get('content-type', '').startswith('application/json'):
+            return None
+        try:
+            data = loads(request.body)
+        except ValueError:
+            return None
+        return await run_sync(self.save, request, data)
+
+    def save(self, request, data):
+        return render_response(views.save_tag_data(request, data))
+
+
+class AsyncTagDataCurrent(AsyncAPIView):
+    async def get(self, request):
+        req_tag = request.kwargs.get('tag', None)
+        if not req_tag:
+            return None
+        data = await read_latest(latest.get_tag_data, req_tag, request.user.pk)
+        if data is None:
+            return None
+        return render([data])
+
+
+class AsyncWxDataCurrent(AsyncAPIView):
+    async def get(self, request):
+        req_identifier = request.kwargs.get('identifier', None)
+        data = await read_latest(latest.get_weather_data, request.user.pk, req_identifier)
+        if data is None:
+            return None
+        return render([data])
+
+
+class AsyncLiveData(AsyncAPIView):
+    async def get(self, request):
+        if request.query_params.get('stream', None) == 'sse':
+            return None
+        view = views.LiveData(request=request, kwargs=request.kwargs)
+        try:
+            tag_ids, identifiers = await run_sync(view.get_keys)
+            timeout = view.get_wait_timeout()
+        except serializers.ValidationError:
+            #Answered with its 400 response by the sync view
+            return None
+        keys = view.get_live_keys(tag_ids, identifiers)
+        since = view.get_since()
+
+        event = live.hub.subscribe(keys, LoopEvent())
+        try:
+            data, cursor, reset = await run_sync(live.read, keys, since)
+            if not data and not reset and await event.wait(timeout):
+                data, cursor, reset = await run_sync(live.read, keys, since)
+        finally:
+            live.hub.unsubscribe(keys, event)
+        if reset:
+            data = await run_sync(view.get_current, tag_ids, identifiers)
+        return render({'cursor': cursor, 'reset': reset, 'data': data})
+
+
+#Sync view: async variant
+ASYNC_VIEWS = {
+    views.TagData: AsyncTagData,
+    views.TagDataCurrent: AsyncTagDataCurrent,
+    views.WxDataCurrent: AsyncWxDataCurrent,
+    views.LiveData: AsyncLiveData,
+}
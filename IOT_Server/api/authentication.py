@@ -0,0 +1,104 @@
+#--- IOT_Server - api app authentication --------------------------------------
+
+import copy
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+
+
+class TokenCache:
+    """
+    Bounded LRU cache of token key -> (user, token) with a time to live.
+    Entries are dropped by the Token and User signal receivers in api.signals, other
+    server processes pick up a change when their entry expires.
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_timeout(self):
+        return getattr(settings, 'IOT_TOKEN_CACHE_TIMEOUT', 60)
+
+    def get_max_size(self):
+        return getattr(settings, 'IOT_TOKEN_CACHE_SIZE', 10000)
+
+    def get(self, key):
+        #(user, token) of a cached key, None on a miss
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1], entry[2]
+
+    def set(self, key, user, token):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.get_timeout(), user, token)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.get_max_size():
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def invalidate_user(self, user_id):
+        with self.lock:
+            for key in [key for key, entry in self.entries.items() if entry[1].pk == user_id]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+token_cache = TokenCache()
+
+
+def _copy_user(user):
+    #Each request gets its own user instance, with its own related object cache
+    user = copy.copy(user)
+    user._state = copy.copy(user._state)
+    user._state.fields_cache = {}
+    return user
+
+
+def get_cached_token_user(key):
+    #Active user of a cached token key, None when it is not cached, never queries
+    cached = token_cache.get(key)
+    if cached is None:
+        return None
+    return _copy_user(cached[0])
+
+
+def get_token_user(key):
+    #Active user of a token key or None, using the token cache
+    try:
+        user, token = CachedTokenAuthentication().authenticate_credentials(key)
+    except exceptions.AuthenticationFailed:
+        return None
+    return user
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication that keeps authenticated tokens in an in-process cache, so
+    requests with a recently seen token need no Token / User query.
+    Only active users are cached, failed keys always go to the database.
+    """
+
+    def authenticate_credentials(self, key):
+        cached = token_cache.get(key)
+        if cached is not None:
+            user, token = cached
+            return _copy_user(user), token
+        user, token = super().authenticate_credentials(key)
+        token_cache.set(key, user, token)
+        return _copy_user(user), token
@@ -0,0 +1,179 @@
+#--- IOT_Server - api app benchmark helpers -----------------------------------
+
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from decimal import Decimal
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from api.models import Devices, Tags, ValueTypes, IotData
+from api.models import WeatherStations, WeatherData
+
+
+@contextmanager
+def benchmark_database(keepdb=False):
+    """
+    Runs the enclosed block against a throw away copy of the database.
+    The test database of the default connection is used so live data is never touched.
+    """
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False, keepdb=keepdb)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=keepdb)
+
+
+def seed_owner(username='benchmark'):
+    #Create the user that owns all seeded devices and stations
+    user, created = get_user_model().objects.get_or_create(username=username)
+    return user
+
+
+def seed_tags(user, devices=1, tags_per_device=10, tag_type='dec'):
+    #Create devices with tags of a single value type, returns list of tag ids
+    value_type, created = ValueTypes.objects.get_or_create(
+        value_type_id=f'bench_{tag_type}'[:8], defaults={'name': tag_type, 'type': tag_type})
+    tag_ids = []
+    for d in range(devices):
+        device = Devices.objects.create(device_id=f'bench_dev_{d}', name=f'Device {d}', owner=user)
+        for t in range(tags_per_device):
+            tag = Tags.objects.create(tag_id=f'bench_{d}_{t}', device=device,
+                                      value_type=value_type, name=f'Tag {t}')
+            tag_ids.append(tag.tag_id)
+    return tag_ids
+
+
+@transaction.atomic
+def seed_tag_data(tag_ids, per_tag, start=None, step=timedelta(seconds=1), batch_size=5000):
+    """
+    Inserts per_tag readings for every tag, interleaved in time like live traffic.
+    Returns the timestamp following the last reading so seeding can be continued.
+    """
+    ts = start or timezone.now() - step * per_tag
+    batch = []
+    for i in range(per_tag):
+        for tag_id in tag_ids:
+            batch.append(IotData(tag_id=tag_id, timestamp=ts, value_dec=Decimal(i % 1000)))
+        if len(batch) >= batch_size:
+            IotData.objects.bulk_create(batch)
+            batch = []
+        ts += step
+    IotData.objects.bulk_create(batch)
+    return ts
+
+
+def seed_stations(user, stations=1):
+    #Create weather stations, returns list of station identifiers
+    identifiers = []
+    for s in range(stations):
+        station = WeatherStations.objects.create(identifier=f'BENCH{s}', name=f'Station {s}', owner=user)
+        identifiers.append(station.identifier)
+    return identifiers
+
+
+@transaction.atomic
+def seed_weather_data(user, identifiers, per_station, start=None, step=timedelta(minutes=1), batch_size=5000):
+    #Inserts per_station observations for every station, returns the next timestamp
+    stations = list(WeatherStations.objects.filter(owner=user, identifier__in=identifiers))
+    ts = start or timezone.now() - step * per_station
+    batch = []
+    for i in range(per_station):
+        for station in stations:
+            batch.append(WeatherData(station=station, timestamp=ts, temperature=Decimal(i % 40),
+                                     wind_speed=Decimal(i % 20), pressure=Decimal(1000 + i % 30)))
+        if len(batch) >= batch_size:
+            WeatherData.objects.bulk_create(batch)
+            batch = []
+        ts += step
+    WeatherData.objects.bulk_create(batch)
+    return ts
+
+
+def time_calls(fn, repeat):
+    #Returns a list of elapsed seconds for repeat calls of fn
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def percentile(samples, pct):
+    #Nearest rank percentile of a list of samples
+    ordered = sorted(samples)
+    if not ordered:
+        return 0
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[rank]
+
+
+def api_client(user):
+    #Test client authenticated with a token of user, like a device
+    token, created = Token.objects.get_or_create(user=user)
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+    return client
+
+
+def measure_requests(request, repeat, warmup=5):
+    """
+    Calls request() repeat times after warmup calls and returns a dict of
+    p50_ms, p99_ms, requests_per_sec, queries_per_request and the status codes seen.
+    request is called with the call number and returns a response.
+    """
+    for i in range(warmup):
+        request(i)
+    samples = []
+    statuses = set()
+    with CaptureQueriesContext(connection) as queries:
+        for i in range(warmup, warmup + repeat):
+            start = time.perf_counter()
+            response = request(i)
+            samples.append(time.perf_counter() - start)
+            statuses.add(response.status_code)
+    total = sum(samples)
+    return {
+        'requests': repeat,
+        'p50_ms': round(percentile(samples, 50) * 1000, 3),
+        'p99_ms': round(percentile(samples, 99) * 1000, 3),
+        'requests_per_sec': round(repeat / total, 1) if total else 0,
+        'queries_per_request': round(len(queries.captured_queries) / repeat, 2),
+        'status': sorted(statuses),
+    }
+
+
+def http_scope(method, path, token, content_type=None):
+    #ASGI http scope of a token authenticated request
+    headers = [(b'authorization', f'Token {token}'.encode('latin1'))]
+    if content_type:
+        headers.append((b'content-type', content_type.encode('latin1')))
+    path, separator, query = path.partition('?')
+    return {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method,
+            'scheme': 'http', 'path': path, 'root_path': '', 'query_string': query.encode('latin1'),
+            'headers': headers, 'server': ('testserver', 80), 'client': ('127.0.0.1', 0)}
+
+
+async def asgi_call(application, scope, body=b''):
+    #Calls an ASGI application like a server would, returns the response status
+    import asyncio
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    response = {}
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        #Client stays connected
+        await asyncio.Event().wait()
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+
+    await application(scope, receive, send)
+    return response['status']
@@ -0,0 +1,44 @@
+#--- IOT_Server - api app system checks ----------------------------------------
+
+from django.core.checks import Error, Warning, register
+from api import ingest_queue, latest, partitions
+
+
+@register()
+def check_latest_cache(app_configs, **kwargs):
+    #A local memory latest value store is only correct with a single server process
+    if not latest.is_process_local():
+        return []
+    return [Warning(
+        'The latest value store (IOT_LATEST_CACHE) is a local memory cache, each process keeps its own '
+        'current values and readings saved by other processes are only seen after IOT_LATEST_CACHE_TIMEOUT.',
+        hint='Use a shared cache (memcached, redis or the database cache) when running more than one process, '
+             'or add "api.W001" to SILENCED_SYSTEM_CHECKS for a single process server.',
+        id='api.W001',
+    )]
+
+
+@register()
+def check_ingest_queue_cache(app_configs, **kwargs):
+    #Queued readings are stored in the latest value store by the drain_ingest process
+    if not (ingest_queue.is_enabled() and latest.is_process_local()):
+        return []
+    return [Error(
+        "IOT_INGEST_MODE = 'queue' needs a shared latest value store (IOT_LATEST_CACHE), with a local memory "
+        'cache the readings saved by drain_ingest are never seen by the web processes.',
+        hint='Point IOT_LATEST_CACHE at a memcached, redis or database cache.',
+        id='api.E001',
+    )]
+
+
+@register()
+def check_partitions(app_configs, **kwargs):
+    #Monthly partitions are a MySQL feature, other databases apply the retention by deleting records
+    if not partitions.is_enabled() or partitions.is_supported():
+        return []
+    return [Warning(
+        'IOT_PARTITIONS is enabled but the database is not MySQL, maintain_partitions --setup will refuse to run '
+        'and expired records are deleted in chunks.',
+        hint='Set IOT_PARTITIONS = False, or use MySQL for the data tables.',
+        id='api.W002',
+    )]
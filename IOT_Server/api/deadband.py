@@ -0,0 +1,68 @@
+#--- IOT_Server - api app ingest deadband filter -------------------------------
+#Per tag deadband filter of the ingest paths, the last stored reading of each tag is kept in process memory
+
+import threading
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+from api.aggregation import VALUE_FIELDS
+
+_last = {}
+_suppressed = defaultdict(int)
+_lock = threading.Lock()
+
+
+def _within(tag_info, last_value, value):
+    #True when value is within the deadband of last_value
+    if tag_info.deadband_type in ('abs', 'pct') and tag_info.type in ('int', 'dec'):
+        band = tag_info.deadband or 0
+        if tag_info.deadband_type == 'pct':
+            band = abs(Decimal(last_value)) * band / 100
+        return abs(Decimal(value) - Decimal(last_value)) <= band
+    return value == last_value
+
+
+def accept(tag_id, tag_info, timestamp, value):
+    #True when a reading should be stored, the reading becomes the last stored one of the tag
+    if not tag_info.deadband_type:
+        return True
+    with _lock:
+        last = _last.get(tag_id)
+        if last is not None:
+            last_timestamp, last_value = last
+            if timestamp < last_timestamp:
+                return True
+            heartbeat = tag_info.heartbeat
+            if ((not heartbeat or timestamp - last_timestamp < timedelta(seconds=heartbeat)) and
+                    _within(tag_info, last_value, value)):
+                _suppressed[tag_id] += 1
+                return False
+        _last[tag_id] = (timestamp, value)
+    return True
+
+
+def filter_records(records, tag_infos):
+    #Returns the unsaved IotData records to store, tag_infos = {tag_id: TagInfo}
+    accepted = []
+    for record in records:
+        tag_info = tag_infos[record.tag_id]
+        value = getattr(record, VALUE_FIELDS[tag_info.type])
+        if accept(record.tag_id, tag_info, record.timestamp, value):
+            accepted.append(record)
+    return accepted
+
+
+def stats():
+    #Readings suppressed by this process since it started, in total and per tag
+    with _lock:
+        return {'suppressed': sum(_suppressed.values()), 'tags': dict(_suppressed)}
+
+
+def reset(tag_ids=None):
+    #Forgets the last stored readings of the given tags, or of every tag when None
+    with _lock:
+        if tag_ids is None:
+            _last.clear()
+        else:
+            for tag_id in tag_ids:
+                _last.pop(tag_id, None)
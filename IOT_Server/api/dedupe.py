@@ -0,0 +1,82 @@
+#--- IOT_Server - api app history dedupe ---------------------------------------
+#Removal of duplicate readings (same tag / station and timestamp) and their unique indexes
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, Min
+from api.models import IotData, WeatherData
+
+#Data model: (owner field, unique index name)
+UNIQUE_KEYS = {
+    IotData: ('tag', 'api_iotdata_tag_ts_uniq'),
+    WeatherData: ('station', 'api_wxdata_station_ts_uniq'),
+}
+
+
+def get_chunk_size():
+    return getattr(settings, 'IOT_DEDUPE_CHUNK_SIZE', 1000)
+
+
+def duplicate_groups(model, owner_pk, limit=None):
+    #[(timestamp, id kept, number of records)] of up to limit duplicate groups of one tag / station
+    field, index_name = UNIQUE_KEYS[model]
+    groups = model.objects.filter(**{f'{field}_id': owner_pk}).values('timestamp') \
+                          .annotate(records=Count('pk'), keep=Min('pk')).filter(records__gt=1).order_by()
+    if limit is not None:
+        groups = groups[:limit]
+    return [(group['timestamp'], group['keep'], group['records']) for group in groups]
+
+
+def remove_duplicates(model, owner_pk, dry_run=False):
+    #Deletes the duplicates of one tag / station, returns the number of records deleted (or found)
+    field, index_name = UNIQUE_KEYS[model]
+    if dry_run:
+        return sum(records - 1 for timestamp, keep, records in duplicate_groups(model, owner_pk))
+    chunk_size = get_chunk_size()
+    deleted = 0
+    while True:
+        groups = duplicate_groups(model, owner_pk, chunk_size)
+        if not groups:
+            return deleted
+        duplicates = model.objects.filter(**{f'{field}_id': owner_pk},
+                                          timestamp__in=[timestamp for timestamp, keep, records in groups]) \
+                                  .exclude(pk__in=[keep for timestamp, keep, records in groups])
+        with transaction.atomic():
+            deleted += duplicates.delete()[0]
+        if len(groups) < chunk_size:
+            return deleted
+
+
+def has_unique_index(model):
+    field, index_name = UNIQUE_KEYS[model]
+    with connection.cursor() as cursor:
+        return index_name in connection.introspection.get_constraints(cursor, model._meta.db_table)
+
+
+def unique_index_sql(model):
+    field, index_name = UNIQUE_KEYS[model]
+    columns = [model._meta.get_field(field).column, model._meta.get_field('timestamp').column]
+    return (f'CREATE UNIQUE INDEX {connection.ops.quote_name(index_name)} '
+            f'ON {connection.ops.quote_name(model._meta.db_table)} '
+            f'({", ".join(connection.ops.quote_name(column) for column in columns)})')
+
+
+def is_unique_index_error(error):
+    """
+    True when an IntegrityError was raised by one of the UNIQUE_KEYS indexes. MySQL and
+    PostgreSQL name the index in the message, SQLite names its table columns.
+    """
+    message = str(error)
+    for model, (field, index_name) in UNIQUE_KEYS.items():
+        table = model._meta.db_table
+        columns = [model._meta.get_field(field).column, model._meta.get_field('timestamp').column]
+        if index_name in message or ', '.join(f'{table}.{column}' for column in columns) in message:
+            return True
+    return False
+
+
+def drop_unique_index_sql(model):
+    field, index_name = UNIQUE_KEYS[model]
+    if connection.vendor == 'mysql':
+        return f'DROP INDEX {connection.ops.quote_name(index_name)} ON {connection.ops.quote_name(model._meta.db_table)}'
+    return f'DROP INDEX {connection.ops.quote_name(index_name)}'
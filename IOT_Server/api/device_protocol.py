@@ -0,0 +1,128 @@
+#--- IOT_Server - api app device line protocol --------------------------------
+#Line protocol "<token> <tag> <value> [<timestamp>]" of the device_listener command
+
+from django.db import close_old_connections
+from rest_framework import serializers
+from api.models import IotData
+from api.serializers import parse_tag_value
+from api.authentication import get_token_user
+from api import tag_cache, ingest_queue, deadband
+
+_timestamp_field = serializers.DateTimeField()
+
+
+class LineIngest:
+    """
+    Validates protocol lines and buffers the readings for a bulk insert.
+    Not thread safe, the listener runs every call on a single database thread.
+    """
+
+    def __init__(self, flush_size, on_error=None):
+        self.flush_size = flush_size
+        #Called with unexpected exceptions, which are answered with ERR
+        self.on_error = on_error
+        self.records = []
+        #(replies, index) of the reply of each buffered record
+        self.pending = []
+        #(replies, done) of the calls waiting for a flush
+        self.waiting = []
+        #Readings left out by their tag deadband since the last flush
+        self.suppressed = 0
+
+    def parse_line(self, line):
+        #Returns an unsaved IotData record for a protocol line, raises ValueError with a message if invalid
+        fields = line.split()
+        if len(fields) not in (3, 4):
+            raise ValueError('Expected: token tag value [timestamp]')
+        key, tag_id, value = fields[:3]
+
+        user = get_token_user(key)
+        if user is None:
+            raise ValueError('Invalid token.')
+        tag_info = tag_cache.get_tag(tag_id)
+        if tag_info is None or tag_info.owner_id != user.pk:
+            raise ValueError(f'Invalid pk "{tag_id}" - object does not exist.')
+
+        values = parse_tag_value(tag_info.type, value)
+        if len(fields) == 4:
+            try:
+                values['timestamp'] = _timestamp_field.to_internal_value(fields[3])
+            except serializers.ValidationError as e:
+                raise ValueError(' '.join(e.detail))
+        return IotData(tag_id=tag_id, **values)
+
+    def report_error(self, e):
+        if self.on_error is not None:
+            self.on_error(e)
+
+    def handle_lines(self, lines, done):
+        """
+        Validates and buffers lines, done is called with a reply per line ('OK' or 'ERR <message>')
+        once the buffered readings among them are flushed, right away when none were buffered.
+        """
+        close_old_connections()
+        replies = []
+        for line in lines:
+            try:
+                record = self.parse_line(line)
+                if deadband.filter_records([record], tag_cache.get_tags([record.tag_id])):
+                    self.pending.append((replies, len(replies)))
+                    self.records.append(record)
+                    replies.append(None)
+                else:
+                    self.suppressed += 1
+                    replies.append('OK')
+            except ValueError as e:
+                replies.append(f'ERR {e}')
+            except Exception as e:
+                self.report_error(e)
+                replies.append('ERR Server error.')
+        if None in replies:
+            self.waiting.append((replies, done))
+        else:
+            done(replies)
+
+    def is_full(self):
+        return len(self.records) >= self.flush_size
+
+    def save(self, records):
+        #Saves or queues records, returns [(index, error message)] of the records that were not
+        if ingest_queue.is_enabled():
+            try:
+                ingest_queue.enqueue(ingest_queue.TAG_DATA, records)
+            except ingest_queue.QueueFull as e:
+                return [(index, f'Ingest queue full: {e}') for index in range(len(records))]
+            return []
+        failed = ingest_queue.save_records(IotData, records)
+        failed_indexes = {index for index, error in failed}
+        try:
+            ingest_queue.update_latest(ingest_queue.TAG_DATA, [record for index, record in enumerate(records)
+                                                               if index not in failed_indexes])
+        except Exception as e:
+            #The readings are committed, current values are read from the database when the store misses
+            self.report_error(e)
+        return failed
+
+    def flush(self):
+        """
+        Saves the buffered readings and sends the replies waiting for them.
+        Returns (saved, [(record, error message)]).
+        """
+        if not self.records:
+            return 0, []
+        close_old_connections()
+        records, self.records = self.records, []
+        pending, self.pending = self.pending, []
+        waiting, self.waiting = self.waiting, []
+        try:
+            failed = self.save(records)
+        except Exception as e:
+            self.report_error(e)
+            failed = [(index, 'Server error.') for index in range(len(records))]
+        errors = dict(failed)
+        deadband.reset({records[index].tag_id for index in errors})
+        for index, (replies, reply_index) in enumerate(pending):
+            replies[reply_index] = 'ERR ' + ' '.join(errors[index].split()) if index in errors else 'OK'
+        for replies, done in waiting:
+            done(replies)
+        return len(records) - len(errors), [(records[index], error) for index, error in failed]
@@ -0,0 +1,85 @@
+#--- IOT_Server - api app downsampling -----------------------------------------
+#LTTB and min / max downsampling of a series for the points parameter of the data list views
+
+from api import export
+
+METHODS = ('lttb', 'minmax')
+
+
+def _buckets(items, every, last):
+    #Lists of consecutive items, item i goes in bucket i // every (every >= 1), items after bucket last go in last
+    bucket = []
+    index = 0
+    boundary = every
+    for i, item in enumerate(items):
+        if i >= boundary and index < last:
+            yield bucket
+            bucket = []
+            index += 1
+            boundary = (index + 1) * every
+        bucket.append(item)
+    if bucket:
+        yield bucket
+
+
+def _points(rows, start):
+    #(row, x, y) with x the seconds since start and y the value as float.
+    #Subtracting datetimes with the same tzinfo skips the utcoffset calls of datetime.timestamp()
+    for row in rows:
+        yield row, (row[0] - start).total_seconds(), float(row[2])
+
+
+def lttb(rows, count, threshold):
+    #Yields at most threshold (3 or more) of the rows, count is the number of rows
+    rows = iter(rows)
+    if count <= threshold:
+        yield from rows
+        return
+    first = next(rows, None)
+    if first is None:
+        return
+    yield first
+    first = (first, 0.0, float(first[2]))
+    points = _points(rows, first[0][0])
+
+    #The rows between the first and last are split into threshold - 2 buckets, the last row ends up on its own
+    buckets = _buckets(points, (count - 2) / (threshold - 2), threshold - 2)
+    selected = first
+    current = next(buckets, None)
+    for following in buckets:
+        avg_x = sum(point[1] for point in following) / len(following)
+        avg_y = sum(point[2] for point in following) / len(following)
+        sel_x, sel_y = selected[1], selected[2]
+        selected = max(current, key=lambda point: abs((sel_x - avg_x) * (point[2] - sel_y) -
+                                                      (sel_x - point[1]) * (avg_y - sel_y)))
+        yield selected[0]
+        current = following
+    if current:
+        yield current[-1][0]
+
+
+def minmax(rows, count, threshold):
+    #Yields at most threshold (2 or more) of the rows, count is the number of rows
+    rows = iter(rows)
+    if count <= threshold:
+        yield from rows
+        return
+    bucket_count = threshold // 2
+    for bucket in _buckets(rows, count / bucket_count, bucket_count - 1):
+        low = min(bucket, key=lambda row: row[2])
+        high = max(bucket, key=lambda row: row[2])
+        if low is high:
+            yield low
+        else:
+            yield from sorted((low, high), key=lambda row: row[:2])
+
+
+def downsample(rows, count, threshold, method='lttb'):
+    return (lttb if method == 'lttb' else minmax)(rows, count, threshold)
+
+
+def iter_rows(queryset, field):
+    #(timestamp, id, value) of the records with a value, in keyset chunks so memory stays flat on MySQL too
+    queryset = queryset.filter(**{f'{field}__isnull': False})
+    for chunk in export.iter_chunks(queryset, [field]):
+        yield from chunk
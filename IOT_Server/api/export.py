@@ -0,0 +1,114 @@
+#--- IOT_Server - api app export ----------------------------------------------
+#Streaming CSV / NDJSON export, rows are read in keyset chunks as mysqlclient buffers whole results
+
+import csv
+import heapq
+import json
+from itertools import islice
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from rest_framework import serializers
+from api.pagination import keyset_filter
+from api.aggregation import VALUE_FIELDS
+from api.latest import tag_value_repr
+
+OUTPUT_TYPES = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+TAG_COLUMNS = ('tag', 'type', 'value', 'timestamp')
+WEATHER_COLUMNS = ('identifier', 'temperature', 'dewpoint', 'temp_uom',
+                   'wind_speed', 'wind_gust', 'wind_uom', 'wind_dir', 'dir_uom',
+                   'pressure', 'press_uom', 'timestamp')
+
+_timestamp_field = serializers.DateTimeField()
+
+
+def get_chunk_size():
+    return getattr(settings, 'IOT_EXPORT_CHUNK_SIZE', 5000)
+
+
+def parse_output(value):
+    #Returns the output type for an output parameter, default csv
+    if not value:
+        return 'csv'
+    if value not in OUTPUT_TYPES:
+        raise serializers.ValidationError({'Invalid output': value, 'Valid outputs are': list(OUTPUT_TYPES)})
+    return value
+
+
+def iter_chunks(queryset, fields):
+    #Lists of value tuples ('timestamp', 'pk', *fields) in (timestamp, id) order
+    chunk_size = get_chunk_size()
+    queryset = queryset.order_by('timestamp', 'pk')
+    position = None
+    while True:
+        chunk = queryset if position is None else keyset_filter(queryset, *position)
+        rows = list(chunk.values_list('timestamp', 'pk', *fields)[:chunk_size])
+        if rows:
+            yield rows
+        if len(rows) < chunk_size:
+            return
+        position = rows[-1][:2]
+
+
+def merge_chunks(chunks, rows):
+    #Chunks of value tuples merged with (timestamp, id, value) rows in (timestamp, id) order
+    chunk_size = get_chunk_size()
+    merged = heapq.merge((row for chunk in chunks for row in chunk), rows, key=lambda row: row[:2])
+    while True:
+        chunk = list(islice(merged, chunk_size))
+        if chunk:
+            yield chunk
+        if len(chunk) < chunk_size:
+            return
+
+
+def tag_rows(queryset, tag_id, tag_type, archived=()):
+    #Chunks of TAG_COLUMNS rows for the records of a single tag, merged with its archived (timestamp, id, value) rows
+    field = VALUE_FIELDS.get(tag_type, 'value_text')
+    known_type = tag_type in VALUE_FIELDS
+    for chunk in merge_chunks(iter_chunks(queryset, [field]), archived):
+        #A null value (e.g. stored under an earlier value type) is exported empty
+        yield [(tag_id, tag_type, None if value is None and known_type else tag_value_repr(value, tag_type),
+                _timestamp_field.to_representation(timestamp))
+               for timestamp, pk, value in chunk]
+
+
+def weather_rows(queryset, identifier):
+    #Chunks of WEATHER_COLUMNS rows for the records of a single station
+    from api.serializers import WxDataSerializer
+    value_columns = WEATHER_COLUMNS[1:-1]
+    value_fields = [WxDataSerializer().fields[column] for column in value_columns]
+    for chunk in iter_chunks(queryset, value_columns):
+        yield [(identifier,
+                *(None if value is None else field.to_representation(value)
+                  for field, value in zip(value_fields, values)),
+                _timestamp_field.to_representation(timestamp))
+               for timestamp, pk, *values in chunk]
+
+
+class _Echo:
+    #File like object for csv.writer that returns what is written
+    def write(self, value):
+        return value
+
+
+def _csv_lines(chunks, columns):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(columns)
+    for rows in chunks:
+        yield ''.join(writer.writerow(row) for row in rows)
+
+
+def _ndjson_lines(chunks, columns):
+    for rows in chunks:
+        yield ''.join(json.dumps(dict(zip(columns, row))) + '\n' for row in rows)
+
+
+def streaming_response(chunks, columns, output, filename):
+    lines = _csv_lines(chunks, columns) if output == 'csv' else _ndjson_lines(chunks, columns)
+    response = StreamingHttpResponse(lines, content_type=OUTPUT_TYPES[output])
+    response['Content-Disposition'] = f'attachment; filename="{filename}.{output}"'
+    return response
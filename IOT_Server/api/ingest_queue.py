@@ -0,0 +1,228 @@
+#--- IOT_Server - api app ingest queue ----------------------------------------
+#Write-behind ingest queue in a SQLite spool, used when IOT_INGEST_MODE = 'queue'
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from api.models import IotData, WeatherStations, WeatherData
+from api import latest, tag_cache, dedupe
+
+TAG_DATA = 'iotdata'
+WEATHER_DATA = 'weatherdata'
+MODELS = {
+    TAG_DATA: IotData,
+    WEATHER_DATA: WeatherData,
+}
+
+_local = threading.local()
+
+
+class QueueFull(Exception):
+    pass
+
+
+def is_enabled():
+    return getattr(settings, 'IOT_INGEST_MODE', 'sync') == 'queue'
+
+
+def get_path():
+    default = os.path.join(getattr(settings, 'BASE_DIR', ''), 'ingest_spool.sqlite3')
+    return getattr(settings, 'IOT_INGEST_SPOOL', default)
+
+
+def get_max_depth():
+    return getattr(settings, 'IOT_INGEST_MAX_DEPTH', 100000)
+
+
+def ignore_duplicates():
+    return getattr(settings, 'IOT_INGEST_IGNORE_DUPLICATES', False)
+
+
+def _connect():
+    #One connection per thread and spool file, autocommit with explicit transactions
+    path = get_path()
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    if path not in connections:
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS spool (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                     'kind TEXT NOT NULL, payload TEXT NOT NULL, queued REAL NOT NULL)')
+        conn.execute('CREATE TABLE IF NOT EXISTS failed (id INTEGER PRIMARY KEY, '
+                     'kind TEXT NOT NULL, payload TEXT NOT NULL, queued REAL NOT NULL, error TEXT NOT NULL)')
+        connections[path] = conn
+    return connections[path]
+
+
+def _payload(obj):
+    #Field values of an unsaved record, the id and auto set fields are assigned when it is saved.
+    #Datetimes and decimals are stored with str() to keep full precision.
+    return {field.attname: getattr(obj, field.attname) for field in obj._meta.concrete_fields
+            if not field.primary_key and not getattr(field, 'auto_now_add', False)}
+
+
+def _record(kind, payload):
+    model = MODELS[kind]
+    return model(**{name: model._meta.get_field(name).to_python(value) for name, value in payload.items()})
+
+
+def depth():
+    #Number of readings waiting in the spool, ids are contiguous as the worker deletes from the front
+    first, last = _connect().execute('SELECT MIN(id), MAX(id) FROM spool').fetchone()
+    return 0 if first is None else last - first + 1
+
+
+def stats():
+    conn = _connect()
+    queued = conn.execute('SELECT queued FROM spool ORDER BY id LIMIT 1').fetchone()
+    failed = conn.execute('SELECT COUNT(*) FROM failed').fetchone()[0]
+    return {
+        'depth': depth(),
+        'max_depth': get_max_depth(),
+        'oldest_age': round(time.time() - queued[0], 3) if queued else 0,
+        'failed': failed,
+    }
+
+
+def enqueue(kind, records):
+    #Appends validated, unsaved records to the spool, raises QueueFull when it is at max depth
+    conn = _connect()
+    max_depth = get_max_depth()
+    queued = time.time()
+    rows = [(kind, json.dumps(_payload(obj), default=str), queued) for obj in records]
+    #Depth is read under the write lock, so concurrent enqueues cannot pass max depth together
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        if depth() + len(rows) > max_depth:
+            raise QueueFull(f'{max_depth} readings are waiting to be saved.')
+        conn.executemany('INSERT INTO spool (kind, payload, queued) VALUES (?, ?, ?)', rows)
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+
+def drop_stored(model, records):
+    """
+    With IOT_INGEST_IGNORE_DUPLICATES returns the records the unique index would not ignore, see unstored.
+    The ingest serializers apply it before the deadband and the latest value store, a reading
+    stored by a concurrent request after this lookup is still only skipped by the database.
+    """
+    if not ignore_duplicates():
+        return records
+    return unstored(model, records)
+
+
+def unstored(model, records):
+    #Records whose (tag / station, timestamp) is not stored yet, the first of repeats in records, with one query
+    if not records:
+        return records
+    field, index_name = dedupe.UNIQUE_KEYS[model]
+    key_field = f'{field}_id'
+    timestamps = [obj.timestamp for obj in records]
+    stored = model.objects.filter(**{f'{key_field}__in': {getattr(obj, key_field) for obj in records}},
+                                  timestamp__gte=min(timestamps), timestamp__lte=max(timestamps))
+    seen = set(stored.values_list(key_field, 'timestamp'))
+    new = []
+    for obj in records:
+        key = (getattr(obj, key_field), obj.timestamp)
+        if key not in seen:
+            seen.add(key)
+            new.append(obj)
+    return new
+
+
+def insert_records(model, records):
+    """
+    Inserts unsaved records with bulk_create and returns them.
+    With IOT_INGEST_IGNORE_DUPLICATES records conflicting with a unique index are skipped
+    without an error and ids are not set on the returned records. On MySQL this is INSERT
+    IGNORE, which also stores truncated / clamped values and skips rows with a missing
+    tag / station instead of raising.
+    """
+    batch_size = getattr(settings, 'IOT_BULK_BATCH_SIZE', 500)
+    return model.objects.bulk_create(records, batch_size=batch_size, ignore_conflicts=ignore_duplicates())
+
+
+def save_records(model, records):
+    #Insert the records, on an error insert them one at a time.
+    #Returns [(index, error message)] of the records that could not be saved.
+    try:
+        with transaction.atomic():
+            insert_records(model, records)
+        return []
+    except DatabaseError:
+        pass
+    failed = []
+    for index, record in enumerate(records):
+        try:
+            with transaction.atomic():
+                insert_records(model, [record])
+        except DatabaseError as e:
+            failed.append((index, str(e)))
+    return failed
+
+
+def update_latest(kind, records):
+    #Updates the latest value store from saved records of any owner
+    if kind == TAG_DATA:
+        tag_infos = tag_cache.get_tags({obj.tag_id for obj in records})
+        by_owner = defaultdict(list)
+        for obj in records:
+            if obj.tag_id in tag_infos:
+                by_owner[tag_infos[obj.tag_id].owner_id].append(obj)
+        for owner_id, owner_records in by_owner.items():
+            latest.store_tag_data(owner_records, {tag_id: info.type for tag_id, info in tag_infos.items()},
+                                  owner_id)
+    else:
+        stations = WeatherStations.objects.in_bulk({obj.station_id for obj in records})
+        for obj in records:
+            obj.station = stations.get(obj.station_id)
+        latest.store_weather_data([obj for obj in records if obj.station is not None])
+
+
+def drain(max_records):
+    """
+    Saves up to max_records of the oldest queued readings and removes them from the spool.
+    Readings that cannot be saved (e.g. their tag was deleted) are moved to the failed table.
+    Returns the number of readings taken from the spool.
+    """
+    conn = _connect()
+    rows = conn.execute('SELECT id, kind, payload, queued FROM spool ORDER BY id LIMIT ?',
+                        (max_records,)).fetchall()
+    if not rows:
+        return 0
+
+    by_kind = defaultdict(list)
+    for row in rows:
+        by_kind[row[1]].append(row)
+
+    failed_rows = []
+    saved = {}
+    for kind, kind_rows in by_kind.items():
+        records = [_record(kind, json.loads(row[2])) for row in kind_rows]
+        failed = save_records(MODELS[kind], records)
+        failed_indexes = {index for index, error in failed}
+        failed_rows += [(*kind_rows[index], error) for index, error in failed]
+        saved[kind] = [record for index, record in enumerate(records) if index not in failed_indexes]
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.executemany('INSERT OR REPLACE INTO failed (id, kind, payload, queued, error) VALUES (?, ?, ?, ?, ?)',
+                         failed_rows)
+        conn.execute('DELETE FROM spool WHERE id <= ?', (rows[-1][0],))
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+    for kind, records in saved.items():
+        if records:
+            update_latest(kind, records)
+    return len(rows)
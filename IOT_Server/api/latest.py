@@ -0,0 +1,143 @@
+#--- IOT_Server - api app latest value store ----------------------------------
+#Latest reading per tag and weather station, kept in the IOT_LATEST_CACHE Django cache
+
+from decimal import Decimal
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from rest_framework import serializers
+from api.models import IotData
+from api.aggregation import VALUE_FIELDS
+from api import live
+
+TAG_PREFIX = 'iot:latest:tag:'
+STATION_PREFIX = 'iot:latest:wx:'
+
+_timestamp_field = serializers.DateTimeField()
+
+
+def get_cache():
+    return caches[getattr(settings, 'IOT_LATEST_CACHE', 'default')]
+
+
+def get_timeout():
+    return getattr(settings, 'IOT_LATEST_CACHE_TIMEOUT', 60)
+
+
+def is_process_local():
+    #True when the store lives in the memory of each process
+    return isinstance(get_cache(), LocMemCache)
+
+
+def tag_key(tag_id):
+    return f'{TAG_PREFIX}{tag_id}'
+
+
+def station_key(owner_id, identifier):
+    return f'{STATION_PREFIX}{owner_id}:{identifier}'
+
+
+def tag_value_repr(value, tag_type):
+    #String representation of a stored tag value, normalised the way it reads back from the database
+    if tag_type == 'bool':
+        value = bool(value)
+    elif tag_type == 'int':
+        value = int(value)
+    elif tag_type == 'dec':
+        places = IotData._meta.get_field('value_dec').decimal_places
+        value = Decimal(value).quantize(Decimal(10) ** -places)
+    elif tag_type != 'string':
+        value = 'Unknown value type for tag.'
+    return str(value)
+
+
+def tag_data_repr(obj, tag_type):
+    """
+    Returns the TagDataSerializer representation of an IotData record without touching
+    the tag or value type relations. Values are normalised the way they read back
+    from the database so cached and queried records are identical.
+    """
+    value = getattr(obj, VALUE_FIELDS[tag_type]) if tag_type in VALUE_FIELDS else None
+    return {'tag': obj.tag_id, 'type': tag_type, 'value': tag_value_repr(value, tag_type),
+            'timestamp': _timestamp_field.to_representation(obj.timestamp)}
+
+
+def _store(entries):
+    #entries = {key: entry}, only entries newer than the cached reading are written
+    if not entries:
+        return
+    cache = get_cache()
+    cached = cache.get_many(list(entries))
+    newer = {key: entry for key, entry in entries.items()
+             if key not in cached or cached[key]['ts'] <= entry['ts']}
+    if newer:
+        cache.set_many(newer, timeout=get_timeout())
+
+
+def _latest_entries(items):
+    #Keep only the most recent entry per key from (key, entry) pairs
+    entries = {}
+    for key, entry in items:
+        if key not in entries or entries[key]['ts'] <= entry['ts']:
+            entries[key] = entry
+    return entries
+
+
+def store_tag_data(records, tag_types, owner_id):
+    """
+    Updates the latest reading of tags from saved IotData records.
+    tag_types = {tag_id: value type}, all records must belong to tags owned by owner_id.
+    The live/ watchers of the tags in this process are woken.
+    """
+    items = [(obj, tag_data_repr(obj, tag_types[obj.tag_id])) for obj in records]
+    _store(_latest_entries(
+        (tag_key(obj.tag_id), {'ts': obj.timestamp, 'owner': owner_id, 'data': data})
+        for obj, data in items))
+    live.hub.notify({live.tag_key(obj.tag_id) for obj in records})
+
+
+def store_weather_data(records):
+    #Updates the latest reading of stations from saved WeatherData records with station loaded, and wakes their watchers
+    from api.serializers import WxDataSerializer
+    items = [(obj, dict(WxDataSerializer(obj).data)) for obj in records]
+    _store(_latest_entries(
+        (station_key(obj.station.owner_id, obj.station.identifier),
+         {'ts': obj.timestamp, 'owner': obj.station.owner_id, 'data': data})
+        for obj, data in items))
+    live.hub.notify({live.station_key(obj.station.owner_id, obj.station.identifier) for obj in records})
+
+
+def get_tag_data(tag_id, owner_id):
+    #Latest serialized reading of a tag owned by owner_id, None on a miss
+    entry = get_cache().get(tag_key(tag_id))
+    if entry is None or entry['owner'] != owner_id:
+        return None
+    return entry['data']
+
+
+def get_tag_data_many(tag_ids, owner_id):
+    #Latest serialized readings of tags owned by owner_id, returns {tag_id: data} of hits
+    entries = get_cache().get_many([tag_key(tag_id) for tag_id in tag_ids])
+    found = {}
+    for tag_id in tag_ids:
+        entry = entries.get(tag_key(tag_id))
+        if entry is not None and entry['owner'] == owner_id:
+            found[tag_id] = entry['data']
+    return found
+
+
+def get_weather_data(owner_id, identifier):
+    #Latest serialized observation of a station owned by owner_id, None on a miss
+    entry = get_cache().get(station_key(owner_id, identifier))
+    if entry is None:
+        return None
+    return entry['data']
+
+
+def invalidate_tags(tag_ids):
+    get_cache().delete_many([tag_key(tag_id) for tag_id in tag_ids])
+
+
+def invalidate_stations(stations):
+    #stations = iterable of (owner_id, identifier)
+    get_cache().delete_many([station_key(owner_id, identifier) for owner_id, identifier in stations])
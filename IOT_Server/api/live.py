@@ -0,0 +1,363 @@
+#--- IOT_Server - api app live readings hub ------------------------------------
+#Readings of watched tags / stations for live/, read once per process by the poller and kept in memory
+
+import json
+import operator
+import threading
+import time
+from collections import defaultdict, deque
+from functools import reduce
+from django.conf import settings
+from django.db import close_old_connections, connection
+from django.db.models import Q
+from api.models import IotData, WeatherData
+
+#Cursor / mark positions of the data tables
+TAGS, STATIONS = 0, 1
+
+
+def tag_key(tag_id):
+    return ('tag', tag_id)
+
+
+def station_key(owner_id, identifier):
+    return ('station', owner_id, identifier)
+
+
+def get_poll_interval():
+    #0 turns the poller off, readings are then read by each request and only local saves wake watchers
+    return getattr(settings, 'IOT_LIVE_POLL_INTERVAL', 1)
+
+
+def get_read_limit():
+    #Most rows of each table read per request / poll
+    return getattr(settings, 'IOT_LIVE_POLL_LIMIT', 5000)
+
+
+def get_commit_window():
+    #Seconds a row may commit after rows with higher ids and still be read by the poller
+    return getattr(settings, 'IOT_LIVE_COMMIT_WINDOW', 5)
+
+
+def get_keep_seconds():
+    #Seconds readings and keys without watchers are kept for reconnecting clients
+    return getattr(settings, 'IOT_LIVE_KEEP_SECONDS', 60)
+
+
+class Hub:
+    """
+    Watchers of tag / station keys and the readings the poller read for them.
+    Each reading is kept as (appended at, table, id, key, timestamp, data); a cursor holds the id
+    high-water marks of the data tables and the appended at time (microseconds) of the last reading it saw, so
+    rows committed late (ids below the marks) still reach the clients that already passed them.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.watchers = defaultdict(set)
+        #Key: monotonic time its rows stop being read once it has no watchers
+        self.expires = {}
+        #Key: marks from which the readings of the key are all kept
+        self.covered = {}
+        self.readings = deque()
+        self.dropped_at = 0
+        self.last_appended = 0
+        self.marks = None
+        self.poller = None
+
+    def notify(self, keys):
+        #Readings of keys were saved by this process, wakes the poller or without one the watchers of keys
+        with self.lock:
+            if self.poller is not None:
+                if any(key in self.watchers or key in self.expires for key in keys):
+                    self.poller.wake.set()
+                return
+            for key in keys:
+                for event in self.watchers.get(key, ()):
+                    event.set()
+
+    def subscribe(self, keys, event=None):
+        #Returns the event set when a reading of one of keys is available, a threading.Event unless given
+        if event is None:
+            event = threading.Event()
+        with self.lock:
+            for key in keys:
+                self.watchers[key].add(event)
+                self.expires.pop(key, None)
+            if get_poll_interval() and self.poller is None:
+                self.poller = Poller(self)
+                self.poller.start()
+        return event
+
+    def unsubscribe(self, keys, event):
+        expires = time.monotonic() + get_keep_seconds()
+        with self.lock:
+            for key in keys:
+                watchers = self.watchers.get(key)
+                if watchers is not None:
+                    watchers.discard(event)
+                    if not watchers:
+                        del self.watchers[key]
+                        self.expires[key] = expires
+
+    def watched_keys(self, poller):
+        #Keys with watchers or kept for reconnecting clients, when there are none the poller is stopped
+        now = time.monotonic()
+        with self.lock:
+            for key, expires in list(self.expires.items()):
+                if expires <= now:
+                    del self.expires[key]
+                    self.covered.pop(key, None)
+            keys = list(self.watchers) + list(self.expires)
+            if not keys and self.poller is poller:
+                self.stop(poller)
+            return keys
+
+    def stop(self, poller):
+        #Called with the lock held, cursors of the dropped readings are read from the database again
+        if self.poller is poller:
+            self.poller = None
+            self.marks = None
+            self.covered.clear()
+            self.readings.clear()
+            self.dropped_at = self.last_appended
+
+    def append(self, readings, marks, covered):
+        #Adds readings read by the poller and wakes their watchers
+        with self.lock:
+            self.marks = marks
+            for key, key_marks in covered.items():
+                self.covered.setdefault(key, key_marks)
+            if readings:
+                self.last_appended = appended = max(now_us(), self.last_appended + 1)
+                self.readings.extend((appended,) + reading for reading in readings)
+            self.trim()
+            for key in {reading[2] for reading in readings}:
+                for event in self.watchers.get(key, ()):
+                    event.set()
+
+    def trim(self):
+        oldest = now_us() - get_keep_seconds() * 1000000
+        limit = getattr(settings, 'IOT_LIVE_BUFFER_SIZE', 10000)
+        while self.readings and (len(self.readings) > limit or self.readings[0][0] < oldest):
+            self.dropped_at = self.readings.popleft()[0]
+
+    def read(self, keys, marks, appended):
+        """
+        Returns (readings of keys after the cursor (marks, appended), new marks, new appended),
+        None when the kept readings do not cover the cursor.
+        """
+        keys = set(keys)
+        with self.lock:
+            if self.poller is None or appended < self.dropped_at:
+                return None
+            for key in keys:
+                key_marks = self.covered.get(key)
+                if key_marks is None or key_marks[key_table(key)] > marks[key_table(key)]:
+                    return None
+            readings = [reading[1:] for reading in self.readings if reading[3] in keys and
+                        (reading[2] > marks[reading[1]] or reading[0] > appended)]
+            return readings, marks, self.last_appended
+
+
+def now_us():
+    #Wall clock time in microseconds, readings are appended at and cursors compare it across processes
+    return time.time_ns() // 1000
+
+
+def key_table(key):
+    return TAGS if key[0] == 'tag' else STATIONS
+
+
+def _max_pk(model):
+    return model.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+
+
+def _tag_rows(keys, mark, seen, limit):
+    #IotData rows of the tag keys above mark except the ids in seen, ordered by id
+    tag_ids = [key[1] for key in keys if key[0] == 'tag']
+    if not tag_ids:
+        return []
+    records = IotData.objects.filter(pk__gt=mark, tag_id__in=tag_ids)
+    if seen:
+        records = records.exclude(pk__in=seen)
+    return list(records.order_by('pk')[:limit])
+
+
+def _station_rows(keys, mark, seen, limit):
+    #WeatherData rows of the station keys above mark except the ids in seen with their station, ordered by id
+    stations = [Q(station__owner_id=key[1], station__identifier=key[2]) for key in keys if key[0] == 'station']
+    if not stations:
+        return []
+    records = WeatherData.objects.filter(reduce(operator.or_, stations), pk__gt=mark)
+    if seen:
+        records = records.exclude(pk__in=seen)
+    return list(records.select_related('station').order_by('pk')[:limit])
+
+
+def _readings(tag_rows, station_rows):
+    #(table, id, key, timestamp, data) of the rows
+    from api import latest, tag_cache
+    from api.serializers import WxDataSerializer
+    tag_infos = tag_cache.get_tags({obj.tag_id for obj in tag_rows})
+    readings = [(TAGS, obj.pk, tag_key(obj.tag_id), obj.timestamp,
+                 latest.tag_data_repr(obj, tag_infos[obj.tag_id].type)) for obj in tag_rows if obj.tag_id in tag_infos]
+    readings += [(STATIONS, obj.pk, station_key(obj.station.owner_id, obj.station.identifier), obj.timestamp,
+                  dict(WxDataSerializer(obj).data)) for obj in station_rows]
+    return readings
+
+
+class Poller(threading.Thread):
+    """
+    Reads the rows of the watched keys once per tick for all watchers of the process, woken early
+    by readings saved in the process. Rows above the marks of IOT_LIVE_COMMIT_WINDOW seconds ago
+    are read again, less the ids already read, so rows committed late are not skipped.
+    Stops when nobody watches.
+    """
+
+    def __init__(self, hub):
+        super().__init__(name='iot-live-poller', daemon=True)
+        self.hub = hub
+        self.wake = threading.Event()
+        self.marks = None
+        #(monotonic time, marks) of the ticks in the commit window and ids read above its floor
+        self.ticks = deque()
+        self.seen = (set(), set())
+
+    def run(self):
+        try:
+            self.begin()
+            while True:
+                self.wake.wait(get_poll_interval())
+                self.wake.clear()
+                keys = self.hub.watched_keys(self)
+                if not keys:
+                    return
+                close_old_connections()
+                self.poll(keys)
+        except Exception:
+            #Let the next watcher start a new poller
+            with self.hub.lock:
+                self.hub.stop(self)
+            raise
+        finally:
+            connection.close()
+
+    def begin(self):
+        self.marks = (_max_pk(IotData), _max_pk(WeatherData))
+        self.ticks.append((time.monotonic(), self.marks))
+
+    def get_floor(self, now):
+        #Marks of the newest tick older than the commit window, ids read at or below it are forgotten
+        while len(self.ticks) > 1 and self.ticks[1][0] <= now - get_commit_window():
+            self.ticks.popleft()
+        floor = self.ticks[0][1]
+        for table in (TAGS, STATIONS):
+            self.seen[table].difference_update([pk for pk in self.seen[table] if pk <= floor[table]])
+        return floor
+
+    def poll(self, keys):
+        now = time.monotonic()
+        floor = self.get_floor(now)
+        limit = get_read_limit()
+        tag_rows = _tag_rows(keys, floor[TAGS], self.seen[TAGS], limit)
+        station_rows = _station_rows(keys, floor[STATIONS], self.seen[STATIONS], limit)
+        self.seen[TAGS].update(obj.pk for obj in tag_rows)
+        self.seen[STATIONS].update(obj.pk for obj in station_rows)
+        self.marks = (max([self.marks[TAGS]] + [obj.pk for obj in tag_rows]),
+                      max([self.marks[STATIONS]] + [obj.pk for obj in station_rows]))
+        self.ticks.append((now, self.marks))
+        #Rows of keys read for the first time are all kept from the floor on
+        self.hub.append(_readings(tag_rows, station_rows), self.marks, {key: floor for key in keys})
+
+
+def parse_cursor(cursor):
+    #((IotData mark, WeatherData mark), appended at) of a cursor, None when it is missing or invalid
+    parts = (cursor or '').split(':')
+    if len(parts) != 3 or not all(part.isdigit() for part in parts):
+        return None
+    return (int(parts[0]), int(parts[1])), int(parts[2])
+
+
+def format_cursor(marks, appended):
+    return f'{marks[TAGS]}:{marks[STATIONS]}:{appended}'
+
+
+def current_cursor():
+    with hub.lock:
+        marks = hub.marks
+    if marks is None:
+        marks = (_max_pk(IotData), _max_pk(WeatherData))
+    return format_cursor(marks, now_us())
+
+
+def read(keys, cursor):
+    """
+    Returns (data of the readings of keys after cursor in the order they were taken, new cursor, reset).
+    reset is True when the cursor is missing or invalid, the new cursor is then the current one.
+    Readings kept by the hub are returned without a query, other cursors are read from the database.
+    """
+    parsed = parse_cursor(cursor)
+    if parsed is None:
+        return [], current_cursor(), True
+    marks, appended = parsed
+    result = hub.read(keys, marks, appended)
+    if result is None:
+        limit = get_read_limit()
+        readings = _readings(_tag_rows(keys, marks[TAGS], None, limit),
+                             _station_rows(keys, marks[STATIONS], None, limit))
+        result = readings, marks, now_us()
+    readings, marks, appended = result
+    new_marks = [marks[TAGS], marks[STATIONS]]
+    for table, pk, key, timestamp, data in readings:
+        new_marks[table] = max(new_marks[table], pk)
+    readings.sort(key=lambda reading: reading[3])
+    return [reading[4] for reading in readings], format_cursor(new_marks, appended), False
+def get_timeout():
+    #Longest wait of a long-poll request in seconds
+    return getattr(settings, 'IOT_LIVE_TIMEOUT', 25)
+
+
+def wait(keys, cursor, timeout):
+    #Long-poll, returns (data, cursor, reset) as soon as there are readings after cursor or after timeout
+    event = hub.subscribe(keys)
+    try:
+        data, new_cursor, reset = read(keys, cursor)
+        if not data and not reset and event.wait(timeout):
+            data, new_cursor, reset = read(keys, cursor)
+        return data, new_cursor, reset
+    finally:
+        hub.unsubscribe(keys, event)
+
+
+def sse_lines(keys, cursor, get_current):
+    """
+    Server-Sent Events stream of the readings of keys after cursor, one message per batch of
+    readings with the cursor as its id. A reset message carries get_current() instead.
+    Comments are sent every IOT_LIVE_HEARTBEAT seconds (default 15) to keep the connection
+    open, the stream ends after IOT_LIVE_SSE_SECONDS (default 300) and the client reconnects
+    with Last-Event-ID.
+    """
+    heartbeat = getattr(settings, 'IOT_LIVE_HEARTBEAT', 15)
+    deadline = time.monotonic() + getattr(settings, 'IOT_LIVE_SSE_SECONDS', 300)
+    event = hub.subscribe(keys)
+    try:
+        yield 'retry: 1000\n\n'
+        while True:
+            data, cursor, reset = read(keys, cursor)
+            if reset:
+                yield f'event: reset\nid: {cursor}\ndata: {json.dumps(get_current())}\n\n'
+            elif data:
+                yield f'id: {cursor}\ndata: {json.dumps(data)}\n\n'
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            if event.wait(min(heartbeat, remaining)):
+                event.clear()
+            else:
+                yield ': keepalive\n\n'
+    finally:
+        hub.unsubscribe(keys, event)
+
+
+hub = Hub()
@@ -0,0 +1,46 @@
+#--- IOT_Server - api app archive_history command ------------------------------
+
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from api.models import Tags, IotData
+from api.aggregation import EpochBucket, VALUE_FIELDS, bucket_datetime
+from api.archive import MixedValues, archive_day, get_archive_after
+
+
+class Command(BaseCommand):
+    help = ('Moves tag history older than IOT_ARCHIVE_AFTER_DAYS (default 90) into compressed '
+            'columnar blocks, one per tag and UTC day. Archived records are still returned by data/list/.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int,
+                            help='Archive records older than this many days instead of IOT_ARCHIVE_AFTER_DAYS.')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        cutoff = now - (timedelta(days=options['days']) if options['days'] else get_archive_after())
+        #Only whole UTC days are archived
+        cutoff = cutoff.replace(hour=0, minute=0, second=0, microsecond=0)
+
+        archived = tag_count = skipped = 0
+        for tag_id, tag_type in Tags.objects.values_list('tag_id', 'value_type__type').iterator():
+            if tag_type not in VALUE_FIELDS:
+                continue
+            days = IotData.objects.filter(tag_id=tag_id, timestamp__lt=cutoff) \
+                                  .annotate(day=EpochBucket('timestamp', 86400)) \
+                                  .values_list('day', flat=True).distinct()
+            tag_archived = 0
+            for day in sorted(days):
+                try:
+                    tag_archived += archive_day(tag_id, tag_type, bucket_datetime(day).date())
+                except MixedValues as e:
+                    skipped += 1
+                    self.stderr.write(f'Not archived: {e}')
+            if tag_archived:
+                tag_count += 1
+                archived += tag_archived
+                if options['verbosity'] > 1:
+                    self.stdout.write(f'{tag_id}: {tag_archived} records archived.')
+        self.stdout.write(f'{archived} records of {tag_count} tags archived before {cutoff.isoformat()}.')
+        if skipped:
+            self.stdout.write(f'{skipped} days with values of more than one type left live.')
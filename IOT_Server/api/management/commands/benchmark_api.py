@@ -0,0 +1,100 @@
+#--- IOT_Server - api app benchmark_api command -------------------------------
+
+import json
+import platform
+from datetime import timedelta
+import django
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.utils import timezone
+from api import benchmark
+
+
+class Command(BaseCommand):
+    help = ('Seeds a throw away database and drives the ingest and query views through the test client, '
+            'reporting p50 / p99 latency, requests per second and queries per request. '
+            'Results can be written as JSON and compared with an earlier run.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--devices', type=int, default=2, help='Number of devices seeded.')
+        parser.add_argument('--tags', type=int, default=10, help='Tags per device.')
+        parser.add_argument('--readings', type=int, default=10000, help='Readings seeded per tag and station.')
+        parser.add_argument('--stations', type=int, default=2, help='Number of weather stations seeded.')
+        parser.add_argument('--repeat', type=int, default=200, help='Timed requests per endpoint.')
+        parser.add_argument('--batch-size', type=int, default=100, help='Records per data/add/batch/ request.')
+        parser.add_argument('--output', help='Write the results to this JSON file.')
+        parser.add_argument('--compare', help='JSON file of an earlier run to report changes against.')
+
+    def get_scenarios(self, client, tag_ids, identifiers, batch_size, end):
+        #(name, request(call number)) of every measured endpoint
+        tag, ident = tag_ids[0], identifiers[0]
+        mid = (end - timedelta(seconds=self.readings // 2)).isoformat()
+        return (
+            ('tag add', lambda i: client.post('/data/add/', {'tag': tag_ids[i % len(tag_ids)], 'value': i % 1000},
+                                              format='json')),
+            ('tag add batch', lambda i: client.post('/data/add/batch/', [
+                {'tag': tag_ids[n % len(tag_ids)], 'value': n % 1000} for n in range(batch_size)], format='json')),
+            ('weather add', lambda i: client.post('/weatherdata/add/', {'identifier': identifiers[i % len(identifiers)],
+                                                                        'temperature': i % 40}, format='json')),
+            ('tag list', lambda i: client.get(f'/data/list/{tag}/', {'max': 100})),
+            ('tag list range', lambda i: client.get(f'/data/list/{tag}/', {'begin': mid, 'max': 100})),
+            ('tag current', lambda i: client.get(f'/data/current/{tag}/')),
+            ('tag current all', lambda i: client.get('/data/current/')),
+            ('tag aggregate', lambda i: client.get(f'/data/aggregate/{tag}/', {'interval': '1h'})),
+            ('tag points', lambda i: client.get(f'/data/list/{tag}/', {'points': 500})),
+            ('weather list', lambda i: client.get(f'/weatherdata/list/{ident}/', {'max': 100})),
+            ('weather current', lambda i: client.get(f'/weatherdata/current/{ident}/')),
+        )
+
+    def handle(self, *args, **options):
+        self.readings = options['readings']
+        results = {}
+        setup_test_environment()
+        try:
+            with benchmark.benchmark_database():
+                user = benchmark.seed_owner()
+                tag_ids = benchmark.seed_tags(user, devices=options['devices'], tags_per_device=options['tags'])
+                identifiers = benchmark.seed_stations(user, stations=options['stations'])
+                end = benchmark.seed_tag_data(tag_ids, self.readings)
+                benchmark.seed_weather_data(user, identifiers, self.readings)
+                client = benchmark.api_client(user)
+
+                self.stdout.write(f"{'endpoint':<18} {'p50 ms':>8} {'p99 ms':>8} {'req/s':>9} {'queries':>8}")
+                for name, request in self.get_scenarios(client, tag_ids, identifiers, options['batch_size'], end):
+                    #Warm up covers every tag once so the caches are warm as in steady traffic
+                    result = benchmark.measure_requests(request, options['repeat'], warmup=max(5, len(tag_ids)))
+                    results[name] = result
+                    self.stdout.write(f"{name:<18} {result['p50_ms']:>8.3f} {result['p99_ms']:>8.3f} "
+                                      f"{result['requests_per_sec']:>9.1f} {result['queries_per_request']:>8.2f}")
+                    if any(code >= 400 for code in result['status']):
+                        self.stderr.write(f"{name}: error responses {result['status']}")
+        finally:
+            teardown_test_environment()
+
+        report = {
+            'created': timezone.now().isoformat(),
+            'environment': {'python': platform.python_version(), 'django': django.get_version(),
+                            'database': connection.vendor},
+            'options': {name: options[name] for name in
+                        ('devices', 'tags', 'readings', 'stations', 'repeat', 'batch_size')},
+            'results': results,
+        }
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+                f.write('\n')
+        if options['compare']:
+            with open(options['compare']) as f:
+                self.compare(json.load(f), report)
+
+    def compare(self, before, after):
+        #Change of p50 latency and queries per request against an earlier report
+        self.stdout.write(f"\n{'endpoint':<18} {'p50 change':>11} {'queries before':>15} {'queries after':>14}")
+        for name, result in after['results'].items():
+            earlier = before.get('results', {}).get(name)
+            if earlier is None:
+                continue
+            change = (result['p50_ms'] - earlier['p50_ms']) / earlier['p50_ms'] * 100 if earlier['p50_ms'] else 0
+            self.stdout.write(f"{name:<18} {change:>+10.1f}% {earlier['queries_per_request']:>15.2f} "
+                              f"{result['queries_per_request']:>14.2f}")
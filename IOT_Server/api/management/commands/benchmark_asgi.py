@@ -0,0 +1,128 @@
+#--- IOT_Server - api app benchmark_asgi command ------------------------------
+
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand
+from django.test.utils import setup_test_environment, teardown_test_environment
+from rest_framework.authtoken.models import Token
+from api import benchmark
+from api.asgi import ASGIApplication, get_environ, get_max_threads
+
+
+class Command(BaseCommand):
+    help = ('Compares how many concurrent keep-alive device connections the sync (thread per connection) '
+            'and the ASGI views serve. Every connection sends --requests readings / current value requests '
+            'with --idle seconds between them, as a device does. Runs in process against a throw away database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', default='100,1000',
+                            help='Comma separated numbers of concurrent connections to measure.')
+        parser.add_argument('--requests', type=int, default=2, help='Requests per connection.')
+        parser.add_argument('--idle', type=float, default=0.5, help='Seconds a connection idles between requests.')
+        parser.add_argument('--threads', type=int, default=64,
+                            help='Worker threads of the sync server, each holds one connection.')
+        parser.add_argument('--tags', type=int, default=10, help='Tags seeded.')
+
+    def get_requests(self, tag_ids, token):
+        #(scope, body) of the requests a connection sends in turn: a reading, then the current value
+        requests = []
+        for i, tag_id in enumerate(tag_ids):
+            body = json.dumps({'tag': tag_id, 'value': i}).encode()
+            requests.append((benchmark.http_scope('POST', '/data/add/', token, 'application/json'), body))
+            requests.append((benchmark.http_scope('GET', f'/data/current/{tag_id}/', token), b''))
+        return requests
+
+    def run_sync_server(self, connections, requests, threads):
+        #Thread per connection server, a connection holds its thread while it idles
+        handler = WSGIHandler()
+        latencies, statuses = [], set()
+
+        def connection(n):
+            #A connection that waits for a free thread counts the wait in its first request
+            start = opened
+            for i in range(self.requests):
+                if i:
+                    time.sleep(self.idle)
+                    start = time.perf_counter()
+                scope, body = requests[(n + i) % len(requests)]
+                result = {}
+                response = handler(get_environ(scope, body),
+                                   lambda status, headers, exc_info=None: result.update(status=int(status[:3])))
+                b''.join(response)
+                response.close()
+                latencies.append(time.perf_counter() - start)
+                statuses.add(result['status'])
+
+        opened = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(connection, range(connections)))
+        return latencies, statuses, threads
+
+    def run_asgi_server(self, connections, requests):
+        #Event loop server, idle connections are coroutines, Django work runs in the IOT_ASGI_THREADS pool
+        application = ASGIApplication()
+        latencies, statuses = [], set()
+
+        async def connection(n):
+            start = opened
+            for i in range(self.requests):
+                if i:
+                    await asyncio.sleep(self.idle)
+                    start = time.perf_counter()
+                scope, body = requests[(n + i) % len(requests)]
+                statuses.add(await benchmark.asgi_call(application, scope, body))
+                latencies.append(time.perf_counter() - start)
+
+        async def serve():
+            await asyncio.gather(*(connection(n) for n in range(connections)))
+            return threading.active_count()
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        opened = time.perf_counter()
+        try:
+            peak_threads = loop.run_until_complete(serve())
+        finally:
+            loop.close()
+        return latencies, statuses, peak_threads
+
+    def report(self, name, connections, seconds, latencies, statuses, threads):
+        requests_per_sec = len(latencies) / seconds if seconds else 0
+        p50_ms = benchmark.percentile(latencies, 50) * 1000
+        p99_ms = benchmark.percentile(latencies, 99) * 1000
+        self.stdout.write(f"{name:<6} {connections:>11} {seconds:>9.2f} {requests_per_sec:>9.1f} "
+                          f"{p50_ms:>9.2f} {p99_ms:>9.2f} {threads:>8}")
+        if any(code >= 400 for code in statuses):
+            self.stderr.write(f'{name}: error responses {sorted(statuses)}')
+
+    def handle(self, *args, **options):
+        self.requests = options['requests']
+        self.idle = options['idle']
+        setup_test_environment()
+        try:
+            with benchmark.benchmark_database():
+                user = benchmark.seed_owner()
+                tag_ids = benchmark.seed_tags(user, tags_per_device=options['tags'])
+                benchmark.seed_tag_data(tag_ids, 10)
+                token, created = Token.objects.get_or_create(user=user)
+                requests = self.get_requests(tag_ids, token.key)
+                #Warm the token, tag and latest value caches
+                self.run_sync_server(1, requests, 1)
+
+                self.stdout.write(f'Sync server threads: {options["threads"]}, ASGI pool threads: {get_max_threads()}, '
+                                  f'{self.requests} requests per connection, {self.idle}s idle between requests.')
+                self.stdout.write(f"{'server':<6} {'connections':>11} {'seconds':>9} {'req/s':>9} "
+                                  f"{'p50 ms':>9} {'p99 ms':>9} {'threads':>8}")
+                for connections in [int(n) for n in options['connections'].split(',')]:
+                    start = time.perf_counter()
+                    result = self.run_sync_server(connections, requests, options['threads'])
+                    self.report('sync', connections, time.perf_counter() - start, *result)
+                    start = time.perf_counter()
+                    result = self.run_asgi_server(connections, requests)
+                    self.report('asgi', connections, time.perf_counter() - start, *result)
+        finally:
+            teardown_test_environment()
@@ -0,0 +1,45 @@
+#--- IOT_Server - api app benchmark_downsample command ------------------------
+
+import math
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from api import downsample
+
+
+def synthetic_rows(size):
+    #(timestamp, id, value) rows of a noisy sine wave one second apart, generated on the fly
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    for i in range(size):
+        value = Decimal(round(math.sin(i / 5000) * 100 + (i * 7919 % 101) / 10, 3))
+        yield start + timedelta(seconds=i), i + 1, value
+
+
+class Command(BaseCommand):
+    help = ('Reports throughput of the points downsampling methods on generated series, '
+            'without the database read.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='100000,1000000',
+                            help='Comma separated series lengths, e.g. 10000000 for the 10M point case.')
+        parser.add_argument('--points', type=int, default=2000, help='Points returned per series.')
+
+    def handle(self, *args, **options):
+        sizes = sorted(int(size) for size in options['sizes'].split(','))
+        points = options['points']
+
+        self.stdout.write(f"{'rows':>10}  {'method':<8} {'points':>8} {'seconds':>9} {'rows/s':>12}")
+        for size in sizes:
+            #Time to generate the series alone, subtracted from each method
+            start = time.perf_counter()
+            for row in synthetic_rows(size):
+                pass
+            generate = time.perf_counter() - start
+
+            for method in downsample.METHODS:
+                start = time.perf_counter()
+                returned = sum(1 for row in downsample.downsample(synthetic_rows(size), size, points, method))
+                elapsed = max(time.perf_counter() - start - generate, 1e-9)
+                self.stdout.write(f'{size:>10}  {method:<8} {returned:>8} {elapsed:>9.3f} {size / elapsed:>12.0f}')
@@ -0,0 +1,53 @@
+#--- IOT_Server - api app benchmark_history command ---------------------------
+
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from api.models import IotData, WeatherData
+from api import benchmark
+
+
+class Command(BaseCommand):
+    help = ('Seeds a throw away database with growing tag and weather history and reports '
+            'latency of the "current" and range queries used by the data views at each size.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1000,10000,100000',
+                            help='Comma separated readings per tag / station to measure at (cumulative).')
+        parser.add_argument('--tags', type=int, default=10, help='Number of tags and stations seeded.')
+        parser.add_argument('--repeat', type=int, default=50, help='Calls per query and size.')
+
+    def handle(self, *args, **options):
+        sizes = sorted(int(size) for size in options['sizes'].split(','))
+        repeat = options['repeat']
+
+        with benchmark.benchmark_database():
+            user = benchmark.seed_owner()
+            tag_ids = benchmark.seed_tags(user, tags_per_device=options['tags'])
+            identifiers = benchmark.seed_stations(user, stations=options['tags'])
+            tag, ident = tag_ids[0], identifiers[0]
+
+            self.stdout.write(f"{'per tag':>10} {'total rows':>12}  {'query':<16} {'p50 ms':>8} {'p99 ms':>8}")
+            seeded = 0
+            tag_ts = wx_ts = None
+            for size in sizes:
+                tag_ts = benchmark.seed_tag_data(tag_ids, size - seeded, start=tag_ts)
+                wx_ts = benchmark.seed_weather_data(user, identifiers, size - seeded, start=wx_ts)
+                seeded = size
+
+                #Same filters and ordering as TagDataCurrent / TagDataList and WxDataCurrent / WxDataList
+                tag_data = IotData.objects.filter(tag__device__owner=user, tag=tag)
+                wx_data = WeatherData.objects.filter(station__owner=user, station__identifier=ident)
+                tag_mid = tag_ts - timedelta(seconds=size // 2)
+                wx_mid = wx_ts - timedelta(minutes=size // 2)
+                queries = (
+                    ('tag current', lambda: list(tag_data.order_by('-timestamp')[:1])),
+                    ('tag range', lambda: list(tag_data.filter(timestamp__gte=tag_mid).order_by('timestamp')[:100])),
+                    ('weather current', lambda: list(wx_data.order_by('-timestamp')[:1])),
+                    ('weather range', lambda: list(wx_data.filter(timestamp__gte=wx_mid).order_by('timestamp')[:100])),
+                )
+                total = IotData.objects.count()
+                for name, query in queries:
+                    samples = benchmark.time_calls(query, repeat)
+                    p50 = benchmark.percentile(samples, 50) * 1000
+                    p99 = benchmark.percentile(samples, 99) * 1000
+                    self.stdout.write(f'{size:>10} {total:>12}  {name:<16} {p50:>8.3f} {p99:>8.3f}')
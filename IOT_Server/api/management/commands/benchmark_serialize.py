@@ -0,0 +1,82 @@
+#--- IOT_Server - api app benchmark_serialize command --------------------------
+
+import time
+from django.core.management.base import BaseCommand
+from django.test.utils import setup_test_environment, teardown_test_environment
+from rest_framework.renderers import JSONRenderer
+from api import benchmark
+from api.models import IotData, WeatherStations, WeatherData
+from api.renderers import FastJSONRenderer, orjson
+from api.rows import WEATHER_VALUE_FIELDS, tag_value_field, tag_data_rows, weather_data_rows
+from api.serializers import TagDataSerializer, WxDataSerializer
+
+
+class Command(BaseCommand):
+    help = ('Seeds a throw away database and reports rows per second of a data/list/ and weatherdata/list/ '
+            'page read, serialized and rendered with model instances and ModelSerializer (before) and with '
+            'value rows and the fast JSON renderer (after).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10000, help='Rows per page (max=).')
+        parser.add_argument('--repeat', type=int, default=10, help='Timed pages per path.')
+
+    def get_paths(self, tag_id, tag_type, station):
+        #(name, read(), serialize(records), renderer) of every measured path
+        tag_page = IotData.objects.filter(tag=tag_id).order_by('timestamp', 'pk')[:self.rows]
+        station_page = WeatherData.objects.filter(station=station).order_by('timestamp', 'pk')[:self.rows]
+        field = tag_value_field(tag_type)
+        return (
+            ('tag serializer', lambda: list(tag_page.select_related('tag__value_type')),
+             lambda records: TagDataSerializer(records, many=True).data, JSONRenderer()),
+            ('tag rows', lambda: list(tag_page.values_list('timestamp', 'pk', field)),
+             lambda rows: tag_data_rows(rows, tag_id, tag_type), JSONRenderer()),
+            ('tag rows fast', lambda: list(tag_page.values_list('timestamp', 'pk', field)),
+             lambda rows: tag_data_rows(rows, tag_id, tag_type), FastJSONRenderer()),
+            ('weather serializer', lambda: list(station_page.select_related('station')),
+             lambda records: WxDataSerializer(records, many=True).data, JSONRenderer()),
+            ('weather rows', lambda: list(station_page.values_list('timestamp', 'pk', *WEATHER_VALUE_FIELDS)),
+             lambda rows: weather_data_rows(rows, station.identifier), JSONRenderer()),
+            ('weather rows fast', lambda: list(station_page.values_list('timestamp', 'pk', *WEATHER_VALUE_FIELDS)),
+             lambda rows: weather_data_rows(rows, station.identifier), FastJSONRenderer()),
+        )
+
+    def measure(self, read, serialize, renderer):
+        #Seconds spent reading, serializing and rendering one page, median of repeat pages
+        timings = {'read': [], 'serialize': [], 'render': []}
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            records = read()
+            read_done = time.perf_counter()
+            data = serialize(records)
+            serialize_done = time.perf_counter()
+            renderer.render(data)
+            timings['read'].append(read_done - start)
+            timings['serialize'].append(serialize_done - read_done)
+            timings['render'].append(time.perf_counter() - serialize_done)
+        return {phase: benchmark.percentile(samples, 50) for phase, samples in timings.items()}
+
+    def handle(self, *args, **options):
+        self.rows = options['rows']
+        self.repeat = options['repeat']
+        setup_test_environment()
+        try:
+            with benchmark.benchmark_database():
+                user = benchmark.seed_owner()
+                tag_id = benchmark.seed_tags(user, tags_per_device=1)[0]
+                identifier = benchmark.seed_stations(user)[0]
+                benchmark.seed_tag_data([tag_id], self.rows)
+                benchmark.seed_weather_data(user, [identifier], self.rows)
+                station = WeatherStations.objects.get(owner=user, identifier=identifier)
+
+                if orjson is None:
+                    self.stdout.write('orjson is not installed, the fast renderer uses the stdlib encoder.')
+                self.stdout.write(f"{'path':<19} {'read rows/s':>12} {'serialize rows/s':>17} "
+                                  f"{'render rows/s':>14} {'total rows/s':>13}")
+                for name, read, serialize, renderer in self.get_paths(tag_id, 'dec', station):
+                    seconds = self.measure(read, serialize, renderer)
+                    rates = [self.rows / seconds[phase] if seconds[phase] else 0
+                             for phase in ('read', 'serialize', 'render')]
+                    total = self.rows / sum(seconds.values()) if sum(seconds.values()) else 0
+                    self.stdout.write(f'{name:<19} {rates[0]:>12,.0f} {rates[1]:>17,.0f} {rates[2]:>14,.0f} {total:>13,.0f}')
+        finally:
+            teardown_test_environment()
@@ -0,0 +1,51 @@
+#--- IOT_Server - api app dedupe_history command -------------------------------
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from api.models import Tags, WeatherStations, IotData, WeatherData
+from api import dedupe
+
+
+class Command(BaseCommand):
+    help = ('Deletes duplicate tag and weather readings (same tag / station and timestamp) in chunks, '
+            'keeping the first saved. --add-constraint then adds unique indexes so that with '
+            'IOT_INGEST_IGNORE_DUPLICATES retried readings are skipped by the database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--add-constraint', action='store_true',
+                            help='Add the unique (tag, timestamp) and (station, timestamp) indexes after deduplicating.')
+        parser.add_argument('--drop-constraint', action='store_true',
+                            help='Drop the unique indexes, nothing is deduplicated.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Count duplicates without deleting them.')
+
+    def execute_sql(self, statement):
+        self.stdout.write(statement)
+        with connection.cursor() as cursor:
+            cursor.execute(statement)
+
+    def handle(self, *args, **options):
+        if options['add_constraint'] and options['drop_constraint']:
+            raise CommandError('Give only one of --add-constraint and --drop-constraint.')
+
+        for model, owner_model in ((IotData, Tags), (WeatherData, WeatherStations)):
+            table = model._meta.db_table
+            if options['drop_constraint']:
+                if dedupe.has_unique_index(model):
+                    self.execute_sql(dedupe.drop_unique_index_sql(model))
+                continue
+
+            total = 0
+            for owner_pk in owner_model.objects.values_list('pk', flat=True).iterator():
+                removed = dedupe.remove_duplicates(model, owner_pk, dry_run=options['dry_run'])
+                if removed and options['verbosity'] > 1:
+                    self.stdout.write(f'{table} {owner_pk}: {removed} duplicates.')
+                total += removed
+            action = 'found' if options['dry_run'] else 'deleted'
+            self.stdout.write(f'{table}: {total} duplicate records {action}.')
+
+            if options['add_constraint'] and not options['dry_run']:
+                if dedupe.has_unique_index(model):
+                    self.stdout.write(f'{table} already has its unique index.')
+                else:
+                    self.execute_sql(dedupe.unique_index_sql(model))
@@ -0,0 +1,142 @@
+#--- IOT_Server - api app device_listener command ------------------------------
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from api.device_protocol import LineIngest
+
+#Longest accepted protocol line in bytes, longer lines close the TCP connection
+MAX_LINE = 1024
+
+
+class TcpLineProtocol(asyncio.Protocol):
+    #One reply line ('OK' or 'ERR <message>') is written per reading line received, once it is saved
+    def __init__(self, listener):
+        self.listener = listener
+        self.buffer = b''
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buffer += data
+        *lines, self.buffer = self.buffer.split(b'\n')
+        if len(self.buffer) > MAX_LINE:
+            self.transport.write(b'ERR Line too long.\n')
+            self.transport.close()
+            return
+        if lines:
+            self.listener.handle(lines, self.reply)
+
+    def reply(self, replies):
+        if not self.transport.is_closing():
+            self.transport.write(''.join(f'{reply}\n' for reply in replies).encode())
+
+
+class UdpLineProtocol(asyncio.DatagramProtocol):
+    #Every datagram holds one or more reading lines, nothing is sent back
+    def __init__(self, listener):
+        self.listener = listener
+
+    def datagram_received(self, data, addr):
+        self.listener.handle(data.split(b'\n'), None)
+
+
+class Listener:
+    """
+    Runs all validation and database work on a single thread so the event loop only
+    does network I/O and the readings buffer needs no locking.
+    """
+
+    def __init__(self, command, flush_size, flush_interval):
+        self.command = command
+        self.ingest = LineIngest(flush_size, self.report_error)
+        self.flush_interval = flush_interval
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.loop = asyncio.get_event_loop()
+
+    def report_error(self, e):
+        self.command.stderr.write(f'Unexpected error: {e!r}')
+
+    def process(self, lines, reply):
+        decoded = []
+        for line in lines:
+            line = line.strip()
+            if line:
+                decoded.append(line.decode('utf-8', errors='replace'))
+
+        def done(replies):
+            #Called on the database thread, replies are written on the event loop
+            if reply is not None:
+                self.loop.call_soon_threadsafe(reply, replies)
+
+        self.ingest.handle_lines(decoded, done)
+        if self.ingest.is_full():
+            self.flush()
+
+    def flush(self):
+        saved, failed = self.ingest.flush()
+        suppressed, self.ingest.suppressed = self.ingest.suppressed, 0
+        for record, error in failed:
+            self.command.stderr.write(f'Reading for tag {record.tag_id} not saved: {error}')
+        if (saved or suppressed) and self.command.verbosity > 1:
+            self.command.stdout.write(f'{saved} readings saved, {suppressed} suppressed by deadband.')
+
+    def handle(self, lines, reply):
+        #reply is called with the replies to lines once their readings are flushed
+        self.loop.run_in_executor(self.executor, self.process, lines, reply)
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.loop.run_in_executor(self.executor, self.flush)
+
+
+class Command(BaseCommand):
+    help = ('Listens for device readings in the compact line protocol "<token> <tag> <value> [<timestamp>]" '
+            'over TCP and / or UDP and saves them with batched inserts.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='0.0.0.0', help='Address to listen on.')
+        parser.add_argument('--tcp-port', type=int, default=getattr(settings, 'IOT_DEVICE_TCP_PORT', 7878),
+                            help='TCP port, 0 to disable.')
+        parser.add_argument('--udp-port', type=int, default=getattr(settings, 'IOT_DEVICE_UDP_PORT', 0),
+                            help='UDP port, 0 to disable.')
+        parser.add_argument('--flush-size', type=int,
+                            default=getattr(settings, 'IOT_INGEST_FLUSH_SIZE', 1000),
+                            help='Readings buffered before a bulk insert.')
+        parser.add_argument('--interval', type=float,
+                            default=getattr(settings, 'IOT_INGEST_FLUSH_INTERVAL', 1.0),
+                            help='Seconds between inserts of buffered readings.')
+
+    def handle(self, *args, **options):
+        if not options['tcp_port'] and not options['udp_port']:
+            raise CommandError('Give a --tcp-port and / or a --udp-port.')
+        self.verbosity = options['verbosity']
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        listener = Listener(self, options['flush_size'], options['interval'])
+
+        if options['tcp_port']:
+            loop.run_until_complete(loop.create_server(lambda: TcpLineProtocol(listener),
+                                                       options['host'], options['tcp_port']))
+            self.stdout.write(f"Listening for TCP readings on {options['host']}:{options['tcp_port']}")
+        if options['udp_port']:
+            loop.run_until_complete(loop.create_datagram_endpoint(lambda: UdpLineProtocol(listener),
+                                                                  local_addr=(options['host'], options['udp_port'])))
+            self.stdout.write(f"Listening for UDP readings on {options['host']}:{options['udp_port']}")
+
+        flusher = asyncio.ensure_future(listener.flush_periodically())
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            #Save what is still buffered before exiting
+            flusher.cancel()
+            loop.run_until_complete(asyncio.gather(flusher, return_exceptions=True))
+            listener.executor.submit(listener.flush).result()
+            listener.executor.shutdown()
+            loop.close()
@@ -0,0 +1,45 @@
+#--- IOT_Server - api app drain_ingest command --------------------------------
+
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from api import ingest_queue
+
+
+class Command(BaseCommand):
+    help = ('Saves readings queued by the ingest endpoints when IOT_INGEST_MODE is "queue". '
+            'Readings left in the spool by a crash are replayed on start.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--flush-size', type=int,
+                            default=getattr(settings, 'IOT_INGEST_FLUSH_SIZE', 1000),
+                            help='Maximum readings saved per bulk insert.')
+        parser.add_argument('--interval', type=float,
+                            default=getattr(settings, 'IOT_INGEST_FLUSH_INTERVAL', 1.0),
+                            help='Seconds to wait when the queue is empty.')
+        parser.add_argument('--once', action='store_true',
+                            help='Drain the queue and exit instead of running continuously.')
+        parser.add_argument('--stats', action='store_true',
+                            help='Print the queue depth, oldest reading age and failed count and exit.')
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            for name, value in ingest_queue.stats().items():
+                self.stdout.write(f'{name}: {value}')
+            return
+
+        pending = ingest_queue.depth()
+        if pending:
+            self.stdout.write(f'{pending} queued readings found, replaying.')
+
+        total = 0
+        while True:
+            drained = ingest_queue.drain(options['flush_size'])
+            total += drained
+            if drained and options['verbosity'] > 1:
+                self.stdout.write(f'{drained} readings saved, {ingest_queue.depth()} queued.')
+            if drained < options['flush_size']:
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
+        self.stdout.write(f'{total} readings saved.')
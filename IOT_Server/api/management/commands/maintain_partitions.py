@@ -0,0 +1,54 @@
+#--- IOT_Server - api app maintain_partitions command --------------------------
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from api.models import IotData, WeatherData
+from api import partitions
+
+
+class Command(BaseCommand):
+    help = ('Applies the retention of IotData and WeatherData. On MySQL creates the monthly partitions '
+            'ahead and drops (or archives) expired ones, run --setup once (IOT_PARTITIONS = True) to partition '
+            'the tables. Other databases delete expired records in chunks.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--setup', action='store_true',
+                            help='Convert the tables to monthly partitions (MySQL only, rewrites the tables).')
+        parser.add_argument('--archive', action='store_true',
+                            help='Exchange expired partitions into <table>_archive_YYYYMM tables before dropping.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Print the statements and expired partitions without changing anything.')
+
+    def execute_sql(self, statements, dry_run):
+        for statement in statements:
+            self.stdout.write(statement)
+            if not dry_run:
+                with connection.cursor() as cursor:
+                    cursor.execute(statement)
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        supported = partitions.is_supported()
+        if options['setup'] and not partitions.is_enabled():
+            raise CommandError('Partitioning is disabled, set IOT_PARTITIONS = True to run --setup.')
+        if options['setup'] and not supported:
+            raise CommandError(f'Partitioning is only supported on MySQL, not {connection.vendor}.')
+
+        for model in (IotData, WeatherData):
+            table = model._meta.db_table
+            if options['setup']:
+                if partitions.get_partitions(model):
+                    self.stdout.write(f'{table} is already partitioned.')
+                else:
+                    self.execute_sql(partitions.setup_sql(model), dry_run)
+
+            partitioned = supported and bool(partitions.get_partitions(model))
+            if partitioned:
+                self.execute_sql(partitions.future_partitions_sql(model), dry_run)
+                for name in partitions.expired_partitions(model):
+                    self.execute_sql(partitions.drop_partition_sql(model, name, options['archive']), dry_run)
+
+            if dry_run:
+                continue
+            deleted = partitions.purge(model, partitioned=partitioned)
+            self.stdout.write(f'{table}: {deleted} expired records deleted.')
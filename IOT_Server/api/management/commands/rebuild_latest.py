@@ -0,0 +1,34 @@
+#--- IOT_Server - api app rebuild_latest command ------------------------------
+
+from django.core.management.base import BaseCommand, CommandError
+from api.models import Tags, IotData, WeatherStations, WeatherData
+from api import latest
+
+
+class Command(BaseCommand):
+    help = ('Rebuilds the latest value store from the database. '
+            'Run after readings were changed or deleted outside of the API.')
+
+    def handle(self, *args, **options):
+        if latest.is_process_local():
+            raise CommandError('IOT_LATEST_CACHE is a local memory cache, a rebuild from this command does not reach '
+                               'the server processes. Restart them instead, their stores refill from the database.')
+        tags = Tags.objects.select_related('value_type', 'device')
+        tag_count = 0
+        for tag in tags.iterator():
+            latest.invalidate_tags([tag.tag_id])
+            record = IotData.objects.filter(tag=tag).order_by('-timestamp').first()
+            if record:
+                latest.store_tag_data([record], {tag.tag_id: tag.value_type.type}, tag.device.owner_id)
+                tag_count += 1
+
+        station_count = 0
+        for station in WeatherStations.objects.iterator():
+            latest.invalidate_stations([(station.owner_id, station.identifier)])
+            record = WeatherData.objects.filter(station=station).order_by('-timestamp').first()
+            if record:
+                record.station = station
+                latest.store_weather_data([record])
+                station_count += 1
+
+        self.stdout.write(f'Latest values stored for {tag_count} tags and {station_count} weather stations.')
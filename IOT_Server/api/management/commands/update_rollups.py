@@ -0,0 +1,44 @@
+#--- IOT_Server - api app update_rollups command ------------------------------
+
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import dateparse
+from api import rollups
+
+
+class Command(BaseCommand):
+    help = ('Updates the 1m / 1h / 1d rollup tables of tag and weather data from the records '
+            'created since the last run. Use --backfill to build them from existing history.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backfill', action='store_true',
+                            help='Recompute all rollups (or those between --begin and --end) from raw records.')
+        parser.add_argument('--begin', help='Backfill records from this timezone aware datetime.')
+        parser.add_argument('--end', help='Backfill records before this timezone aware datetime.')
+        parser.add_argument('--loop', type=int, default=0, metavar='SECONDS',
+                            help='Keep running, updating every SECONDS seconds.')
+
+    def parse_date(self, value):
+        if value is None:
+            return None
+        parsed = dateparse.parse_datetime(value)
+        if parsed is None:
+            raise CommandError(f'Invalid datetime: {value}')
+        return parsed
+
+    def handle(self, *args, **options):
+        if options['backfill']:
+            begin, end = self.parse_date(options['begin']), self.parse_date(options['end'])
+            for name in (rollups.TAG_DATA, rollups.WEATHER_DATA):
+                written = rollups.backfill(name, begin, end)
+                self.stdout.write(f'{name}: {written} rollup rows written by backfill.')
+
+        while True:
+            for name in (rollups.TAG_DATA, rollups.WEATHER_DATA):
+                written = rollups.update(name)
+                if written is None:
+                    raise CommandError(f'{name} rollups have not been built yet, run with --backfill first.')
+                self.stdout.write(f'{name}: {written} rollup rows updated.')
+            if not options['loop']:
+                break
+            time.sleep(options['loop'])
@@ -0,0 +1,185 @@
+#--- IOT_Server - api app request metrics --------------------------------------
+#Per endpoint request metrics of this process, recorded by MetricsMiddleware and served on metrics/
+
+import threading
+import time
+from collections import defaultdict
+from functools import wraps
+from django.conf import settings
+
+#Upper bounds in seconds of the request latency histogram
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PHASES = ('auth', 'serializer', 'render')
+
+_local = threading.local()
+_lock = threading.Lock()
+_instrumented = False
+
+
+def is_enabled():
+    return getattr(settings, 'IOT_METRICS_ENABLED', False)
+
+
+class EndpointMetrics:
+    def __init__(self):
+        self.requests = defaultdict(int)
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.seconds = 0.0
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.phase_seconds = defaultdict(float)
+
+
+_endpoints = defaultdict(EndpointMetrics)
+
+
+class RequestRecorder:
+    #Totals of the request being handled by this thread
+    def __init__(self):
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.phase_seconds = defaultdict(float)
+        self.depth = defaultdict(int)
+
+    def execute_wrapper(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.query_seconds += time.perf_counter() - start
+            self.queries += 1
+
+
+def start_request():
+    _local.recorder = RequestRecorder()
+    return _local.recorder
+
+
+def end_request():
+    _local.recorder = None
+
+
+def timed(phase, fn):
+    #Wraps fn so its time is added to phase of the current request, nested calls count once
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        recorder = getattr(_local, 'recorder', None)
+        if recorder is None:
+            return fn(*args, **kwargs)
+        recorder.depth[phase] += 1
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            recorder.depth[phase] -= 1
+            if not recorder.depth[phase]:
+                recorder.phase_seconds[phase] += time.perf_counter() - start
+    return wrapper
+
+
+def instrument():
+    """
+    Times DRF authentication, serializer validation / output and rendering for every view.
+    Called once by the middleware when metrics are enabled, so nothing is wrapped otherwise.
+    """
+    global _instrumented
+    with _lock:
+        if _instrumented:
+            return
+        from rest_framework.request import Request
+        from rest_framework.response import Response
+        from rest_framework.serializers import BaseSerializer
+        Request._authenticate = timed('auth', Request._authenticate)
+        BaseSerializer.is_valid = timed('serializer', BaseSerializer.is_valid)
+        BaseSerializer.data = property(timed('serializer', BaseSerializer.data.fget))
+        Response.rendered_content = property(timed('render', Response.rendered_content.fget))
+        _instrumented = True
+
+
+def record(endpoint, method, status, seconds, recorder):
+    #Adds a finished request to the endpoint totals
+    with _lock:
+        metrics = _endpoints[endpoint]
+        metrics.requests[(method, status)] += 1
+        metrics.count += 1
+        metrics.seconds += seconds
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                metrics.buckets[i] += 1
+                break
+        metrics.queries += recorder.queries
+        metrics.query_seconds += recorder.query_seconds
+        for phase, phase_seconds in recorder.phase_seconds.items():
+            metrics.phase_seconds[phase] += phase_seconds
+
+
+def reset():
+    with _lock:
+        _endpoints.clear()
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _gauges():
+    #Process level values of the ingest path
+    from api import deadband, ingest_queue
+    gauges = [('iot_deadband_suppressed_total', 'counter', 'Readings left out by tag deadbands.',
+               deadband.stats()['suppressed'])]
+    if ingest_queue.is_enabled():
+        stats = ingest_queue.stats()
+        gauges += [
+            ('iot_ingest_queue_depth', 'gauge', 'Readings waiting in the ingest spool.', stats['depth']),
+            ('iot_ingest_queue_oldest_seconds', 'gauge', 'Age of the oldest queued reading.', stats['oldest_age']),
+            ('iot_ingest_queue_failed', 'gauge', 'Readings moved to the failed table.', stats['failed']),
+        ]
+    return gauges
+
+
+def render():
+    #Prometheus text exposition format of all metrics
+    with _lock:
+        endpoints = sorted(_endpoints.items())
+        lines = [
+            '# HELP iot_http_requests_total Requests by endpoint, method and status.',
+            '# TYPE iot_http_requests_total counter',
+        ]
+        for endpoint, metrics in endpoints:
+            for (method, status), count in sorted(metrics.requests.items()):
+                lines.append(f'iot_http_requests_total{{endpoint="{_label(endpoint)}",method="{method}",'
+                             f'status="{status}"}} {count}')
+
+        lines += [
+            '# HELP iot_http_request_duration_seconds Request latency by endpoint.',
+            '# TYPE iot_http_request_duration_seconds histogram',
+        ]
+        for endpoint, metrics in endpoints:
+            label = f'endpoint="{_label(endpoint)}"'
+            cumulative = 0
+            for bound, count in zip(BUCKETS, metrics.buckets):
+                cumulative += count
+                lines.append(f'iot_http_request_duration_seconds_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f'iot_http_request_duration_seconds_bucket{{{label},le="+Inf"}} {metrics.count}')
+            lines.append(f'iot_http_request_duration_seconds_sum{{{label}}} {metrics.seconds:.6f}')
+            lines.append(f'iot_http_request_duration_seconds_count{{{label}}} {metrics.count}')
+
+        for name, help_text, value in (
+                ('iot_db_queries_total', 'Database queries by endpoint.', lambda m: m.queries),
+                ('iot_db_query_seconds_total', 'Database query time by endpoint.', lambda m: f'{m.query_seconds:.6f}')):
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+            lines += [f'{name}{{endpoint="{_label(endpoint)}"}} {value(metrics)}' for endpoint, metrics in endpoints]
+
+        lines += [
+            '# HELP iot_phase_seconds_total Time spent authenticating, in serializers and rendering by endpoint.',
+            '# TYPE iot_phase_seconds_total counter',
+        ]
+        for endpoint, metrics in endpoints:
+            for phase in PHASES:
+                lines.append(f'iot_phase_seconds_total{{endpoint="{_label(endpoint)}",phase="{phase}"}} '
+                             f'{metrics.phase_seconds[phase]:.6f}')
+
+    for name, metric_type, help_text, value in _gauges():
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {metric_type}', f'{name} {value}']
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,38 @@
+#--- IOT_Server - api app middleware -------------------------------------------
+
+import time
+from contextlib import ExitStack
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from api import metrics
+
+
+class MetricsMiddleware:
+    """
+    Records per endpoint request metrics for the metrics/ endpoint, see api.metrics.
+    Add 'api.middleware.MetricsMiddleware' to MIDDLEWARE and set IOT_METRICS_ENABLED = True.
+    When metrics are disabled Django drops the middleware at startup, so it costs nothing.
+    """
+
+    def __init__(self, get_response):
+        if not metrics.is_enabled():
+            raise MiddlewareNotUsed()
+        metrics.instrument()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = metrics.start_request()
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(recorder.execute_wrapper))
+                response = self.get_response(request)
+            seconds = time.perf_counter() - start
+        finally:
+            metrics.end_request()
+        #Label by URL pattern, so e.g. every tag of data/list/<tag>/ is counted together
+        match = getattr(request, 'resolver_match', None)
+        endpoint = match.route if match is not None else 'unmatched'
+        metrics.record(endpoint, request.method, response.status_code, seconds, recorder)
+        return response
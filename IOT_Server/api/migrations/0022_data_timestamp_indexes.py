@@ -0,0 +1,44 @@
+# Generated by Django 2.2.13 on 2026-10-18 10:52
+
+from django.db import migrations, models
+
+
+class AddIndexOnline(migrations.AddIndex):
+    """
+    AddIndex that does not block writes to the table while the index is built.
+    MySQL (InnoDB) builds the index in place with LOCK=NONE and PostgreSQL uses
+    CREATE INDEX CONCURRENTLY, other backends fall back to a plain CREATE INDEX.
+    """
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+        vendor = schema_editor.connection.vendor
+        sql = str(self.index.create_sql(model, schema_editor))
+        if vendor == 'mysql':
+            schema_editor.execute(sql + ' ALGORITHM=INPLACE LOCK=NONE')
+        elif vendor == 'postgresql':
+            schema_editor.execute(sql.replace('CREATE INDEX', 'CREATE INDEX CONCURRENTLY', 1))
+        else:
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+
+class Migration(migrations.Migration):
+
+    #CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('api', '0021_auto_20200704_1154'),
+    ]
+
+    operations = [
+        AddIndexOnline(
+            model_name='iotdata',
+            index=models.Index(fields=['tag', 'timestamp'], name='api_iotdata_tag_ts_idx'),
+        ),
+        AddIndexOnline(
+            model_name='weatherdata',
+            index=models.Index(fields=['station', 'timestamp'], name='api_wxdata_station_ts_idx'),
+        ),
+    ]
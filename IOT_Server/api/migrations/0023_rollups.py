@@ -0,0 +1,81 @@
+# Generated by Django 2.2.13 on 2026-10-18 10:58
+
+from django.db import migrations, models
+import django.db.models.deletion
+from api.operations import AddIndexOnline
+
+
+class Migration(migrations.Migration):
+
+    #CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('api', '0022_data_timestamp_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IotDataRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('interval', models.CharField(choices=[('1m', '1 minute'), ('1h', '1 hour'), ('1d', '1 day')], max_length=2)),
+                ('bucket', models.DateTimeField()),
+                ('count', models.IntegerField()),
+                ('value_min', models.DecimalField(blank=True, decimal_places=3, max_digits=20, null=True)),
+                ('value_max', models.DecimalField(blank=True, decimal_places=3, max_digits=20, null=True)),
+                ('value_sum', models.DecimalField(blank=True, decimal_places=3, max_digits=20, null=True)),
+                ('value_last', models.DecimalField(blank=True, decimal_places=3, max_digits=20, null=True)),
+                ('updated_on', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RollupState',
+            fields=[
+                ('name', models.CharField(max_length=20, primary_key=True, serialize=False)),
+                ('high_water', models.DateTimeField(blank=True, null=True)),
+                ('updated_on', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='WeatherDataRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('interval', models.CharField(choices=[('1m', '1 minute'), ('1h', '1 hour'), ('1d', '1 day')], max_length=2)),
+                ('field', models.CharField(choices=[('temperature', 'Temperature'), ('dewpoint', 'Dewpoint'), ('wind_speed', 'Wind speed'), ('wind_gust', 'Wind gust'), ('wind_dir', 'Wind direction'), ('pressure', 'Pressure')], max_length=12)),
+                ('bucket', models.DateTimeField()),
+                ('count', models.IntegerField()),
+                ('value_min', models.DecimalField(blank=True, decimal_places=3, max_digits=20, null=True)),
+                ('value_max', models.DecimalField(blank=True, decimal_places=3, max_digits=20, null=True)),
+                ('value_sum', models.DecimalField(blank=True, decimal_places=3, max_digits=20, null=True)),
+                ('value_last', models.DecimalField(blank=True, decimal_places=3, max_digits=20, null=True)),
+                ('updated_on', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        AddIndexOnline(
+            model_name='iotdata',
+            index=models.Index(fields=['created_on'], name='api_iotdata_created_idx'),
+        ),
+        AddIndexOnline(
+            model_name='weatherdata',
+            index=models.Index(fields=['created_on'], name='api_wxdata_created_idx'),
+        ),
+        migrations.AddField(
+            model_name='weatherdatarollup',
+            name='station',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='api.WeatherStations'),
+        ),
+        migrations.AddField(
+            model_name='iotdatarollup',
+            name='tag',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='api.Tags'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='weatherdatarollup',
+            unique_together={('station', 'interval', 'field', 'bucket')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='iotdatarollup',
+            unique_together={('tag', 'interval', 'bucket')},
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.13 on 2026-10-18 11:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0023_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='devices',
+            name='retention_days',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='weatherstations',
+            name='retention_days',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
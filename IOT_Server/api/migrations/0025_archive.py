@@ -0,0 +1,30 @@
+# Generated by Django 2.2.13 on 2026-10-18 11:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0024_retention_days'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IotDataArchive',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('count', models.IntegerField()),
+                ('first_timestamp', models.DateTimeField()),
+                ('last_timestamp', models.DateTimeField()),
+                ('data', models.BinaryField()),
+                ('updated_on', models.DateTimeField(auto_now=True)),
+                ('tag', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='api.Tags')),
+            ],
+            options={
+                'unique_together': {('tag', 'day')},
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.2.13 on 2026-10-18 11:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0025_archive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tags',
+            name='deadband',
+            field=models.DecimalField(blank=True, decimal_places=3, max_digits=12, null=True),
+        ),
+        migrations.AddField(
+            model_name='tags',
+            name='deadband_type',
+            field=models.CharField(blank=True, choices=[('', 'None'), ('abs', 'Absolute (int, dec)'), ('pct', 'Percentage of last value (int, dec)'), ('change', 'Change only')], default='', max_length=6),
+        ),
+        migrations.AddField(
+            model_name='tags',
+            name='heartbeat',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
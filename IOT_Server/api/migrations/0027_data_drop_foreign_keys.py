@@ -0,0 +1,30 @@
+# Generated by Django 2.2.13 on 2026-10-18 14:02
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    """
+    Drops the database foreign keys of the data tables, MySQL cannot partition a table
+    that has (or is referenced by) a foreign key. The relations stay ForeignKeys in Django,
+    on_delete (PROTECT for tags, CASCADE for stations) is still applied by the ORM but rows
+    written outside of Django are no longer checked by the database.
+    """
+
+    dependencies = [
+        ('api', '0026_tag_deadband'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='iotdata',
+            name='tag',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.PROTECT, to='api.Tags'),
+        ),
+        migrations.AlterField(
+            model_name='weatherdata',
+            name='station',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to='api.WeatherStations'),
+        ),
+    ]
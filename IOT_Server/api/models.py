@@ -14,6 +14,8 @@ class Devices(models.Model):
     description = models.CharField(max_length=255, blank=True)
     type = models.CharField(max_length=50, blank=True)
     owner = models.ForeignKey(get_user_model(), on_delete=models.CASCADE)
+    #Days of IotData kept for the device's tags, blank keeps IOT_DEFAULT_RETENTION_DAYS (forever if unset)
+    retention_days = models.PositiveIntegerField(blank=True, null = True)
     created_on = models.DateTimeField(auto_now_add=True)
     updated_on = models.DateTimeField(auto_now=True)
     def __str__(self):
@@ -45,11 +47,23 @@ class ValueTypes(models.Model):
 
 
 class Tags(models.Model):
+    DEADBAND_CHOICES = (
+        ('', 'None'),
+        ('abs', 'Absolute (int, dec)'),
+        ('pct', 'Percentage of last value (int, dec)'),
+        ('change', 'Change only'),
+        )
+
     tag_id = models.CharField(max_length=25, primary_key=True, validators=[MinLengthValidator(3)])
     device = models.ForeignKey(Devices, related_name='device_tags', on_delete=models.PROTECT)
     value_type = models.ForeignKey(ValueTypes, on_delete=models.PROTECT)
     name = models.CharField(max_length=50)
     description = models.CharField(max_length=255, blank=True)
+    #Ingest filter, readings within the deadband of the last stored reading are not stored
+    deadband_type = models.CharField(max_length=6, choices=DEADBAND_CHOICES, blank=True, default='')
+    deadband = models.DecimalField(max_digits=12, decimal_places=3, blank=True, null = True)
+    #A reading is always stored when the last stored reading is this many seconds old
+    heartbeat = models.PositiveIntegerField(blank=True, null = True)
     created_on = models.DateTimeField(auto_now_add=True)
     updated_on = models.DateTimeField(auto_now=True)
 
@@ -60,6 +74,10 @@ class Tags(models.Model):
     def owner(self):
         return self.device.owner
 
+    @property
+    def owner_id(self):
+        return self.device.owner_id
+
     #for Tags page in Admin module
     def device_concat(self):
         return self.device.device_id + ' / ' + self.device.name
@@ -72,7 +90,8 @@ class Tags(models.Model):
 
 
 class IotData(models.Model):
-    tag = models.ForeignKey(Tags, on_delete=models.PROTECT)
+    #No database foreign key, MySQL cannot partition a table that has one (migration 0027)
+    tag = models.ForeignKey(Tags, on_delete=models.PROTECT, db_constraint=False)
     timestamp = models.DateTimeField(default=timezone.now)
     value_int = models.IntegerField(blank=True, null = True)
     value_dec = models.DecimalField(max_digits=8, decimal_places=3, blank=True, null = True)
@@ -98,6 +117,16 @@ class IotData(models.Model):
     def owner(self):
         return self.tag.device.owner
 
+    @property
+    def owner_id(self):
+        return self.tag.device.owner_id
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['tag', 'timestamp'], name='api_iotdata_tag_ts_idx'),
+            models.Index(fields=['created_on'], name='api_iotdata_created_idx'),
+        ]
+
 
 class WeatherStations(models.Model):
     identifier = models.CharField(max_length=30)
@@ -107,6 +136,8 @@ class WeatherStations(models.Model):
     longitude = models.DecimalField(max_digits=10, decimal_places=7, blank=True, null = True)
     type = models.CharField(max_length=50, blank=True)
     owner = models.ForeignKey(get_user_model(), on_delete=models.CASCADE)
+    #Days of WeatherData kept for the station, blank keeps IOT_DEFAULT_RETENTION_DAYS (forever if unset)
+    retention_days = models.PositiveIntegerField(blank=True, null = True)
     created_on = models.DateTimeField(auto_now_add=True)
     updated_on = models.DateTimeField(auto_now=True)
 
@@ -119,7 +150,8 @@ class WeatherStations(models.Model):
 
 
 class WeatherData(models.Model):
-    station = models.ForeignKey(WeatherStations, on_delete=models.CASCADE)
+    #No database foreign key, MySQL cannot partition a table that has one (migration 0027)
+    station = models.ForeignKey(WeatherStations, on_delete=models.CASCADE, db_constraint=False)
     timestamp = models.DateTimeField(default=timezone.now)
     temperature = models.DecimalField(max_digits=5, decimal_places=2, blank=True, null = True)
     dewpoint = models.DecimalField(max_digits=5, decimal_places=2, blank=True, null = True)
@@ -137,6 +169,87 @@ class WeatherData(models.Model):
     def owner(self):
         return self.station.owner
 
+    @property
+    def owner_id(self):
+        return self.station.owner_id
+
     @property
     def identifier(self):
         return self.station.identifier
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['station', 'timestamp'], name='api_wxdata_station_ts_idx'),
+            models.Index(fields=['created_on'], name='api_wxdata_created_idx'),
+        ]
+
+
+#--- Rollups - pre-computed aggregates maintained by the update_rollups command ---
+
+ROLLUP_INTERVAL_CHOICES = (
+    ('1m', '1 minute'),
+    ('1h', '1 hour'),
+    ('1d', '1 day'),
+    )
+
+
+class IotDataRollup(models.Model):
+    tag = models.ForeignKey(Tags, on_delete=models.CASCADE)
+    interval = models.CharField(max_length=2, choices=ROLLUP_INTERVAL_CHOICES)
+    bucket = models.DateTimeField()
+    count = models.IntegerField()
+    value_min = models.DecimalField(max_digits=20, decimal_places=3, blank=True, null = True)
+    value_max = models.DecimalField(max_digits=20, decimal_places=3, blank=True, null = True)
+    value_sum = models.DecimalField(max_digits=20, decimal_places=3, blank=True, null = True)
+    value_last = models.DecimalField(max_digits=20, decimal_places=3, blank=True, null = True)
+    updated_on = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = (('tag', 'interval', 'bucket'),)
+
+
+class WeatherDataRollup(models.Model):
+    FIELD_CHOICES = (
+        ('temperature', 'Temperature'),
+        ('dewpoint', 'Dewpoint'),
+        ('wind_speed', 'Wind speed'),
+        ('wind_gust', 'Wind gust'),
+        ('wind_dir', 'Wind direction'),
+        ('pressure', 'Pressure'),
+        )
+    station = models.ForeignKey(WeatherStations, on_delete=models.CASCADE)
+    interval = models.CharField(max_length=2, choices=ROLLUP_INTERVAL_CHOICES)
+    field = models.CharField(max_length=12, choices=FIELD_CHOICES)
+    bucket = models.DateTimeField()
+    count = models.IntegerField()
+    value_min = models.DecimalField(max_digits=20, decimal_places=3, blank=True, null = True)
+    value_max = models.DecimalField(max_digits=20, decimal_places=3, blank=True, null = True)
+    value_sum = models.DecimalField(max_digits=20, decimal_places=3, blank=True, null = True)
+    value_last = models.DecimalField(max_digits=20, decimal_places=3, blank=True, null = True)
+    updated_on = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = (('station', 'interval', 'field', 'bucket'),)
+
+
+class RollupState(models.Model):
+    #created_on high-water mark of the raw records included in the rollups
+    name = models.CharField(max_length=20, primary_key=True)
+    high_water = models.DateTimeField(blank=True, null = True)
+    updated_on = models.DateTimeField(auto_now=True)
+
+
+#--- Archive - compressed history of a tag per UTC day, written by the archive_history command ---
+
+class IotDataArchive(models.Model):
+    tag = models.ForeignKey(Tags, on_delete=models.PROTECT)
+    day = models.DateField()
+    count = models.IntegerField()
+    first_timestamp = models.DateTimeField()
+    last_timestamp = models.DateTimeField()
+    #Columnar block encoded by api.archive
+    data = models.BinaryField()
+    updated_on = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = (('tag', 'day'),)
@@ -0,0 +1,24 @@
+#--- IOT_Server - api app custom migration operations -------------------------
+
+from django.db import migrations
+
+
+class AddIndexOnline(migrations.AddIndex):
+    """
+    AddIndex that does not block writes to the table while the index is built.
+    MySQL (InnoDB) builds the index in place with LOCK=NONE and PostgreSQL uses
+    CREATE INDEX CONCURRENTLY, other backends fall back to a plain CREATE INDEX.
+    Migrations using it on PostgreSQL must set atomic = False.
+    """
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+        vendor = schema_editor.connection.vendor
+        sql = str(self.index.create_sql(model, schema_editor))
+        if vendor == 'mysql':
+            schema_editor.execute(sql + ' ALGORITHM=INPLACE LOCK=NONE')
+        elif vendor == 'postgresql':
+            schema_editor.execute(sql.replace('CREATE INDEX', 'CREATE INDEX CONCURRENTLY', 1))
+        else:
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
@@ -0,0 +1,110 @@
+#--- IOT_Server - api app pagination ------------------------------------------
+
+import base64
+import json
+from django.conf import settings
+from django.db.models import Q
+from django.utils import dateparse
+from rest_framework import serializers
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+def keyset_filter(queryset, timestamp, pk):
+    #Records ordered after (timestamp, pk)
+    return queryset.filter(Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, pk__gt=pk))
+
+
+class TimestampCursorPagination(BasePagination):
+    """
+    Keyset pagination on (timestamp, id) for the data list views.
+    Every page is a single indexed range scan, so deep pages cost the same as the first.
+    The response body stays a plain list, the next page is given in the Link header:
+        Link: <https://host/data/list/tag/?cursor=...>; rel="next"
+    Page size is taken from the max parameter and capped at IOT_MAX_PAGE_SIZE.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'max'
+    default_page_size = 100
+
+    def get_page_size(self, request):
+        max_page_size = getattr(settings, 'IOT_MAX_PAGE_SIZE', 10000)
+        page_size = request.query_params.get(self.page_size_query_param, self.default_page_size)
+        try:
+            page_size = int(page_size)
+        except ValueError:
+            raise serializers.ValidationError({'Invalid max parameter': page_size})
+        return max(1, min(page_size, max_page_size))
+
+    def encode_cursor(self, record):
+        return self.encode_position(record.timestamp, record.pk)
+
+    def encode_position(self, timestamp, pk):
+        position = json.dumps([timestamp.isoformat(), pk])
+        return base64.urlsafe_b64encode(position.encode()).decode()
+
+    def decode_cursor(self, request):
+        cursor = request.query_params.get(self.cursor_query_param, None)
+        if not cursor:
+            return None
+        try:
+            timestamp, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+            timestamp = dateparse.parse_datetime(timestamp)
+            if timestamp is None:
+                raise ValueError(cursor)
+            return timestamp, int(pk)
+        except (TypeError, ValueError):
+            raise serializers.ValidationError({'Invalid cursor': cursor})
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+
+        position = self.decode_cursor(request)
+        if position:
+            queryset = keyset_filter(queryset, *position)
+
+        #Fetch one extra record to know if there is a next page
+        records = list(queryset.order_by('timestamp', 'pk')[:self.page_size + 1])
+        self.has_next = len(records) > self.page_size
+        records = records[:self.page_size]
+        self.next_cursor = self.encode_cursor(records[-1]) if self.has_next else None
+        return records
+
+    def paginate_rows(self, queryset, fields, request, view=None):
+        """
+        Like paginate_queryset, but returns (timestamp, id, *fields) value tuples instead of
+        model instances. Views with archived history merge it with view.get_archived_rows.
+        """
+        self.request = request
+        self.page_size = self.get_page_size(request)
+
+        position = self.decode_cursor(request)
+        if position:
+            queryset = keyset_filter(queryset, *position)
+
+        #Fetch one extra row to know if there is a next page
+        rows = list(queryset.order_by('timestamp', 'pk').values_list('timestamp', 'pk', *fields)[:self.page_size + 1])
+
+        #Views with archived history merge it with the live rows
+        get_archived_rows = getattr(view, 'get_archived_rows', None)
+        if get_archived_rows is not None:
+            rows += get_archived_rows(position, self.page_size + 1)
+            rows = sorted(rows, key=lambda row: row[:2])[:self.page_size + 1]
+        self.has_next = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        self.next_cursor = self.encode_position(*rows[-1][:2]) if self.has_next else None
+        return rows
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.next_cursor)
+
+    def get_paginated_response(self, data):
+        headers = {}
+        if self.has_next:
+            headers['Link'] = f'<{self.get_next_link()}>; rel="next"'
+        return Response(data, headers=headers)
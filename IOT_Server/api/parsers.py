@@ -0,0 +1,33 @@
+#--- IOT_Server - api app parsers -----------------------------------------------
+
+import json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+
+
+def loads(body):
+    #Decodes a UTF-8 JSON request body with orjson when it is installed, raises ValueError
+    if orjson is None:
+        return json.loads(body.decode('utf-8'))
+    return orjson.loads(body)
+
+
+class FastJSONParser(JSONParser):
+    """
+    JSONParser that decodes with orjson when it is installed, used by the ingest views.
+    Bodies in another charset than UTF-8 go to the stdlib decoder of JSONParser.
+    """
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        encoding = (parser_context or {}).get('encoding', settings.DEFAULT_CHARSET)
+        if orjson is None or encoding.lower().replace('-', '') != 'utf8':
+            return super().parse(stream, media_type, parser_context)
+        try:
+            return orjson.loads(stream.read())
+        except ValueError as exc:
+            raise ParseError(f'JSON parse error - {exc}')
@@ -0,0 +1,181 @@
+#--- IOT_Server - api app partitions and retention -----------------------------
+#Monthly range partitions of the data tables (MySQL) and per device / station retention
+
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+from api.models import Devices, IotData, IotDataArchive, WeatherStations, WeatherData
+
+MAX_PARTITION = 'pmax'
+
+#Data model: (owner model of the retention setting, data filter for one owner)
+RETENTION_OWNERS = {
+    IotData: (Devices, 'tag__device'),
+    WeatherData: (WeatherStations, 'station'),
+}
+
+
+def is_supported():
+    return connection.vendor == 'mysql'
+
+
+def is_enabled():
+    return getattr(settings, 'IOT_PARTITIONS', False)
+
+
+def get_default_retention():
+    return getattr(settings, 'IOT_DEFAULT_RETENTION_DAYS', None)
+
+
+def get_months_ahead():
+    return getattr(settings, 'IOT_PARTITION_MONTHS_AHEAD', 3)
+
+
+def month_start(dt):
+    return datetime(dt.year, dt.month, 1, tzinfo=timezone.utc)
+
+
+def next_month(month):
+    return datetime(month.year + month.month // 12, month.month % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def partition_name(month):
+    return f'p{month:%Y%m}'
+
+
+def _partition_sql(month):
+    return f"PARTITION {partition_name(month)} VALUES LESS THAN ('{next_month(month):%Y-%m-%d}')"
+
+
+def _months(first, last):
+    #Month starts from first to last inclusive
+    month = month_start(first)
+    while month <= last:
+        yield month
+        month = next_month(month)
+
+
+def get_partitions(model):
+    #[(partition name, upper bound or None for pmax)] in order, empty if the table is not partitioned
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS '
+                       'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL '
+                       'ORDER BY PARTITION_ORDINAL_POSITION', [model._meta.db_table])
+        rows = cursor.fetchall()
+    partitions = []
+    for name, description in rows:
+        if description == 'MAXVALUE':
+            partitions.append((name, None))
+        else:
+            bound = datetime.strptime(description.strip("'")[:10], '%Y-%m-%d')
+            partitions.append((name, bound.replace(tzinfo=timezone.utc)))
+    return partitions
+
+
+def setup_sql(model, now=None):
+    #Statements converting a table to monthly partitions from its oldest record to the months ahead,
+    #its foreign keys are dropped by migration 0027
+    now = now or timezone.now()
+    table = connection.ops.quote_name(model._meta.db_table)
+    first = model.objects.order_by('timestamp').values_list('timestamp', flat=True).first() or now
+    last = month_start(now)
+    for i in range(get_months_ahead()):
+        last = next_month(last)
+
+    statements = [f'ALTER TABLE {table} DROP PRIMARY KEY, ADD PRIMARY KEY (id, timestamp)']
+    partitions = [_partition_sql(month) for month in _months(first, last)]
+    partitions.append(f'PARTITION {MAX_PARTITION} VALUES LESS THAN (MAXVALUE)')
+    statements.append(f"ALTER TABLE {table} PARTITION BY RANGE COLUMNS(timestamp) ({', '.join(partitions)})")
+    return statements
+
+
+def future_partitions_sql(model, now=None):
+    #Statements splitting the empty pmax partition into the months ahead that are missing
+    now = now or timezone.now()
+    bounds = [bound for name, bound in get_partitions(model) if bound is not None]
+    if not bounds:
+        return []
+    last = month_start(now)
+    for i in range(get_months_ahead()):
+        last = next_month(last)
+    months = list(_months(bounds[-1], last))
+    if not months:
+        return []
+    table = connection.ops.quote_name(model._meta.db_table)
+    partitions = [_partition_sql(month) for month in months]
+    partitions.append(f'PARTITION {MAX_PARTITION} VALUES LESS THAN (MAXVALUE)')
+    return [f"ALTER TABLE {table} REORGANIZE PARTITION {MAX_PARTITION} INTO ({', '.join(partitions)})"]
+
+
+def drop_partition_sql(model, name, archive=False):
+    #Statements dropping a partition, with archive its rows are first exchanged into a table of their own
+    table = model._meta.db_table
+    statements = []
+    if archive:
+        archive_table = connection.ops.quote_name(f'{table}_archive_{name[1:]}')
+        statements += [
+            f'CREATE TABLE {archive_table} LIKE {connection.ops.quote_name(table)}',
+            f'ALTER TABLE {archive_table} REMOVE PARTITIONING',
+            f'ALTER TABLE {connection.ops.quote_name(table)} EXCHANGE PARTITION {name} WITH TABLE {archive_table}',
+        ]
+    statements.append(f'ALTER TABLE {connection.ops.quote_name(table)} DROP PARTITION {name}')
+    return statements
+
+
+def get_retentions(model):
+    #{owner pk: retention days or None to keep forever} of every device / station
+    owner_model, lookup = RETENTION_OWNERS[model]
+    default = get_default_retention()
+    return {pk: days or default for pk, days in owner_model.objects.values_list('pk', 'retention_days')}
+
+
+def get_table_retention(retentions):
+    #Longest retention of a table, None when any owner keeps data forever
+    if not retentions or None in retentions.values():
+        return None
+    return max(retentions.values())
+
+
+def expired_partitions(model, now=None):
+    #Names of the partitions holding only records older than the longest retention of the table
+    now = now or timezone.now()
+    days = get_table_retention(get_retentions(model))
+    if days is None:
+        return []
+    horizon = now - timedelta(days=days)
+    return [name for name, bound in get_partitions(model) if bound is not None and bound <= horizon]
+
+
+def purge(model, now=None, partitioned=False):
+    """
+    Deletes records older than their device / station retention in chunks of IOT_PURGE_CHUNK_SIZE.
+    On partitioned tables owners with the longest retention are left to the partition drops.
+    Expired archive blocks of tag history are deleted as well.
+    Returns the number of records deleted.
+    """
+    now = now or timezone.now()
+    chunk_size = getattr(settings, 'IOT_PURGE_CHUNK_SIZE', 10000)
+    owner_model, lookup = RETENTION_OWNERS[model]
+    retentions = get_retentions(model)
+    table_retention = get_table_retention(retentions) if partitioned else None
+
+    deleted = 0
+    for owner_pk, days in retentions.items():
+        if days is None:
+            continue
+        horizon = now - timedelta(days=days)
+        if model is IotData:
+            #Archived days are dropped whole once the day has expired
+            IotDataArchive.objects.filter(tag__device=owner_pk, last_timestamp__lt=horizon).delete()
+        if days == table_retention:
+            continue
+        expired = model.objects.filter(**{lookup: owner_pk, 'timestamp__lt': horizon})
+        while True:
+            pks = list(expired.values_list('pk', flat=True)[:chunk_size])
+            if not pks:
+                break
+            #No delete signals are connected for the data models, this is a single DELETE per chunk.
+            #The timestamp condition lets a partitioned table skip the partitions that are kept.
+            deleted += model.objects.filter(pk__in=pks, timestamp__lt=horizon).delete()[0]
+    return deleted
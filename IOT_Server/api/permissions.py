@@ -9,9 +9,10 @@ from rest_framework import permissions
 class IsOwner(permissions.BasePermission):
     """
     Custom permission to allow only owners of an object to view or edit.
+    Compares owner ids, so the owner (and for tags the device) is not loaded.
     """
     def has_object_permission(self, request, view, obj):
-        if obj.owner == request.user:
+        if obj.owner_id == request.user.pk:
             return True
         else:
             return False
@@ -35,6 +36,9 @@ class IsStaff(permissions.BasePermission):
     def has_object_permission(self, request, view, obj):
         return request.user and request.user.is_staff
 
+    def has_permission(self, request, view):
+        return request.user and request.user.is_staff
+
 
 class GetOnlyUnlessIsStaff(permissions.BasePermission):
     """
@@ -0,0 +1,302 @@
+#--- IOT_Server - api app rollups ---------------------------------------------
+#1 minute, 1 hour and 1 day aggregates of numeric tag and weather data, kept up to date by update_rollups
+
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+from django.conf import settings
+from django.db import models, transaction
+from django.utils import timezone
+from api.models import Tags, IotData, WeatherStations, WeatherData
+from api.models import IotDataRollup, WeatherDataRollup, RollupState, IotDataArchive
+from api.aggregation import EpochBucket, INTERVALS, NUMERIC_TYPES, VALUE_FIELDS, WEATHER_FIELDS
+from api.aggregation import aggregate_buckets, bucket_datetime
+from api import archive
+
+ROLLUP_INTERVALS = ('1m', '1h', '1d')
+ROLLUP_FUNCTIONS = ('min', 'max', 'sum', 'count', 'last')
+
+#Buckets further apart than this many bucket widths are recomputed with separate queries
+CLUSTER_GAP = 60
+
+TAG_DATA = 'iotdata'
+WEATHER_DATA = 'weatherdata'
+
+
+def high_water(name):
+    #created_on high-water mark of the rollups, None if they were never built
+    return RollupState.objects.filter(name=name).values_list('high_water', flat=True).first()
+
+
+def get_lag():
+    #Records created in the last seconds may still be in uncommitted transactions, leave them for the next run
+    return timedelta(seconds=getattr(settings, 'IOT_ROLLUP_LAG', 10))
+
+
+def _clusters(buckets, seconds):
+    #Split sorted bucket starts into (first, last) ranges without large gaps
+    ranges = []
+    for bucket in buckets:
+        if ranges and bucket - ranges[-1][1] <= seconds * CLUSTER_GAP:
+            ranges[-1][1] = bucket
+        else:
+            ranges.append([bucket, bucket])
+    return ranges
+
+
+def _compose(rows, seconds, fields):
+    """
+    aggregate_buckets of rollup rows of a finer interval ordered by bucket: counts and sums add up,
+    min / max of the mins / maxes, last of the newest row. Rows without a field column are of fields[0].
+    """
+    buckets = {}
+    for row in rows:
+        bucket = int(row.bucket.timestamp()) // seconds * seconds
+        field = getattr(row, 'field', fields[0])
+        values = buckets.setdefault(bucket, {}).get(field)
+        if values is None:
+            buckets[bucket][field] = {'min': row.value_min, 'max': row.value_max, 'sum': row.value_sum,
+                                      'count': row.count, 'last': row.value_last}
+        else:
+            values['min'], values['max'] = min(values['min'], row.value_min), max(values['max'], row.value_max)
+            values['sum'] += row.value_sum
+            values['count'] += row.count
+            values['last'] = row.value_last
+    empty = {'min': None, 'max': None, 'sum': None, 'count': 0, 'last': None}
+    return [(bucket, {field: buckets[bucket].get(field, empty) for field in fields}) for bucket in sorted(buckets)]
+
+
+def _recompute(aggregate, rollups, make_rollup, fields, minute_buckets):
+    """
+    Recomputes the rollups of one tag or station for every interval containing minute_buckets.
+    aggregate(begin, end, seconds) returns the ROLLUP_FUNCTIONS buckets of the tag / station
+    in [begin, end) in aggregate_buckets format, rollups = its existing rollup rows.
+    make_rollup(interval, bucket, field, values) returns an unsaved rollup instance.
+    Only 1m buckets are read from the raw records, each longer interval is composed from the
+    stored rollups of the one before it.
+    """
+    written = 0
+    with transaction.atomic():
+        finer = None
+        for interval in ROLLUP_INTERVALS:
+            seconds = INTERVALS[interval]
+            buckets = sorted({bucket - bucket % seconds for bucket in minute_buckets})
+            new_rollups = []
+            for first, last in _clusters(buckets, seconds):
+                begin, end = bucket_datetime(first), bucket_datetime(last + seconds)
+                rollups.filter(interval=interval, bucket__gte=begin, bucket__lt=end).delete()
+                if finer is None:
+                    values = aggregate(begin, end, seconds)
+                else:
+                    values = _compose(rollups.filter(interval=finer, bucket__gte=begin, bucket__lt=end)
+                                             .order_by('bucket'), seconds, fields)
+                for bucket, values in values:
+                    for field in fields:
+                        if values[field]['count']:
+                            new_rollups.append(make_rollup(interval, bucket_datetime(bucket), field, values[field]))
+            rollups.model.objects.bulk_create(new_rollups)
+            written += len(new_rollups)
+            finer = interval
+    return written
+
+
+def _rollup_values(values):
+    return {'count': values['count'], 'value_min': values['min'], 'value_max': values['max'],
+            'value_sum': values['sum'], 'value_last': values['last']}
+
+
+def _aggregate_rows(rows, seconds, field):
+    #aggregate_buckets of (id, timestamp, value) rows computed in Python
+    buckets = {}
+    for pk, timestamp, value in rows:
+        bucket = int(timestamp.timestamp()) // seconds * seconds
+        values = buckets.setdefault(bucket, {'min': None, 'max': None, 'sum': None, 'count': 0,
+                                             'last': None, 'last_key': None})
+        #Value of the most recent record, highest id wins on a tie
+        if values['last_key'] is None or (timestamp, pk) > values['last_key']:
+            values['last'], values['last_key'] = value, (timestamp, pk)
+        if value is None:
+            continue
+        if values['count']:
+            values['min'], values['max'] = min(values['min'], value), max(values['max'], value)
+            values['sum'] += value
+        else:
+            values['min'] = values['max'] = values['sum'] = value
+        values['count'] += 1
+    for values in buckets.values():
+        del values['last_key']
+    return [(bucket, {field: buckets[bucket]}) for bucket in sorted(buckets)]
+
+
+def _aggregate_tag(tag_id, field, begin, end, seconds):
+    #Buckets of a tag from its raw records, merged with its archived records when there are any in the range
+    records = IotData.objects.filter(tag_id=tag_id, timestamp__gte=begin, timestamp__lt=end)
+    archived = [row for block_type, row in
+                archive.iter_archived_rows(tag_id, {'timestamp__gte': begin, 'timestamp__lt': end})]
+    if not archived:
+        return aggregate_buckets(records, seconds, [field], ROLLUP_FUNCTIONS, None)
+    return _aggregate_rows(archived + list(records.values_list('pk', 'timestamp', field)), seconds, field)
+
+
+def recompute_tag(tag_id, tag_type, minute_buckets):
+    field = VALUE_FIELDS[tag_type]
+    return _recompute(lambda begin, end, seconds: _aggregate_tag(tag_id, field, begin, end, seconds),
+                      IotDataRollup.objects.filter(tag_id=tag_id),
+                      lambda interval, bucket, field, values: IotDataRollup(
+                          tag_id=tag_id, interval=interval, bucket=bucket, **_rollup_values(values)),
+                      [field], minute_buckets)
+
+
+def recompute_station(station_id, minute_buckets):
+    raw = WeatherData.objects.filter(station_id=station_id)
+    return _recompute(lambda begin, end, seconds: aggregate_buckets(
+                          raw.filter(timestamp__gte=begin, timestamp__lt=end), seconds, list(WEATHER_FIELDS),
+                          ROLLUP_FUNCTIONS, None),
+                      WeatherDataRollup.objects.filter(station_id=station_id),
+                      lambda interval, bucket, field, values: WeatherDataRollup(
+                          station_id=station_id, interval=interval, field=field, bucket=bucket,
+                          **_rollup_values(values)),
+                      list(WEATHER_FIELDS), minute_buckets)
+
+
+def _minute_buckets(queryset, key_field):
+    #{tag / station: set of 1 minute buckets} containing the records of queryset
+    affected = defaultdict(set)
+    minutes = queryset.annotate(minute=EpochBucket('timestamp', 60)).values_list(key_field, 'minute')
+    for key, minute in minutes.distinct():
+        affected[key].add(minute)
+    return affected
+
+
+def _tag_types(tag_ids):
+    #Value type of numeric tags
+    return dict(Tags.objects.filter(pk__in=tag_ids, value_type__type__in=NUMERIC_TYPES)
+                            .values_list('tag_id', 'value_type__type'))
+
+
+def _update_state(name, mark):
+    RollupState.objects.update_or_create(name=name, defaults={'high_water': mark})
+
+
+def update(name):
+    """
+    Incremental update from the high-water mark. Returns number of rollup rows written,
+    None if the rollups were never backfilled.
+    """
+    mark = high_water(name)
+    if mark is None:
+        return None
+    until = timezone.now() - get_lag()
+    if until <= mark:
+        return 0
+
+    written = 0
+    if name == TAG_DATA:
+        new_records = IotData.objects.filter(created_on__gt=mark, created_on__lte=until)
+        affected = _minute_buckets(new_records, 'tag_id')
+        tag_types = _tag_types(list(affected))
+        for tag_id, minute_buckets in affected.items():
+            if tag_id in tag_types:
+                written += recompute_tag(tag_id, tag_types[tag_id], minute_buckets)
+    else:
+        new_records = WeatherData.objects.filter(created_on__gt=mark, created_on__lte=until)
+        for station_id, minute_buckets in _minute_buckets(new_records, 'station_id').items():
+            written += recompute_station(station_id, minute_buckets)
+    _update_state(name, until)
+    return written
+
+
+def backfill(name, begin=None, end=None):
+    """
+    Recomputes the rollups of every tag or station one day at a time between begin and end
+    (default all history) and moves the high-water mark to the start of the backfill.
+    """
+    until = timezone.now() - get_lag()
+    if name == TAG_DATA:
+        raw, key_field = IotData.objects.all(), 'tag_id'
+        tag_types = _tag_types(Tags.objects.values_list('tag_id', flat=True))
+        keys = list(tag_types)
+    else:
+        raw, key_field = WeatherData.objects.all(), 'station_id'
+        keys = list(WeatherStations.objects.values_list('pk', flat=True))
+
+    day = INTERVALS['1d']
+    written = 0
+    for key in keys:
+        records = raw.filter(**{key_field: key})
+        if begin:
+            records = records.filter(timestamp__gte=begin)
+        if end:
+            records = records.filter(timestamp__lt=end)
+        #Only days with records, one day at a time keeps each recompute to a day of raw records
+        days = set(records.annotate(day=EpochBucket('timestamp', day)).values_list('day', flat=True).distinct())
+        if name == TAG_DATA:
+            #Days moved to the archive have no raw records left
+            blocks = IotDataArchive.objects.filter(tag_id=key)
+            if begin:
+                blocks = blocks.filter(last_timestamp__gte=begin)
+            if end:
+                blocks = blocks.filter(first_timestamp__lt=end)
+            days.update(int(first.timestamp()) // day * day
+                        for first in blocks.values_list('first_timestamp', flat=True))
+        for day_start in sorted(days):
+            minute_buckets = range(day_start, day_start + day, 60)
+            if name == TAG_DATA:
+                written += recompute_tag(key, tag_types[key], minute_buckets)
+            else:
+                written += recompute_station(key, minute_buckets)
+
+    #Keep an existing mark that is older, records created since then still need an update
+    mark = high_water(name)
+    if mark is None or mark > until:
+        _update_state(name, until)
+    return written
+
+
+def _value_converters(model, field):
+    """
+    (value, avg) converters of the Decimals stored in the rollups for a field of model, so rollup
+    buckets hold the types of the raw aggregation: int (avg float) for integer fields, Decimals
+    with the places of the field for decimal fields.
+    """
+    model_field = model._meta.get_field(field)
+    if isinstance(model_field, models.IntegerField):
+        return int, float
+    places = Decimal(10) ** -model_field.decimal_places
+    return (lambda value: value.quantize(places)), (lambda value: value)
+
+
+def _rollup_bucket_values(row, functions, converters):
+    convert, convert_avg = converters
+    values = {}
+    for function in functions:
+        if function == 'avg':
+            values['avg'] = convert_avg(row.value_sum / row.count) if row.count else None
+        elif function == 'count':
+            values['count'] = row.count
+        else:
+            value = getattr(row, f'value_{function}')
+            values[function] = None if value is None else convert(value)
+    return values
+
+
+def tag_buckets(tag_id, interval, field, functions, begin, end, max_buckets):
+    #Most recent max_buckets rollup buckets of a tag in [begin, end), in aggregate_buckets format
+    rows = IotDataRollup.objects.filter(tag_id=tag_id, interval=interval, bucket__gte=begin, bucket__lt=end)
+    rows = reversed(rows.order_by('-bucket')[:max_buckets])
+    converters = _value_converters(IotData, field)
+    return [(int(row.bucket.timestamp()), {field: _rollup_bucket_values(row, functions, converters)}) for row in rows]
+
+
+def station_buckets(station_id, interval, fields, functions, begin, end, max_buckets):
+    #Most recent max_buckets rollup buckets of a station in [begin, end), in aggregate_buckets format
+    rows = WeatherDataRollup.objects.filter(station_id=station_id, interval=interval, field__in=fields,
+                                            bucket__gte=begin, bucket__lt=end)
+    converters = {field: _value_converters(WeatherData, field) for field in fields}
+    buckets = defaultdict(dict)
+    for row in reversed(rows.order_by('-bucket')[:max_buckets * len(fields)]):
+        buckets[int(row.bucket.timestamp())][row.field] = _rollup_bucket_values(row, functions, converters[row.field])
+    #Fields without records in a bucket have no rollup row, report them like the raw aggregation
+    empty = {function: (0 if function == 'count' else None) for function in functions}
+    return [(bucket, {field: values.get(field, dict(empty)) for field in fields})
+            for bucket, values in buckets.items()]
@@ -0,0 +1,42 @@
+#--- IOT_Server - api app value rows --------------------------------------------
+#Data list responses built from values_list() rows, same output as the serializers
+
+from rest_framework import serializers
+from api.aggregation import VALUE_FIELDS
+from api.export import WEATHER_COLUMNS
+from api.latest import tag_value_repr
+
+WEATHER_VALUE_FIELDS = WEATHER_COLUMNS[1:-1]
+
+_timestamp_field = serializers.DateTimeField()
+
+
+def tag_value_field(tag_type):
+    #IotData field holding the values of a tag type
+    return VALUE_FIELDS.get(tag_type, 'value_text')
+
+
+def tag_data_rows(rows, tag_id, tag_type):
+    #TagDataSerializer dicts of the (timestamp, id, value) rows of one tag
+    timestamp_repr = _timestamp_field.to_representation
+    known_type = tag_type in VALUE_FIELDS
+    return [{'tag': tag_id, 'type': tag_type,
+             'value': None if value is None and known_type else tag_value_repr(value, tag_type),
+             'timestamp': timestamp_repr(timestamp)}
+            for timestamp, pk, value in rows]
+
+
+def weather_data_rows(rows, identifier):
+    #WxDataSerializer dicts of the (timestamp, id, *WEATHER_VALUE_FIELDS) rows of one station
+    from api.serializers import WxDataSerializer
+    fields = WxDataSerializer().fields
+    value_reprs = [fields[column].to_representation for column in WEATHER_VALUE_FIELDS]
+    timestamp_repr = _timestamp_field.to_representation
+    data = []
+    for timestamp, pk, *values in rows:
+        record = {'identifier': identifier}
+        for column, value_repr, value in zip(WEATHER_VALUE_FIELDS, value_reprs, values):
+            record[column] = None if value is None else value_repr(value)
+        record['timestamp'] = timestamp_repr(timestamp)
+        data.append(record)
+    return data
@@ -8,13 +8,65 @@ from api.models import Devices, Tags, ValueTypes, IotData
 from api.models import WeatherStations, WeatherData
 from distutils.util import strtobool
 from django.core.exceptions import ObjectDoesNotExist
+from django.conf import settings
+from decimal import Decimal, InvalidOperation
+from api import latest, tag_cache, ingest_queue, deadband
+
+
+def parse_tag_value(tag_type, value):
+    """
+    Converts a POSTED value to the IotData value field for the given tag value type.
+    Returns a dict of {field name: value}, raises ValueError with a message if invalid.
+    """
+    val = str(value)
+
+    #Handle boolean value
+    if tag_type == 'bool':
+        try:
+            return {'value_bool': bool(strtobool(val))}
+        except ValueError:
+            raise ValueError('Boolean value required. (True, Yes, Y, On, 1, False, No, N, Off, 0)')
+
+    #Handle integer value
+    elif tag_type == 'int':
+        try:
+            return {'value_int': int(val)}
+        except ValueError:
+            raise ValueError('Integer value required.')
+
+    #Handle decimal value
+    elif tag_type == 'dec':
+        try:
+            dec_val = Decimal(val)
+        except InvalidOperation:
+            raise ValueError('Numeric value required.')
+        if not dec_val.is_finite():
+            raise ValueError('Numeric value required.')
+        #check lengths of decimal number parts
+        digit_max = IotData._meta.get_field('value_dec').max_digits
+        dec_max = IotData._meta.get_field('value_dec').decimal_places
+        if '.' in val:
+            val_parts = val.split('.')
+        else:
+            val_parts = (val, "0")
+        if len(val_parts[0]) > digit_max - dec_max:
+            raise ValueError(f'Maximum of {digit_max-dec_max} digits before the decimal point exceeded.')
+        if len(val_parts[1]) > dec_max:
+            raise ValueError(f'Maximum of {dec_max} digits after the decimal point exceeded.')
+        return {'value_dec': dec_val}
+
+    #Handle string value
+    elif tag_type == 'string':
+        return {'value_text': val}
+
+    raise ValueError('ValueType not defined.')
 
 
 class DeviceSerializer(serializers.ModelSerializer):
     owner = serializers.ReadOnlyField(source='owner.username')
     class Meta:
         model = Devices
-        fields = ('device_id', 'owner', 'name', 'description', 'type')
+        fields = ('device_id', 'owner', 'name', 'description', 'type', 'retention_days')
 
 
 class OwnedDevices(serializers.PrimaryKeyRelatedField):
@@ -30,7 +82,25 @@ class TagSerializer(serializers.ModelSerializer):
     device = OwnedDevices(many=False)
     class Meta:
         model = Tags
-        fields = ('tag_id', 'owner', 'name', 'description', 'device', 'value_type')
+        fields = ('tag_id', 'owner', 'name', 'description', 'device', 'value_type',
+                  'deadband_type', 'deadband', 'heartbeat')
+
+    def validate(self, data):
+        #Check deadband settings against the value type, PATCH falls back to the saved values
+        def current(name):
+            return data[name] if name in data else getattr(self.instance, name, None)
+        deadband_type = current('deadband_type')
+        value_type = current('value_type')
+        if deadband_type in ('abs', 'pct'):
+            if value_type is not None and value_type.type not in ('int', 'dec'):
+                msg = f'Deadband type {deadband_type} requires an int or dec value type.'
+                raise serializers.ValidationError({'deadband_type': msg})
+            if current('deadband') is None:
+                msg = f'A deadband is required for deadband type {deadband_type}.'
+                raise serializers.ValidationError({'deadband': msg})
+        if (current('deadband') or 0) < 0:
+            raise serializers.ValidationError({'deadband': 'Deadband cannot be negative.'})
+        return data
 
 
 class DeviceTags(serializers.ModelSerializer):
@@ -54,19 +124,30 @@ class ValTypeSerializer(serializers.ModelSerializer):
         fields = ('value_type_id', 'name', 'type')
 
 
-class OwnedTags(serializers.PrimaryKeyRelatedField):
-    #Limit tag list to those owned by request.user
-    def get_queryset(self):
-        user = self.context['request'].user
-        queryset = Tags.objects.filter(device__owner=user)
-        return queryset
+class TagValueField(serializers.CharField):
+    #Tag value given as a JSON string, number or boolean, converted by parse_tag_value for the tag type
+    def to_internal_value(self, data):
+        if isinstance(data, bool):
+            data = str(data)
+        return super().to_internal_value(data)
+
+
+class CachedOwnedTag(serializers.CharField):
+    #Tag id limited to tags owned by request.user, resolved from the tag metadata cache
+    def to_internal_value(self, data):
+        tag_id = super().to_internal_value(data)
+        info = tag_cache.get_tag(tag_id)
+        if info is None or info.owner_id != self.context['request'].user.pk:
+            msg = f"""Invalid pk "{tag_id}" - object does not exist."""
+            raise serializers.ValidationError(msg)
+        return tag_id
 
 
 class TagDataSerializer(serializers.ModelSerializer):
-    value = serializers.CharField(max_length=100)
+    value = TagValueField(max_length=100)
     type = serializers.ReadOnlyField(source='tag.value_type.type')
     #owner = serializers.ReadOnlyField(source='owner.username')
-    tag = OwnedTags(many=False)
+    tag = CachedOwnedTag(max_length=25, source='tag_id')
 
     class Meta:
         model = IotData
@@ -76,68 +157,165 @@ class TagDataSerializer(serializers.ModelSerializer):
         values = super().to_internal_value(data)
 
         #Get value type for tag POSTED
-        tag_type = Tags.objects.select_related('value_type').get(pk=data['tag']).value_type.type
-        
-        val = str(data['value'])
+        self.tag_info = tag_cache.get_tag(values['tag_id'])
+        self.tag_type = self.tag_info.type
+        self.owner_id = self.tag_info.owner_id
 
-        #-- Save value POSTED in appropriate field based on tag value type --
-        #Handle boolean value
-        if tag_type == 'bool':
-            try:
-                values['value_bool'] = strtobool(val)
-            except ValueError:
-                msg = 'Boolean value required. (True, Yes, Y, On, 1, False, No, N, Off, 0)'
-                raise serializers.ValidationError({data['tag']: msg})
+        #Save value POSTED in appropriate field based on tag value type
+        try:
+            values.update(parse_tag_value(self.tag_type, data['value']))
+        except ValueError as e:
+            raise serializers.ValidationError({data['tag']: str(e)})
+
+        del values['value']
+        return values
 
-        #Handle integer value
-        elif tag_type == 'int':
+    def filter_deadband(self, instance):
+        #Applies the tag deadband, sets suppressed when the reading is not to be stored
+        self.suppressed = not deadband.filter_records([instance], {instance.tag_id: self.tag_info})
+        return not self.suppressed
+
+    def create(self, validated_data):
+        instance = IotData(**validated_data)
+        if not ingest_queue.drop_stored(IotData, [instance]):
+            #Already stored, the database would ignore it
+            return instance
+        if self.filter_deadband(instance):
+            try:
+                ingest_queue.insert_records(IotData, [instance])
+            except Exception:
+                #Not stored, a retry of the reading must not be suppressed
+                deadband.reset([instance.tag_id])
+                raise
+            latest.store_tag_data([instance], {instance.tag_id: self.tag_type}, self.owner_id)
+        return instance
+
+    def enqueue(self):
+        #Queue the record for the drain_ingest worker instead of saving it (IOT_INGEST_MODE = 'queue')
+        self.instance = IotData(**self.validated_data)
+        if self.filter_deadband(self.instance):
             try:
-                int(val)
-                values['value_int'] = val
-            except ValueError:
-                raise serializers.ValidationError({data['tag']: 'Integer value required.'})
-        
-        #Handle decimal value
-        elif tag_type == 'dec':
+                ingest_queue.enqueue(ingest_queue.TAG_DATA, [self.instance])
+            except Exception:
+                deadband.reset([self.instance.tag_id])
+                raise
+        return self.instance
+
+    def to_representation(self, instance):
+        #A record saved by this serializer has its tag type known, skip loading tag and value type
+        if getattr(self, 'tag_type', None) is not None:
+            return latest.tag_data_repr(instance, self.tag_type)
+        return super().to_representation(instance)
+
+
+class TagDataRecordSerializer(serializers.Serializer):
+    #Field level validation for a single record of a TagDataBatchSerializer payload
+    tag = serializers.CharField(max_length=25)
+    value = TagValueField(max_length=100)
+    timestamp = serializers.DateTimeField(required=False)
+
+
+class BatchSerializer(serializers.BaseSerializer):
+    #Field level validation of a list of records shared by the batch serializers
+    record_serializer_class = None
+
+    def validate_records(self, data):
+        """
+        Returns [(index, validated values)] of the valid records of data and sets record_errors
+        to the errors of the others. One record serializer validates every record, its fields
+        are only built once.
+        """
+        if not isinstance(data, list):
+            raise serializers.ValidationError({'non_field_errors': ['Expected a list of records.']})
+        if not data:
+            raise serializers.ValidationError({'non_field_errors': ['No records given.']})
+        max_records = getattr(settings, 'IOT_BATCH_MAX_RECORDS', 5000)
+        if len(data) > max_records:
+            msg = f'Maximum of {max_records} records per request exceeded.'
+            raise serializers.ValidationError({'non_field_errors': [msg]})
+
+        record = self.record_serializer_class()
+        self.record_errors = []
+        valid = []
+        for index, rec in enumerate(data):
             try:
-                float(val)
-            except ValueError:
-                raise serializers.ValidationError({data['tag']: 'Numeric value required.'})
-            #check lengths of decimal number parts
-            digit_max = IotData._meta.get_field('value_dec').max_digits
-            dec_max = IotData._meta.get_field('value_dec').decimal_places
-            if '.' in val:
-                val_parts = val.split('.')
-            else:
-                val_parts = (val, "0")
-            if len(val_parts[0]) > digit_max - dec_max:
-                msg = f'Maximum of {digit_max-dec_max} digits before the decimal point exceeded.'
-                raise serializers.ValidationError({data['tag']: msg})
-            if len(val_parts[1]) > dec_max:
-                msg = f'Maximum of {dec_max} digits after the decimal point exceeded.'
-                raise serializers.ValidationError({data['tag']: msg})
-            values['value_dec'] = val
-
-        #Handle string value
-        elif tag_type == 'string':
-            values['value_text'] = val
+                valid.append((index, dict(record.run_validation(rec))))
+            except serializers.ValidationError as e:
+                self.record_errors.append({'index': index, 'errors': e.detail})
+        return valid
 
-        else:
-            msg = f'ValueType not defined.'
-            raise serializers.ValidationError({data['tag']: msg})
 
-        del values['value']
-        return values
+class TagDataBatchSerializer(BatchSerializer):
+    """
+    Validates a list of tag data records together.
+    Tags are resolved from the tag metadata cache and valid records are saved with one bulk insert.
+    Invalid records are skipped and reported with their list index in record_errors,
+    records within their tag deadband are not saved and counted in suppressed.
+    """
+    record_serializer_class = TagDataRecordSerializer
 
-    #Validate request.user is owner of tag
-    def validate_tag(self, value):
-        if self.context['request'].user != value.owner:
-            msg = f"""Invalid pk "{value.tag_id}" - object does not exist."""
-            raise serializers.ValidationError(msg)
-        return value
+    def to_internal_value(self, data):
+        valid = self.validate_records(data)
+
+        #Get value type of every tag referenced that is owned by request.user
+        user = self.context['request'].user
+        tag_ids = {values['tag'] for index, values in valid}
+        tag_infos = {tag_id: info for tag_id, info in tag_cache.get_tags(tag_ids).items()
+                     if info.owner_id == user.pk}
+        tag_types = {tag_id: info.type for tag_id, info in tag_infos.items()}
+
+        records = []
+        for index, values in valid:
+            tag = values.pop('tag')
+            if tag not in tag_types:
+                msg = f"""Invalid pk "{tag}" - object does not exist."""
+                self.record_errors.append({'index': index, 'errors': {'tag': [msg]}})
+                continue
+            try:
+                values.update(parse_tag_value(tag_types[tag], values.pop('value')))
+            except ValueError as e:
+                self.record_errors.append({'index': index, 'errors': {tag: [str(e)]}})
+                continue
+            records.append(IotData(tag_id=tag, **values))
+
+        self.record_errors.sort(key=lambda error: error['index'])
+        if not records:
+            raise serializers.ValidationError({'errors': self.record_errors})
+        return {'records': records, 'tag_types': tag_types, 'tag_infos': tag_infos}
+
+    def filter_deadband(self, validated_data):
+        #Records outside their tag deadband, sets suppressed to the number left out
+        records = deadband.filter_records(validated_data['records'], validated_data['tag_infos'])
+        self.suppressed = len(validated_data['records']) - len(records)
+        return records
 
     def create(self, validated_data):
-        return IotData.objects.create(**validated_data)
+        records = ingest_queue.drop_stored(IotData, validated_data['records'])
+        records = self.filter_deadband({**validated_data, 'records': records})
+        if records:
+            try:
+                records = ingest_queue.insert_records(IotData, records)
+            except Exception:
+                #Not stored, a retry of the readings must not be suppressed
+                deadband.reset({obj.tag_id for obj in records})
+                raise
+            latest.store_tag_data(records, validated_data['tag_types'], self.context['request'].user.pk)
+        return records
+
+    def enqueue(self):
+        #Queue the records for the drain_ingest worker instead of saving them (IOT_INGEST_MODE = 'queue')
+        self.instance = self.filter_deadband(self.validated_data)
+        if self.instance:
+            try:
+                ingest_queue.enqueue(ingest_queue.TAG_DATA, self.instance)
+            except Exception:
+                deadband.reset({obj.tag_id for obj in self.instance})
+                raise
+        return self.instance
+
+    def to_representation(self, instance):
+        return {'created': len(instance), 'suppressed': getattr(self, 'suppressed', 0),
+                'errors': self.record_errors}
 
 
 class WxStationSerializer(serializers.ModelSerializer):
@@ -145,7 +323,7 @@ class WxStationSerializer(serializers.ModelSerializer):
     class Meta:
         model = WeatherStations
         fields = ('identifier', 'owner', 'name', 'description',
-                 'latitude', 'longitude', 'type')
+                 'latitude', 'longitude', 'type', 'retention_days')
 
     def validate(self, data):
         user = self.context['request'].user
@@ -205,4 +383,86 @@ class WxDataCreateSerializer(serializers.ModelSerializer):
         return values
 
     def create(self, validated_data):
-        return WeatherData.objects.create(**validated_data)
+        instance = WeatherData(**validated_data)
+        if ingest_queue.drop_stored(WeatherData, [instance]):
+            ingest_queue.insert_records(WeatherData, [instance])
+            latest.store_weather_data([instance])
+        return instance
+
+    def enqueue(self):
+        #Queue the record for the drain_ingest worker instead of saving it (IOT_INGEST_MODE = 'queue')
+        self.instance = WeatherData(**self.validated_data)
+        ingest_queue.enqueue(ingest_queue.WEATHER_DATA, [self.instance])
+        return self.instance
+
+
+class WxDataRecordSerializer(serializers.ModelSerializer):
+    #Field level validation for a single record of a WxDataBatchSerializer payload
+    identifier = serializers.CharField(max_length=30)
+
+    class Meta:
+        model = WeatherData
+        fields = ('identifier', 'temperature', 'dewpoint', 'temp_uom',
+                  'wind_speed', 'wind_gust', 'wind_uom', 'wind_dir', 'dir_uom',
+                  'pressure', 'press_uom', 'timestamp')
+
+
+class WxDataBatchSerializer(BatchSerializer):
+    """
+    Validates a list of weather data records together.
+    Stations are resolved with one query and valid records are saved with one bulk insert.
+    Invalid records are skipped and reported with their list index in record_errors.
+    With dedupe, records for a station and timestamp already stored or repeated in the
+    payload (the first one is kept, as with the unique index) are skipped and counted in duplicates.
+    """
+    record_serializer_class = WxDataRecordSerializer
+
+    def __init__(self, *args, dedupe=False, **kwargs):
+        self.dedupe = dedupe
+        super().__init__(*args, **kwargs)
+
+    def to_internal_value(self, data):
+        valid = self.validate_records(data)
+        self.duplicates = 0
+
+        #Get every station referenced that is owned by request.user
+        user = self.context['request'].user
+        stations = {station.identifier: station for station in WeatherStations.objects.filter(
+            owner=user, identifier__in={values['identifier'] for index, values in valid})}
+
+        records = []
+        for index, values in valid:
+            ident = values.pop('identifier')
+            if ident not in stations:
+                self.record_errors.append({'index': index, 'errors': {'Station identifier does not exist': ident}})
+                continue
+            records.append(WeatherData(station=stations[ident], **values))
+
+        if not records:
+            raise serializers.ValidationError({'errors': self.record_errors})
+        if self.dedupe:
+            new = ingest_queue.unstored(WeatherData, records)
+            self.duplicates = len(records) - len(new)
+            records = new
+        return {'records': records}
+
+    def create(self, validated_data):
+        #With dedupe the duplicates were already left out
+        records = validated_data['records']
+        if not self.dedupe:
+            records = ingest_queue.drop_stored(WeatherData, records)
+            self.duplicates = len(validated_data['records']) - len(records)
+        if records:
+            records = ingest_queue.insert_records(WeatherData, records)
+            latest.store_weather_data(records)
+        return records
+
+    def enqueue(self):
+        #Queue the records for the drain_ingest worker instead of saving them (IOT_INGEST_MODE = 'queue')
+        self.instance = self.validated_data['records']
+        if self.instance:
+            ingest_queue.enqueue(ingest_queue.WEATHER_DATA, self.instance)
+        return self.instance
+
+    def to_representation(self, instance):
+        return {'created': len(instance), 'duplicates': self.duplicates, 'errors': self.record_errors}
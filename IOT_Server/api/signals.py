@@ -0,0 +1,65 @@
+#--- IOT_Server - api app signal handlers -------------------------------------
+
+from django.db.models.signals import post_save, post_delete, pre_save
+from django.dispatch import receiver
+from django.contrib.auth import get_user_model
+from rest_framework.authtoken.models import Token
+from api.models import Devices, Tags, ValueTypes, WeatherStations
+from api import latest, tag_cache, deadband
+from api.authentication import token_cache
+
+
+#--- Latest value store and tag metadata cache invalidation ---
+#Owner, value type or identifier changes make cached readings and tag metadata stale.
+#IotData / WeatherData deletes are not handled here, a delete receiver would stop Django
+#from fast deleting querysets. Run rebuild_latest after deleting recent readings.
+#Devices and ValueTypes cannot be deleted while tags use them (PROTECT), saves are enough.
+
+@receiver(post_save, sender=Tags)
+@receiver(post_delete, sender=Tags)
+def tag_changed(sender, instance, **kwargs):
+    latest.invalidate_tags([instance.tag_id])
+    tag_cache.invalidate([instance.tag_id])
+    #Deadband settings may have changed, the next reading starts the filter again
+    deadband.reset([instance.tag_id])
+
+
+@receiver(post_save, sender=Devices)
+def device_changed(sender, instance, **kwargs):
+    tag_ids = list(Tags.objects.filter(device=instance).values_list('tag_id', flat=True))
+    latest.invalidate_tags(tag_ids)
+    tag_cache.invalidate(tag_ids)
+
+
+@receiver(post_save, sender=ValueTypes)
+def value_type_changed(sender, instance, **kwargs):
+    tag_ids = list(Tags.objects.filter(value_type=instance).values_list('tag_id', flat=True))
+    latest.invalidate_tags(tag_ids)
+    tag_cache.invalidate(tag_ids)
+
+
+@receiver(pre_save, sender=WeatherStations)
+def station_changing(sender, instance, **kwargs):
+    #Identifier or owner may be changing, drop the entry stored under the old values
+    if instance.pk:
+        latest.invalidate_stations(WeatherStations.objects.filter(pk=instance.pk)
+                                                          .values_list('owner_id', 'identifier'))
+
+
+@receiver(post_delete, sender=WeatherStations)
+def station_deleted(sender, instance, **kwargs):
+    latest.invalidate_stations([(instance.owner_id, instance.identifier)])
+
+
+#--- Token cache invalidation ---
+#A deleted token must stop working, a deactivated user loses access through all tokens.
+
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+def token_changed(sender, instance, **kwargs):
+    token_cache.invalidate(instance.key)
+
+
+@receiver(post_save, sender=get_user_model())
+def user_changed(sender, instance, **kwargs):
+    token_cache.invalidate_user(instance.pk)
@@ -0,0 +1,60 @@
+#--- IOT_Server - api app tag metadata cache ----------------------------------
+#In-process cache of tag metadata for the ingest paths, invalidated by api.signals
+
+import threading
+import time
+from collections import namedtuple
+from django.conf import settings
+from api.models import Tags
+
+TagInfo = namedtuple('TagInfo', ('type', 'owner_id', 'deadband_type', 'deadband', 'heartbeat'))
+
+_entries = {}
+_lock = threading.Lock()
+
+
+def get_timeout():
+    return getattr(settings, 'IOT_TAG_CACHE_TIMEOUT', 300)
+
+
+def get_tags(tag_ids):
+    #Returns {tag_id: TagInfo} of the tags that exist, misses are loaded with one query
+    now = time.monotonic()
+    found = {}
+    missing = []
+    for tag_id in tag_ids:
+        entry = _entries.get(tag_id)
+        if entry is not None and entry[0] > now:
+            found[tag_id] = entry[1]
+        else:
+            missing.append(tag_id)
+
+    if missing:
+        rows = Tags.objects.filter(pk__in=missing).values_list(
+            'tag_id', 'value_type__type', 'device__owner_id', 'deadband_type', 'deadband', 'heartbeat')
+        loaded = {row[0]: TagInfo(*row[1:]) for row in rows}
+        expires = now + get_timeout()
+        with _lock:
+            _entries.update((tag_id, (expires, info)) for tag_id, info in loaded.items())
+        found.update(loaded)
+    return found
+
+
+def get_tag(tag_id):
+    #TagInfo of a tag, None if it does not exist
+    return get_tags([tag_id]).get(tag_id)
+
+
+def get_owned_types(tag_ids, owner_id):
+    #Returns {tag_id: value type} of the tags owned by owner_id
+    return {tag_id: info.type for tag_id, info in get_tags(tag_ids).items() if info.owner_id == owner_id}
+
+
+def invalidate(tag_ids=None):
+    #Drops the given tags, or every tag when None
+    with _lock:
+        if tag_ids is None:
+            _entries.clear()
+        else:
+            for tag_id in tag_ids:
+                _entries.pop(tag_id, None)
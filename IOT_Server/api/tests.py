@@ -0,0 +1,834 @@
+#--- IOT_Server - api app tests ------------------------------------------------
+
+import asyncio
+import csv
+import json
+import os
+import tempfile
+import threading
+from io import StringIO
+from datetime import datetime, timedelta
+from unittest import mock
+from decimal import Decimal
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import DatabaseError, IntegrityError
+from django.http import StreamingHttpResponse
+from django.test import override_settings
+from django.utils import dateparse, timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APITestCase
+from api.models import Devices, Tags, ValueTypes, IotData
+from api.models import WeatherStations, WeatherData, IotDataArchive, IotDataRollup
+from api.asgi import ASGIApplication
+from api.authentication import token_cache
+from api.benchmark import http_scope
+from api.device_protocol import LineIngest
+from api.renderers import FastJSONRenderer
+from api.rows import WEATHER_VALUE_FIELDS, tag_value_field, tag_data_rows, weather_data_rows
+from api.serializers import TagDataSerializer, WxDataSerializer
+from api import aggregation, archive, live, checks, dedupe, downsample, export, ingest_queue, rollups
+from api import tag_cache, latest, deadband
+
+#Rows loaded for every query count test
+ROW_COUNTS = (1, 100, 1000)
+
+
+class ApiTestCase(APITestCase):
+    def setUp(self):
+        self.clear_caches()
+        self.user = get_user_model().objects.create_user('owner')
+        self.client.force_authenticate(self.user)
+        self.value_type = ValueTypes.objects.create(value_type_id='dec', name='Decimal', type='dec')
+        self.device = Devices.objects.create(device_id='dev_0', name='Device', owner=self.user)
+        self.tag = Tags.objects.create(tag_id='tag_0', device=self.device, value_type=self.value_type, name='Tag')
+        self.station = WeatherStations.objects.create(identifier='STN_0', name='Station', owner=self.user)
+        self.start = timezone.now() - timedelta(days=1)
+
+    def clear_caches(self):
+        #Process level caches outlive test transactions, every measured request starts empty
+        tag_cache.invalidate()
+        latest.get_cache().clear()
+        token_cache.clear()
+        deadband.reset()
+
+    def seed_devices(self, count):
+        existing = Devices.objects.filter(owner=self.user).count()
+        Devices.objects.bulk_create([Devices(device_id=f'dev_{n}', name=f'Device {n}', owner=self.user)
+                                     for n in range(existing, count)])
+
+    def seed_tags(self, count):
+        existing = Tags.objects.filter(device=self.device).count()
+        Tags.objects.bulk_create([Tags(tag_id=f'tag_{n}', device=self.device, value_type=self.value_type, name=f'Tag {n}')
+                                  for n in range(existing, count)])
+
+    def seed_current(self, count):
+        #count tags with one reading each
+        self.seed_tags(count)
+        IotData.objects.bulk_create([IotData(tag=tag, timestamp=self.start, value_dec=Decimal(1))
+                                     for tag in Tags.objects.filter(device=self.device, iotdata__isnull=True)])
+
+    def seed_value_types(self, count):
+        existing = ValueTypes.objects.count()
+        ValueTypes.objects.bulk_create([ValueTypes(value_type_id=f'vt_{n}', name=f'Type {n}', type='int')
+                                        for n in range(existing, count)])
+
+    def seed_stations(self, count):
+        existing = WeatherStations.objects.filter(owner=self.user).count()
+        WeatherStations.objects.bulk_create([WeatherStations(identifier=f'STN_{n}', name=f'Station {n}', owner=self.user)
+                                             for n in range(existing, count)])
+
+    def seed_tag_data(self, count):
+        existing = IotData.objects.filter(tag=self.tag).count()
+        IotData.objects.bulk_create([IotData(tag=self.tag, timestamp=self.start + timedelta(seconds=n),
+                                             value_dec=Decimal(n % 100)) for n in range(existing, count)])
+
+    def seed_weather_data(self, count):
+        existing = WeatherData.objects.filter(station=self.station).count()
+        WeatherData.objects.bulk_create([WeatherData(station=self.station, timestamp=self.start + timedelta(seconds=n),
+                                                     temperature=Decimal(n % 40)) for n in range(existing, count)])
+
+    def assertQueriesAtRowCounts(self, queries, seed, url, items=None):
+        #GET url returns every seeded row (or items(count) entries) with the same number of queries at each count
+        for count in ROW_COUNTS:
+            seed(count)
+            self.clear_caches()
+            with self.subTest(rows=count), self.assertNumQueries(queries):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.data), count if items is None else items(count))
+
+
+class ListQueryCountTests(ApiTestCase):
+    """
+    Every list view reads its related rows in a fixed number of queries, however many rows it returns.
+    Authentication is forced, so only the queries of the view are counted.
+    """
+
+    def test_device_list(self):
+        self.assertQueriesAtRowCounts(1, self.seed_devices, '/device/list/')
+
+    def test_device_tag_list(self):
+        #Devices, then their tags in one prefetch query
+        self.assertQueriesAtRowCounts(2, self.seed_tags, '/device/tag/', items=lambda count: 1)
+
+    def test_tag_list(self):
+        self.assertQueriesAtRowCounts(1, self.seed_tags, '/tag/list/')
+
+    def test_value_type_list(self):
+        self.assertQueriesAtRowCounts(1, self.seed_value_types, '/valuetype/')
+
+    def test_tag_data_list(self):
+        #Tag metadata, the page of rows and the archive blocks of the span
+        self.assertQueriesAtRowCounts(3, self.seed_tag_data, '/data/list/tag_0/?max=1000')
+
+    def test_tag_data_current_snapshot(self):
+        #Owned tags, then the ids and the records of the last reading of each tag
+        self.assertQueriesAtRowCounts(3, self.seed_current, '/data/current/')
+
+    def test_station_list(self):
+        self.assertQueriesAtRowCounts(1, self.seed_stations, '/weatherstation/list/')
+
+    def test_weather_data_list(self):
+        self.assertQueriesAtRowCounts(1, self.seed_weather_data, '/weatherdata/list/STN_0/?max=1000')
+
+
+class ObjectQueryCountTests(ApiTestCase):
+    """
+    Object checks and single station reads run a fixed number of queries, missing and foreign
+    objects included. Authentication is forced unless the test authenticates with a token.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.other = get_user_model().objects.create_user('other')
+        self.other_device = Devices.objects.create(device_id='other_dev', name='Other', owner=self.other)
+        self.other_tag = Tags.objects.create(tag_id='other_tag', device=self.other_device,
+                                             value_type=self.value_type, name='Other')
+        self.other_station = WeatherStations.objects.create(identifier='OTHER', name='Other', owner=self.other)
+
+    def assertQueries(self, queries, url, status_code):
+        self.clear_caches()
+        with self.assertNumQueries(queries):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status_code)
+        return response
+
+    def test_is_owner(self):
+        #The object with its owner in one query, IsOwner compares ids
+        for url, other_url in (('/device/edit/dev_0/', '/device/edit/other_dev/'),
+                               ('/tag/edit/tag_0/', '/tag/edit/other_tag/'),
+                               ('/weatherstation/edit/STN_0/', '/weatherstation/edit/OTHER/')):
+            with self.subTest(url=url):
+                self.assertQueries(1, url, 200)
+                self.assertQueries(1, other_url, 403)
+
+    def test_is_owner_missing(self):
+        for url in ('/device/edit/missing/', '/tag/edit/missing/', '/weatherstation/edit/missing/'):
+            with self.subTest(url=url):
+                self.assertQueries(1, url, 404)
+
+    def test_weather_data_list(self):
+        self.seed_weather_data(10)
+        response = self.assertQueries(1, '/weatherdata/list/STN_0/', 200)
+        self.assertEqual(len(response.data), 10)
+
+    def test_weather_data_list_empty(self):
+        #An empty page, then the station check
+        response = self.assertQueries(2, '/weatherdata/list/STN_0/', 200)
+        self.assertEqual(response.data, [])
+
+    def test_weather_data_list_missing(self):
+        for identifier in ('missing', 'OTHER'):
+            with self.subTest(identifier=identifier):
+                response = self.assertQueries(2, f'/weatherdata/list/{identifier}/', 400)
+                self.assertIn('Station identifier does not exist', response.data)
+
+    def test_weather_data_current(self):
+        self.seed_weather_data(10)
+        response = self.assertQueries(1, '/weatherdata/current/STN_0/', 200)
+        self.assertEqual(len(response.data), 1)
+        #Served from the latest value store once stored
+        with self.assertNumQueries(0):
+            cached = self.client.get('/weatherdata/current/STN_0/')
+        self.assertEqual(cached.data, response.data)
+
+    def test_weather_data_current_empty(self):
+        response = self.assertQueries(2, '/weatherdata/current/STN_0/', 200)
+        self.assertEqual(response.data, [])
+
+    def test_weather_data_current_missing(self):
+        for identifier in ('missing', 'OTHER'):
+            with self.subTest(identifier=identifier):
+                response = self.assertQueries(2, f'/weatherdata/current/{identifier}/', 400)
+                self.assertIn('Station identifier does not exist', response.data)
+
+    def test_token_authentication(self):
+        #One query for the token and its user on a cache miss, none once cached
+        token = Token.objects.create(user=self.user)
+        self.client.force_authenticate(None)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+        self.seed_weather_data(10)
+        self.assertQueries(2, '/weatherdata/list/STN_0/', 200)
+        self.assertQueries(2, '/device/edit/dev_0/', 200)
+        with self.assertNumQueries(1):
+            self.client.get('/weatherdata/list/STN_0/')
+
+
+class TokenCacheTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(None)
+        self.token = Token.objects.create(user=self.user)
+
+    def get(self, token):
+        #Rejected credentials are answered with 403, session authentication comes first
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+        return self.client.get('/device/list/').status_code
+
+    def assertCached(self, token):
+        self.assertEqual(self.get(token), 200)
+        self.assertIsNotNone(token_cache.get(token.key))
+
+    def test_deleted_token(self):
+        self.assertCached(self.token)
+        self.token.delete()
+        self.assertEqual(self.get(self.token), 403)
+
+    def test_regenerated_token(self):
+        self.assertCached(self.token)
+        self.token.delete()
+        new_token = Token.objects.create(user=self.user)
+        self.assertEqual(self.get(self.token), 403)
+        self.assertCached(new_token)
+
+    def test_deactivated_user(self):
+        self.assertCached(self.token)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.get(self.token), 403)
+
+
+class IngestQueueTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        spool = tempfile.TemporaryDirectory()
+        self.addCleanup(spool.cleanup)
+        self.spool = os.path.join(spool.name, 'spool.sqlite3')
+
+    def test_queue_mode_needs_shared_latest_store(self):
+        with override_settings(IOT_INGEST_MODE='queue'):
+            self.assertIn('api.E001', [message.id for message in checks.check_ingest_queue_cache(None)])
+        self.assertEqual(checks.check_ingest_queue_cache(None), [])
+
+    def test_enqueue_max_depth(self):
+        records = [IotData(tag=self.tag, timestamp=self.start + timedelta(seconds=n), value_dec=Decimal(n))
+                   for n in range(2)]
+        with override_settings(IOT_INGEST_SPOOL=self.spool, IOT_INGEST_MAX_DEPTH=3):
+            ingest_queue.enqueue(ingest_queue.TAG_DATA, records)
+            with self.assertRaises(ingest_queue.QueueFull):
+                ingest_queue.enqueue(ingest_queue.TAG_DATA, records)
+            ingest_queue.enqueue(ingest_queue.TAG_DATA, records[:1])
+            self.assertEqual(ingest_queue.depth(), 3)
+
+
+class BatchIngestTests(ApiTestCase):
+    def test_tag_batch_record_errors(self):
+        other = get_user_model().objects.create_user('other')
+        other_device = Devices.objects.create(device_id='other_dev', name='Other', owner=other)
+        Tags.objects.create(tag_id='other_tag', device=other_device, value_type=self.value_type, name='Other')
+        response = self.client.post('/data/add/batch/', [
+            {'tag': 'tag_0', 'value': '1.5', 'timestamp': '2020-07-04T11:54:00Z'},
+            {'tag': 'tag_0', 'value': 'high'},
+            'not a record',
+            {'value': '2'},
+            {'tag': 'other_tag', 'value': '3'},
+            {'tag': 'tag_0', 'value': '4', 'timestamp': 'yesterday'},
+        ], format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['created'], 1)
+        errors = {error['index']: error['errors'] for error in response.data['errors']}
+        self.assertEqual(list(errors), [1, 2, 3, 4, 5])
+        self.assertIn('non_field_errors', errors[2])
+        self.assertIn('tag', errors[3])
+        self.assertEqual(errors[4], {'tag': ['Invalid pk "other_tag" - object does not exist.']})
+        self.assertIn('timestamp', errors[5])
+        self.assertEqual(list(IotData.objects.values_list('tag', 'value_dec')), [('tag_0', Decimal('1.5'))])
+
+        #Nothing valid
+        response = self.client.post('/data/add/batch/', [{'tag': 'other_tag', 'value': '3'}], format='json')
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(IOT_BATCH_MAX_RECORDS=2)
+    def test_max_records(self):
+        for url, record in (('/data/add/batch/', {'tag': 'tag_0', 'value': '1'}),
+                            ('/weatherdata/add/batch/', {'identifier': 'STN_0', 'temperature': '20'})):
+            self.assertEqual(self.client.post(url, [record] * 2, format='json').status_code, 201)
+            response = self.client.post(url, [record] * 3, format='json')
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.data['non_field_errors'], ['Maximum of 2 records per request exceeded.'])
+
+    def test_weather_batch(self):
+        WeatherData.objects.create(station=self.station, timestamp=dateparse.parse_datetime('2020-07-04T11:54:00Z'),
+                                   temperature=Decimal(1))
+        response = self.client.post('/weatherdata/add/batch/?dedupe=true', [
+            {'identifier': ' STN_0 ', 'temperature': '20', 'timestamp': '2020-07-04T11:55:00Z'},
+            {'identifier': 'STN_0', 'temperature': '21', 'timestamp': '2020-07-04T11:55:00Z'},
+            {'identifier': 'STN_0', 'temperature': '22', 'timestamp': '2020-07-04T11:54:00Z'},
+            {'identifier': 'NONE', 'temperature': '23', 'timestamp': '2020-07-04T11:56:00Z'},
+        ], format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual((response.data['created'], response.data['duplicates']), (1, 2))
+        self.assertEqual([error['index'] for error in response.data['errors']], [3])
+        self.assertEqual(list(WeatherData.objects.order_by('timestamp').values_list('temperature', flat=True)),
+                         [Decimal(1), Decimal(20)])
+
+        response = self.client.post('/weatherdata/add/batch/', [
+            {'identifier': 'STN_0', 'temperature': 'warm'},
+            'not a record',
+            {'temperature': '20'},
+            {'identifier': 'STN_0', 'temperature': '24'},
+        ], format='json')
+        self.assertEqual(response.status_code, 201)
+        errors = {error['index']: error['errors'] for error in response.data['errors']}
+        self.assertEqual(list(errors), [0, 1, 2])
+        self.assertEqual((list(errors[0]), list(errors[1]), list(errors[2])),
+                         (['temperature'], ['non_field_errors'], ['identifier']))
+
+
+class LineIngestTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.token = Token.objects.create(user=self.user)
+        #Test transactions keep the connection open, as the test client does for requests
+        patcher = mock.patch('api.device_protocol.close_old_connections')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.errors = []
+        self.ingest = LineIngest(10, self.errors.append)
+        self.replies = []
+
+    def test_replies_after_flush(self):
+        self.ingest.handle_lines([f'{self.token.key} tag_0 1.5', 'bad', f'{self.token.key} tag_0 x'],
+                                 self.replies.append)
+        self.assertEqual(self.replies, [])
+        self.assertEqual(self.ingest.flush(), (1, []))
+        self.assertEqual(self.replies, [['OK', 'ERR Expected: token tag value [timestamp]',
+                                         'ERR Numeric value required.']])
+        self.assertEqual(IotData.objects.count(), 1)
+
+    def test_failed_flush_replies_error(self):
+        self.ingest.handle_lines([f'{self.token.key} tag_0 1.5'], self.replies.append)
+        with mock.patch('api.ingest_queue.save_records', side_effect=DatabaseError('gone away')):
+            saved, failed = self.ingest.flush()
+        self.assertEqual(saved, 0)
+        self.assertEqual(self.replies, [['ERR Server error.']])
+        self.assertEqual(len(self.errors), 1)
+
+    def test_unexpected_error_replies_error(self):
+        with mock.patch('api.tag_cache.get_tag', side_effect=DatabaseError('gone away')):
+            self.ingest.handle_lines([f'{self.token.key} tag_0 1.5'], self.replies.append)
+        self.assertEqual(self.replies, [['ERR Server error.']])
+        self.assertEqual(len(self.errors), 1)
+
+    def test_queue_mode(self):
+        spool = tempfile.TemporaryDirectory()
+        self.addCleanup(spool.cleanup)
+        with override_settings(IOT_INGEST_MODE='queue', IOT_INGEST_SPOOL=os.path.join(spool.name, 'spool.sqlite3')):
+            self.ingest.handle_lines([f'{self.token.key} tag_0 1.5'], self.replies.append)
+            self.assertEqual(self.ingest.flush(), (1, []))
+            self.assertEqual(ingest_queue.depth(), 1)
+        self.assertEqual(self.replies, [['OK']])
+        self.assertEqual(IotData.objects.count(), 0)
+
+
+class ArchiveTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.day = (timezone.now() - timedelta(days=100)).date()
+        self.begin = datetime(self.day.year, self.day.month, self.day.day, tzinfo=timezone.utc)
+        IotData.objects.bulk_create([IotData(tag=self.tag, timestamp=self.begin + timedelta(minutes=n),
+                                             value_dec=Decimal(n)) for n in range(120)])
+
+    def rollup_rows(self):
+        return list(IotDataRollup.objects.filter(tag=self.tag).order_by('interval', 'bucket')
+                    .values_list('interval', 'bucket', 'count', 'value_min', 'value_max', 'value_sum', 'value_last'))
+
+    def test_mixed_day_is_left_live(self):
+        IotData.objects.create(tag=self.tag, timestamp=self.begin, value_int=1)
+        with self.assertRaises(archive.MixedValues):
+            archive.archive_day(self.tag.pk, 'dec', self.day)
+        self.assertEqual(IotData.objects.count(), 121)
+        self.assertFalse(IotDataArchive.objects.exists())
+
+    def test_rollups_read_archived_records(self):
+        rollups.backfill(rollups.TAG_DATA)
+        expected = self.rollup_rows()
+        self.assertEqual(archive.archive_day(self.tag.pk, 'dec', self.day), 120)
+
+        #Rebuild after archiving, then a late reading in an archived hour
+        IotDataRollup.objects.all().delete()
+        rollups.backfill(rollups.TAG_DATA)
+        self.assertEqual(self.rollup_rows(), expected)
+        IotData.objects.create(tag=self.tag, timestamp=self.begin + timedelta(minutes=30, seconds=1),
+                               value_dec=Decimal(500))
+        rollups.recompute_tag(self.tag.pk, 'dec', [int(self.begin.timestamp()) + 1800])
+        hour = IotDataRollup.objects.get(tag=self.tag, interval='1h', bucket=self.begin)
+        self.assertEqual((hour.count, hour.value_max, hour.value_sum), (61, Decimal(500), Decimal(sum(range(60)) + 500)))
+
+    def test_export_and_current_read_archived_records(self):
+        archive.archive_day(self.tag.pk, 'dec', self.day)
+        IotData.objects.create(tag=self.tag, timestamp=self.begin + timedelta(minutes=30, seconds=1),
+                               value_dec=Decimal(500))
+        response = self.client.get('/data/export/tag_0/', {'output': 'ndjson'})
+        values = [json.loads(line)['value'] for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(values, [f'{n}.000' for n in range(31)] + ['500.000'] + [f'{n}.000' for n in range(31, 120)])
+
+        #Only archived history, the live record is the newest otherwise
+        self.assertEqual(self.client.get('/data/current/tag_0/').data[0]['value'], '500.000')
+        IotData.objects.all().delete()
+        latest.get_cache().clear()
+        self.assertEqual(self.client.get('/data/current/tag_0/').data[0]['value'], '119.000')
+        latest.get_cache().clear()
+        self.assertEqual([item['value'] for item in self.client.get('/data/current/').data], ['119.000'])
+
+
+class PaginationTests(ApiTestCase):
+    def walk(self, url):
+        #Values of every page following the Link headers
+        values = []
+        response = self.client.get(url, {'max': 4})
+        while True:
+            self.assertEqual(response.status_code, 200)
+            values += [item.get('value', item.get('temperature')) for item in response.data]
+            if not response.has_header('Link'):
+                return values
+            response = self.client.get(response['Link'][1:response['Link'].index('>')])
+
+    def test_tag_data_walk(self):
+        #Records three to a timestamp, one day archived with late records in it
+        day = (timezone.now() - timedelta(days=100)).date()
+        begin = datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+        IotData.objects.bulk_create([IotData(tag=self.tag, timestamp=begin + timedelta(minutes=n // 3),
+                                             value_dec=Decimal(n)) for n in range(30)])
+        archive.archive_day(self.tag.pk, 'dec', day)
+        IotData.objects.bulk_create([IotData(tag=self.tag, timestamp=begin + timedelta(minutes=(n - 30) // 3),
+                                             value_dec=Decimal(n)) for n in range(30, 36)])
+        IotData.objects.bulk_create([IotData(tag=self.tag, timestamp=self.start + timedelta(minutes=n // 3),
+                                             value_dec=Decimal(n)) for n in range(36, 50)])
+        values = self.walk('/data/list/tag_0/')
+        self.assertEqual(sorted(values, key=float), [f'{n}.000' for n in range(50)])
+        #Archived records before the late ones at the same timestamp, they have the lower ids
+        self.assertEqual(values[:6], ['0.000', '1.000', '2.000', '30.000', '31.000', '32.000'])
+
+    def test_weather_data_walk(self):
+        WeatherData.objects.bulk_create([WeatherData(station=self.station, temperature=Decimal(n),
+                                                     timestamp=self.start + timedelta(minutes=n // 3))
+                                         for n in range(25)])
+        self.assertEqual(self.walk('/weatherdata/list/STN_0/'), [f'{n}.00' for n in range(25)])
+
+
+@override_settings(IOT_EXPORT_CHUNK_SIZE=3)
+class ExportTests(ApiTestCase):
+    def export(self, url, output):
+        response = self.client.get(url, {'output': output})
+        self.assertEqual(response.status_code, 200)
+        content = b''.join(response.streaming_content).decode()
+        if output == 'csv':
+            return list(csv.DictReader(StringIO(content)))
+        return [json.loads(line) for line in content.splitlines()]
+
+    def test_tag_data(self):
+        #Two records per timestamp, so chunks also end between equal timestamps
+        IotData.objects.bulk_create([IotData(tag=self.tag, timestamp=self.start + timedelta(seconds=n // 2),
+                                             value_dec=None if n % 4 == 1 else Decimal(n)) for n in range(10)])
+        expected = [None if n % 4 == 1 else f'{n}.000' for n in range(10)]
+        self.assertEqual([row['value'] for row in self.export('/data/export/tag_0/', 'ndjson')], expected)
+        #csv has no null, it is written empty
+        self.assertEqual([row['value'] for row in self.export('/data/export/tag_0/', 'csv')],
+                         [value or '' for value in expected])
+
+    def test_weather_data(self):
+        WeatherData.objects.bulk_create([WeatherData(station=self.station, timestamp=self.start + timedelta(seconds=n),
+                                                     temperature=None if n % 3 == 0 else Decimal(n), wind_dir=n)
+                                         for n in range(7)])
+        for output, null in (('ndjson', None), ('csv', '')):
+            rows = self.export('/weatherdata/export/STN_0/', output)
+            self.assertEqual([(row['temperature'], str(row['wind_dir'])) for row in rows],
+                             [(null if n % 3 == 0 else f'{n}.00', str(n)) for n in range(7)])
+            self.assertEqual(list(rows[0]), list(export.WEATHER_COLUMNS))
+
+
+class RollupTests(ApiTestCase):
+    def test_backfill_composes_intervals_and_skips_empty_days(self):
+        begin = datetime(2020, 7, 4, tzinfo=timezone.utc)
+        IotData.objects.bulk_create([IotData(tag=self.tag, timestamp=begin + timedelta(days=days, minutes=n * 4),
+                                             value_dec=Decimal(n % 13)) for days in (0, 10) for n in range(300)])
+        with mock.patch('api.rollups.recompute_tag', wraps=rollups.recompute_tag) as recompute_tag:
+            rollups.backfill(rollups.TAG_DATA)
+        self.assertEqual(recompute_tag.call_count, 2)
+
+        raw = IotData.objects.filter(tag=self.tag)
+        for interval in rollups.ROLLUP_INTERVALS:
+            expected = [(bucket, values['value_dec']) for bucket, values in aggregation.aggregate_buckets(
+                raw, aggregation.INTERVALS[interval], ['value_dec'], rollups.ROLLUP_FUNCTIONS, None)]
+            rows = IotDataRollup.objects.filter(tag=self.tag, interval=interval).order_by('bucket')
+            self.assertEqual([(int(row.bucket.timestamp()), {'min': row.value_min, 'max': row.value_max,
+                                                             'sum': row.value_sum, 'count': row.count,
+                                                             'last': row.value_last}) for row in rows], expected)
+
+    def test_rollup_buckets_have_raw_value_types(self):
+        value_type = ValueTypes.objects.create(value_type_id='int', name='int', type='int')
+        Tags.objects.create(tag_id='tag_int', device=self.device, value_type=value_type, name='Int')
+        begin = datetime(2020, 7, 4, tzinfo=timezone.utc)
+        IotData.objects.bulk_create([IotData(tag_id='tag_int', timestamp=begin + timedelta(minutes=n),
+                                             value_int=n * 3 % 7) for n in range(120)])
+        WeatherData.objects.bulk_create([WeatherData(station=self.station, timestamp=begin + timedelta(minutes=n),
+                                                     temperature=Decimal(n) / 4, wind_dir=n) for n in range(120)])
+        rollups.backfill(rollups.TAG_DATA)
+        rollups.backfill(rollups.WEATHER_DATA)
+        params = {'interval': '1h', 'begin': begin.isoformat(), 'before': (begin + timedelta(hours=2)).isoformat(),
+                  'functions': 'min,max,avg,count,last'}
+        for url in ('/data/aggregate/tag_int/', '/weatherdata/aggregate/STN_0/'):
+            with mock.patch('api.rollups.tag_buckets', wraps=rollups.tag_buckets) as tag_buckets, \
+                    mock.patch('api.rollups.station_buckets', wraps=rollups.station_buckets) as station_buckets:
+                rolled = self.client.get(url, params)
+            self.assertEqual(tag_buckets.call_count + station_buckets.call_count, 1)
+            with override_settings(IOT_ROLLUPS_ENABLED=False):
+                raw = self.client.get(url, params)
+            self.assertEqual(rolled.content, raw.content, url)
+
+
+class DownsampleTests(ApiTestCase):
+    def rows(self, values):
+        return [(self.start + timedelta(seconds=n), n + 1, value) for n, value in enumerate(values)]
+
+    def test_lttb(self):
+        rows = self.rows([Decimal((n * 37) % 101) for n in range(1000)])
+        sampled = list(downsample.lttb(rows, len(rows), 50))
+        self.assertLessEqual(len(sampled), 50)
+        self.assertEqual((sampled[0], sampled[-1]), (rows[0], rows[-1]))
+        self.assertEqual(sampled, sorted(sampled))
+
+    def test_minmax_keeps_bucket_extremes(self):
+        rows = self.rows([Decimal(n % 7) for n in range(100)])
+        rows[13] = rows[13][:2] + (Decimal(-5),)
+        rows[61] = rows[61][:2] + (Decimal(50),)
+        sampled = list(downsample.minmax(rows, len(rows), 10))
+        self.assertLessEqual(len(sampled), 10)
+        #5 buckets of 20 rows
+        for begin in range(0, 100, 20):
+            bucket = rows[begin:begin + 20]
+            self.assertIn(min(bucket, key=lambda row: row[2]), sampled)
+            self.assertIn(max(bucket, key=lambda row: row[2]), sampled)
+        self.assertIn(rows[13], sampled)
+        self.assertIn(rows[61], sampled)
+
+    def test_points(self):
+        IotData.objects.bulk_create([IotData(tag=self.tag, timestamp=self.start + timedelta(seconds=n),
+                                             value_dec=None if n % 10 == 3 else Decimal(n % 17))
+                                     for n in range(500)])
+        values = IotData.objects.filter(tag=self.tag, value_dec__isnull=False).order_by('timestamp')
+        first, last = values.first(), values.last()
+        for method in downsample.METHODS:
+            data = self.client.get('/data/list/tag_0/', {'points': 20, 'downsample': method}).data
+            self.assertLessEqual(len(data), 20)
+            self.assertNotIn('None', [item['value'] for item in data])
+            if method == 'lttb':
+                self.assertEqual((data[0]['value'], data[-1]['value']),
+                                 (f'{first.value_dec:.3f}', f'{last.value_dec:.3f}'))
+                self.assertEqual((dateparse.parse_datetime(data[0]['timestamp']),
+                                  dateparse.parse_datetime(data[-1]['timestamp'])), (first.timestamp, last.timestamp))
+            else:
+                self.assertIn('16.000', [item['value'] for item in data])
+                self.assertIn('0.000', [item['value'] for item in data])
+
+
+class RowRenderingTests(ApiTestCase):
+    def test_rows_render_like_the_serializers(self):
+        cases = {'int': [5, -3, None], 'dec': [Decimal('1.5'), Decimal('-0.125'), None],
+                 'bool': [True, False, None], 'string': ['text', '', None]}
+        for tag_type, values in cases.items():
+            value_type = ValueTypes.objects.create(value_type_id=f'vt_{tag_type}', name=tag_type, type=tag_type)
+            tag = Tags.objects.create(tag_id=f'tag_{tag_type}', device=self.device, value_type=value_type)
+            field = tag_value_field(tag_type)
+            IotData.objects.bulk_create([IotData(tag=tag, timestamp=self.start + timedelta(seconds=n), **{field: value})
+                                         for n, value in enumerate(values)])
+            records = IotData.objects.filter(tag=tag).order_by('timestamp', 'pk')
+            expected = JSONRenderer().render(TagDataSerializer(records.select_related('tag__value_type'),
+                                                               many=True).data)
+            rendered = FastJSONRenderer().render(tag_data_rows(records.values_list('timestamp', 'pk', field),
+                                                               tag.tag_id, tag_type))
+            self.assertEqual(json.loads(rendered), json.loads(expected), tag_type)
+
+        WeatherData.objects.bulk_create([
+            WeatherData(station=self.station, timestamp=self.start, temperature=Decimal('20.5'), wind_dir=270),
+            WeatherData(station=self.station, timestamp=self.start + timedelta(seconds=1), pressure=Decimal('1013.2'))])
+        records = WeatherData.objects.filter(station=self.station).order_by('timestamp', 'pk')
+        expected = JSONRenderer().render(WxDataSerializer(records.select_related('station'), many=True).data)
+        rendered = FastJSONRenderer().render(weather_data_rows(
+            records.values_list('timestamp', 'pk', *WEATHER_VALUE_FIELDS), self.station.identifier))
+        self.assertEqual(json.loads(rendered), json.loads(expected))
+
+
+class DuplicateReadingTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.timestamp = '2020-07-04T11:54:00Z'
+        IotData.objects.bulk_create([IotData(tag=self.tag, timestamp=dateparse.parse_datetime(self.timestamp),
+                                             value_dec=Decimal(n)) for n in (1, 2, 3)])
+
+    def add_constraint(self):
+        call_command('dedupe_history', '--add-constraint', stdout=StringIO())
+
+    def test_dry_run(self):
+        out = StringIO()
+        call_command('dedupe_history', '--dry-run', stdout=out)
+        self.assertIn('api_iotdata: 2 duplicate records found.', out.getvalue())
+        self.assertEqual(IotData.objects.count(), 3)
+
+    def test_dedupe_keeps_first_and_adds_index(self):
+        self.add_constraint()
+        self.assertEqual(list(IotData.objects.values_list('value_dec', flat=True)), [Decimal(1)])
+        self.assertTrue(dedupe.has_unique_index(IotData))
+        self.assertTrue(dedupe.has_unique_index(WeatherData))
+        call_command('dedupe_history', '--drop-constraint', stdout=StringIO())
+        self.assertFalse(dedupe.has_unique_index(IotData))
+
+    def test_duplicate_conflict(self):
+        self.add_constraint()
+        response = self.client.post('/data/add/', {'tag': 'tag_0', 'value': '5', 'timestamp': self.timestamp},
+                                    format='json')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(IotData.objects.count(), 1)
+
+    def test_other_integrity_error_is_not_a_conflict(self):
+        error = IntegrityError('FOREIGN KEY constraint failed')
+        with mock.patch('api.serializers.ingest_queue.insert_records', side_effect=error), \
+                self.assertRaises(IntegrityError):
+            self.client.post('/data/add/', {'tag': 'tag_0', 'value': '5'}, format='json')
+
+    def test_ignored_duplicate_keeps_current_value(self):
+        self.add_constraint()
+        with override_settings(IOT_INGEST_IGNORE_DUPLICATES=True):
+            response = self.client.post('/data/add/', {'tag': 'tag_0', 'value': '5', 'timestamp': self.timestamp},
+                                        format='json')
+            self.assertEqual(response.status_code, 201)
+            response = self.client.post('/data/add/batch/', [
+                {'tag': 'tag_0', 'value': '6', 'timestamp': self.timestamp},
+                {'tag': 'tag_0', 'value': '7', 'timestamp': '2020-07-04T11:55:00Z'},
+                {'tag': 'tag_0', 'value': '8', 'timestamp': '2020-07-04T11:55:00Z'},
+            ], format='json')
+            self.assertEqual(response.data['created'], 1)
+        self.assertEqual(list(IotData.objects.order_by('timestamp').values_list('value_dec', flat=True)),
+                         [Decimal(1), Decimal(7)])
+        self.assertEqual(self.client.get('/data/current/tag_0/').data[0]['value'], '7.000')
+
+
+@override_settings(IOT_LIVE_POLL_INTERVAL=0)
+class PartitionTests(ApiTestCase):
+    def test_partitions_need_mysql(self):
+        self.assertEqual(checks.check_partitions(None), [])
+        with override_settings(IOT_PARTITIONS=True):
+            self.assertIn('api.W002', [message.id for message in checks.check_partitions(None)])
+            with self.assertRaises(CommandError):
+                call_command('maintain_partitions', setup=True, stdout=StringIO())
+        with self.assertRaises(CommandError):
+            call_command('maintain_partitions', setup=True, stdout=StringIO())
+
+
+class DeadbandTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tag.deadband_type = 'abs'
+        self.tag.deadband = Decimal('0.5')
+        self.tag.save()
+
+    def post(self, value, seconds):
+        return self.client.post('/data/add/', {'tag': 'tag_0', 'value': value,
+                                               'timestamp': (self.start + timedelta(seconds=seconds)).isoformat()},
+                                format='json')
+
+    def stored(self):
+        return list(IotData.objects.order_by('timestamp').values_list('value_dec', flat=True))
+
+    def test_deadband(self):
+        self.assertEqual(self.post('1.0', 0).status_code, 201)
+        self.assertEqual(self.post('1.4', 1).status_code, 200)
+        self.assertEqual(self.stored(), [Decimal('1.0')])
+        self.assertEqual(self.post('1.6', 2).status_code, 201)
+        self.assertEqual(self.stored(), [Decimal('1.0'), Decimal('1.6')])
+
+        response = self.client.post('/data/add/batch/', [
+            {'tag': 'tag_0', 'value': '1.7', 'timestamp': (self.start + timedelta(seconds=3)).isoformat()},
+            {'tag': 'tag_0', 'value': '0.5', 'timestamp': (self.start + timedelta(seconds=4)).isoformat()},
+        ], format='json')
+        self.assertEqual((response.data['created'], response.data['suppressed']), (1, 1))
+
+    def test_first_reading_after_restart_is_stored(self):
+        self.assertEqual(self.post('1.0', 0).status_code, 201)
+        deadband.reset()
+        self.assertEqual(self.post('1.1', 1).status_code, 201)
+        self.assertEqual(self.stored(), [Decimal('1.0'), Decimal('1.1')])
+
+
+class LiveDataTests(ApiTestCase):
+    def get(self, since=None):
+        params = {'tags': 'tag_0', 'stations': 'STN_0', 'timeout': 0}
+        if since is not None:
+            params['since'] = since
+        response = self.client.get('/live/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_reset_without_cursor(self):
+        self.client.post('/data/add/', {'tag': 'tag_0', 'value': '1.5'}, format='json')
+        data = self.get()
+        self.assertTrue(data['reset'])
+        self.assertEqual([item['value'] for item in data['data']], ['1.500'])
+        self.assertTrue(self.get('other:5')['reset'])
+
+    def test_cursor_is_valid_across_processes(self):
+        cursor = self.get()['cursor']
+        #Rows saved by another process, nothing is published in this one
+        IotData.objects.create(tag=self.tag, timestamp=self.start, value_dec=Decimal(2))
+        WeatherData.objects.create(station=self.station, timestamp=self.start + timedelta(seconds=1),
+                                   temperature=Decimal(20))
+        data = self.get(cursor)
+        self.assertFalse(data['reset'])
+        self.assertEqual([item.get('value', item.get('temperature')) for item in data['data']], ['2.000', '20.00'])
+        self.assertEqual(self.get(data['cursor'])['data'], [])
+
+    def test_poller_reads_for_all_watchers(self):
+        hub = live.Hub()
+        #Polled by the test, a poller thread does not see the test transaction
+        hub.poller = poller = live.Poller(hub)
+        keys = [live.tag_key('tag_0'), live.station_key(self.user.pk, 'STN_0')]
+        events = [hub.subscribe(keys) for i in range(3)]
+        with mock.patch.object(live, 'hub', hub):
+            poller.begin()
+            poller.poll(keys)
+            cursor = live.read(keys, None)[1]
+            first = IotData.objects.create(tag=self.tag, timestamp=self.start, value_dec=Decimal(1))
+            IotData.objects.create(tag=self.tag, timestamp=self.start + timedelta(seconds=1), value_dec=Decimal(2))
+            late_pk = first.pk
+            first.delete()
+            poller.poll(keys)
+            self.assertTrue(all(event.is_set() for event in events))
+            with self.assertNumQueries(0):
+                results = [live.read(keys, cursor) for event in events]
+            self.assertEqual({tuple(item['value'] for item in data) for data, cursor, reset in results}, {('2.000',)})
+
+            #Committed after the row with the higher id was read
+            IotData.objects.create(pk=late_pk, tag=self.tag, timestamp=self.start, value_dec=Decimal(1))
+            poller.poll(keys)
+            data, cursor, reset = live.read(keys, results[0][1])
+            self.assertEqual([item['value'] for item in data], ['1.000'])
+            self.assertEqual(live.read(keys, cursor)[0], [])
+
+
+class AsyncViewTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+        self.application = ASGIApplication()
+
+    def call(self, method, path, body=b'', headers=()):
+        response = {'body': b''}
+
+        async def receive():
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                response['status'] = message['status']
+            else:
+                response['body'] += message.get('body', b'')
+
+        scope = http_scope(method, path, 'key', 'application/json')
+        scope['headers'] += list(headers)
+        self.loop.run_until_complete(self.application(scope, receive, send))
+        return response
+
+    def test_authentication_error(self):
+        with mock.patch('api.async_views.get_token_user', side_effect=DatabaseError('gone away')), \
+                self.assertLogs('django.request', 'ERROR'):
+            response = self.call('GET', '/data/current/tag_0/')
+        self.assertEqual((response['status'], response['body']), (500, b'<h1>Server Error (500)</h1>'))
+
+    def test_save_error(self):
+        with mock.patch('api.async_views.get_cached_token_user', return_value=self.user), \
+                mock.patch('api.views.save_tag_data', side_effect=DatabaseError('gone away')), \
+                self.assertLogs('django.request', 'ERROR'):
+            response = self.call('POST', '/data/add/', b'{"tag": "tag_0", "value": "1"}')
+        self.assertEqual((response['status'], response['body']), (500, b'<h1>Server Error (500)</h1>'))
+
+    @override_settings(IOT_ASGI_MAX_BODY_SIZE=10)
+    def test_body_too_large(self):
+        self.assertEqual(self.call('POST', '/data/add/', b'{}', [(b'content-length', b'11')])['status'], 413)
+        self.assertEqual(self.call('POST', '/data/add/', b'{"tag": "tag_0"}')['status'], 413)
+
+    @override_settings(ALLOWED_HOSTS=['testserver'])
+    def test_disallowed_host(self):
+        with mock.patch('api.async_views.get_cached_token_user') as get_cached_token_user, \
+                self.assertLogs('django.security.DisallowedHost', 'ERROR'):
+            response = self.call('GET', '/data/current/tag_0/', headers=[(b'host', b'evil.example')])
+        self.assertEqual(response['status'], 400)
+        get_cached_token_user.assert_not_called()
+
+    def test_stream_threads_are_bounded(self):
+        def wsgi(environ, start_response):
+            response = StreamingHttpResponse(iter([b'data']))
+            start_response('200 OK', list(response.items()))
+            return response
+
+        self.application.wsgi = wsgi
+        slots = threading.BoundedSemaphore(1)
+        with mock.patch('api.asgi.get_stream_slots', return_value=slots):
+            self.assertEqual(self.call('GET', '/data/export/tag_0/')['body'], b'data')
+            slots.acquire()
+            self.assertEqual(self.call('GET', '/data/export/tag_0/')['status'], 503)
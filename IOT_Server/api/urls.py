@@ -21,14 +21,22 @@ urlpatterns_include = [
     path('tag/edit/<pk>/', views.TagDetail.as_view()),
     path('tag/list/', views.TagList.as_view()),
     path('data/add/', views.TagData.as_view()),
+    path('data/add/batch/', views.TagDataBatch.as_view()),
     path('data/list/<tag>/', views.TagDataList.as_view()),
+    path('data/aggregate/<tag>/', views.TagDataAggregate.as_view()),
+    path('data/export/<tag>/', views.TagDataExport.as_view()),
+    path('data/current/', views.TagDataCurrent.as_view()),
     path('data/current/<tag>/', views.TagDataCurrent.as_view()),
     path('weatherstation/add/', views.WxStationCreate.as_view()),
     path('weatherstation/edit/<identifier>/', views.WxStationDetail.as_view()),
     path('weatherstation/list/', views.WxStationList.as_view()),
     path('weatherdata/add/', views.WxDataCreate.as_view()),
+    path('weatherdata/add/batch/', views.WxDataBatch.as_view()),
     path('weatherdata/list/<identifier>/', views.WxDataList.as_view()),
+    path('weatherdata/aggregate/<identifier>/', views.WxDataAggregate.as_view()),
+    path('weatherdata/export/<identifier>/', views.WxDataExport.as_view()),
     path('weatherdata/current/<identifier>/', views.WxDataCurrent.as_view()),
+    path('live/', views.LiveData.as_view()),
     path('token/', ObtainAuthToken.as_view()),
     ]
 
@@ -39,4 +47,5 @@ schema_view = get_swagger_view(title="Red Cat IOT Docs", patterns=urlpatterns_in
 urlpatterns = urlpatterns_include + [
     path('', schema_view),
     path('docs/', schema_view),
+    path('metrics/', views.Metrics.as_view()),
     ]
\ No newline at end of file
@@ -7,18 +7,70 @@ from rest_framework import status
 from rest_framework.response import Response
 from rest_framework import serializers
 from rest_framework.authentication import SessionAuthentication
-from rest_framework.authentication import TokenAuthentication
 from rest_framework.permissions import IsAuthenticated
 from rest_framework import generics
+from rest_framework.parsers import FormParser, MultiPartParser
+from rest_framework.renderers import BrowsableAPIRenderer
 from rest_framework.views import APIView
 from django.views.generic import View
+from django.http import HttpResponse, StreamingHttpResponse
 from django.utils import dateparse
+from django.db import IntegrityError, transaction
+from django.db.models import OuterRef, Subquery
+from django.conf import settings
+from django.utils import timezone
+from datetime import timedelta
+import heapq
+from itertools import islice
+from distutils.util import strtobool
 from rest_framework.authtoken.views import ObtainAuthToken
 from api.models import Devices, Tags, ValueTypes, IotData
 from api.models import WeatherStations, WeatherData
 from api.serializers import DeviceSerializer, TagSerializer, TagDataSerializer, ValTypeSerializer, DeviceTagSerializer
-from api.serializers import WxStationSerializer, WxDataSerializer, WxDataCreateSerializer
-from api.permissions import IsOwner, IsSuperUser, GetOnlyUnlessIsStaff
+from api.serializers import TagDataBatchSerializer
+from api.serializers import WxStationSerializer, WxDataSerializer, WxDataCreateSerializer, WxDataBatchSerializer
+from api.permissions import IsOwner, IsSuperUser, IsStaff, GetOnlyUnlessIsStaff
+from api.authentication import CachedTokenAuthentication
+from api.pagination import TimestampCursorPagination
+from api.parsers import FastJSONParser
+from api.renderers import FastJSONRenderer
+from api.rows import WEATHER_VALUE_FIELDS, tag_value_field, tag_data_rows, weather_data_rows
+from api import latest, aggregation, rollups, export, ingest_queue, archive, downsample, metrics, live, tag_cache
+from api import dedupe
+
+
+def save_or_enqueue(serializer):
+    #Saves a valid ingest serializer, or queues it for the drain_ingest worker when IOT_INGEST_MODE = 'queue'
+    if not ingest_queue.is_enabled():
+        try:
+            #Savepoint, so an enclosing transaction stays usable after a duplicate
+            with transaction.atomic():
+                serializer.save()
+        except IntegrityError as e:
+            #Unique index added by dedupe_history without IOT_INGEST_IGNORE_DUPLICATES, other errors are not duplicates
+            if not dedupe.is_unique_index_error(e):
+                raise
+            return Response({'Duplicate reading': 'A reading with this timestamp is already stored.'},
+                            status=status.HTTP_409_CONFLICT)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+    try:
+        serializer.enqueue()
+    except ingest_queue.QueueFull as e:
+        retry_after = getattr(settings, 'IOT_INGEST_RETRY_AFTER', 5)
+        return Response({'Ingest queue full': str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                        headers={'Retry-After': str(retry_after)})
+    return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
+
+
+def save_tag_data(request, data):
+    #Validates and saves one tag reading, used by TagData and its ASGI variant
+    serializer = TagDataSerializer(data=data, context={'request': request})
+    if serializer.is_valid():
+        response = save_or_enqueue(serializer)
+        if getattr(serializer, 'suppressed', False):
+            response.status_code = status.HTTP_200_OK
+        return response
+    return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
 class DeviceList(generics.ListAPIView):
@@ -26,12 +78,12 @@ class DeviceList(generics.ListAPIView):
     get:
     Returns a list of devices that belong to you.
     """
-    authentication_classes = (SessionAuthentication, TokenAuthentication,)
+    authentication_classes = (SessionAuthentication, CachedTokenAuthentication,)
     permission_classes = (IsAuthenticated,)
     serializer_class = DeviceSerializer
 
     def get_queryset(self):
-        return Devices.objects.filter(owner=self.request.user)
+        return Devices.objects.filter(owner=self.request.user).select_related('owner')
 
 
 class DeviceCreate(generics.CreateAPIView):
@@ -39,7 +91,7 @@ class DeviceCreate(generics.CreateAPIView):
     post:
     Creates a new device that belongs to you.
     """
-    authentication_classes = (SessionAuthentication, TokenAuthentication,)
+    authentication_classes = (SessionAuthentication, CachedTokenAuthentication,)
     permission_classes = (IsAuthenticated,)
     serializer_class = DeviceSerializer
 
@@ -54,10 +106,10 @@ class DeviceDetail(generics.RetrieveUpdateDestroyAPIView):
     patch: Update details for the given device. (requires only the property to be updated)
     delete: Deletes the given device.
     """
-    authentication_classes = (SessionAuthentication, TokenAuthentication,)
+    authentication_classes = (SessionAuthentication, CachedTokenAuthentication,)
     permission_classes = (IsAuthenticated, IsOwner,)
 
-    queryset = Devices.objects.all()
+    queryset = Devices.objects.select_related('owner')
     serializer_class = DeviceSerializer
 
 
@@ -71,7 +123,7 @@ class TagList(generics.ListAPIView):
     serializer_class = TagSerializer
 
     def get_queryset(self):
-        return Tags.objects.filter(device__owner=self.request.user)
+        return Tags.objects.filter(device__owner=self.request.user).select_related('device__owner')
 
 
 class TagCreate(generics.CreateAPIView):
@@ -79,7 +131,7 @@ class TagCreate(generics.CreateAPIView):
     post:
     Creates a new tag that belongs to you.
     """
-    authentication_classes = (SessionAuthentication, TokenAuthentication,)
+    authentication_classes = (SessionAuthentication, CachedTokenAuthentication,)
     permission_classes = (IsAuthenticated,)
     serializer_class = TagSerializer
 
@@ -88,12 +140,13 @@ class DeviceTagList(generics.ListAPIView):
     """
     get: Returns a nested representation of Devices and Tags that belong to you.
     """
-    authentication_classes = (SessionAuthentication, TokenAuthentication,)
+    authentication_classes = (SessionAuthentication, CachedTokenAuthentication,)
     permission_classes = (IsAuthenticated,)
     serializer_class = DeviceTagSerializer
     
     def get_queryset(self):
         queryset = Devices.objects.filter(owner=self.request.user)
+        queryset = queryset.select_related('owner').prefetch_related('device_tags')
         #Device if given in url
         device = self.kwargs.get('device_id', None)
         if device:
@@ -111,10 +164,10 @@ class TagDetail(generics.RetrieveUpdateDestroyAPIView):
     patch: Update details for the given tag. (requires only the property to be updated)
     delete: Deletes the given tag.
     """
-    authentication_classes = (SessionAuthentication, TokenAuthentication,)
+    authentication_classes = (SessionAuthentication, CachedTokenAuthentication,)
     permission_classes = (IsAuthenticated, IsOwner,)
 
-    queryset = Tags.objects.all()
+    queryset = Tags.objects.select_related('device__owner')
     serializer_class = TagSerializer
 
 
@@ -165,20 +218,72 @@ class TagData(APIView):
     If optional timestamp is not supplied the current datetime will be used.
     Timezone aware format example: "1999-01-31T09:00:00.000-06:00" (US CST)
     Timezone aware format example: "1999-01-31T15:00:00.000Z" (GMT)
+    When the server runs in queue ingest mode the record is queued and 202 is returned,
+    503 with a Retry-After header means the queue is full.
+    A record within the deadband of its tag is not stored and 200 is returned.
     """
     serializer_class = TagDataSerializer
-    authentication_classes = (SessionAuthentication, TokenAuthentication,)
+    authentication_classes = (SessionAuthentication, CachedTokenAuthentication,)
     permission_classes = (IsAuthenticated,)
+    parser_classes = (FastJSONParser, FormParser, MultiPartParser)
 
     def post(self, request, format=None):
-        serializer = TagDataSerializer(data=request.data, context={'request': request})
+        return save_tag_data(request, request.data)
+
+
+class TagDataBatch(APIView):
+    """
+    post: Add value records for multiple Tags with a single request.
+    data
+    [
+      {"tag": "string", "value": "string", "timestamp": "<timezone aware datetime>"},
+      {"tag": "string", "value": "string"}
+    ]
+    |
+    Records are validated together and all valid records are saved with a single insert.
+    Invalid records are skipped and returned in "errors" with their list index.
+    Records within the deadband of their tag are not stored and counted in "suppressed".
+    If optional timestamp is not supplied the current datetime will be used.
+    When the server runs in queue ingest mode the records are queued and 202 is returned,
+    503 with a Retry-After header means the queue is full.
+    """
+    serializer_class = TagDataBatchSerializer
+    authentication_classes = (SessionAuthentication, CachedTokenAuthentication,)
+    permission_classes = (IsAuthenticated,)
+    parser_classes = (FastJSONParser, FormParser, MultiPartParser)
+
+    def post(self, request, format=None):
+        serializer = TagDataBatchSerializer(data=request.data, context={'request': request})
         if serializer.is_valid():
-            serializer.save()
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
+            return save_or_enqueue(serializer)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class TagDataList(generics.ListAPIView):
+class DownsampleMixin:
+    """
+    Shared parameter handling for the points / downsample parameters of the data list views.
+    With points given the whole requested span is downsampled into a single unpaged response.
+    """
+
+    def get_points(self):
+        #Maximum number of records to return, None when not downsampling
+        req_points = self.request.query_params.get('points', None)
+        if req_points is None:
+            return None
+        max_points = getattr(settings, 'IOT_MAX_POINTS', 10000)
+        try:
+            return max(3, min(int(req_points), max_points))
+        except ValueError:
+            raise serializers.ValidationError({'Invalid points parameter': req_points})
+
+    def get_downsample_method(self):
+        method = self.request.query_params.get('downsample', 'lttb')
+        if method not in downsample.METHODS:
+            raise serializers.ValidationError({'Invalid downsample': method, 'Valid methods are': list(downsample.METHODS)})
+        return method
+
+
+class TagDataList(DownsampleMixin, generics.ListAPIView):
     """
     get: Returns a list of data for the given tag.
     |
@@ -187,15 +292,23 @@ class TagDataList(generics.ListAPIView):
     after=datetime -- Return records after this time (non-inclusive)
     end=datetime -- Return records up to this time (inclusive)
     before=datetime -- Return records occurring before this time (non-inclusive)
-    max=number -- Maximum number of records to return (default=100)
+    max=number -- Maximum number of records to return per page (default=100, capped by the server)
+    cursor=token -- Continue from the previous page, given in the Link header of the response
+    points=number -- Downsample the whole span to at most this many records for charts (capped by the server)
+    downsample=lttb|minmax -- Downsampling method used with points (default=lttb)
     |
     Note1 - all datetime values must be given in timezone aware format, e.g. "2010-01-27T18:09:23.123456Z"
     Note2 - If begin & after are given begin is used, if end and before are given end is used.
+    Note3 - When more records are available the response has a Link header with the URL of the next page.
+    Note4 - Records moved to the archive by archive_history are included.
+    Note5 - points is only available for int and dec tags, the response is not paged and max / cursor are ignored.
 
     """
     serializer_class = TagDataSerializer
-    authentication_classes = (SessionAuthentication, TokenAuthentication,)
+    authentication_classes = (SessionAuthentication, CachedTokenAuthentication,)
     permission_classes = (IsAuthenticated,)
+    pagination_class = TimestampCursorPagination
+    renderer_classes = (FastJSONRenderer, BrowsableAPIRenderer)
 
 
     def validate_date(self, dt):
@@ -211,49 +324,272 @@ class TagDataList(generics.ListAPIView):
 
 
     def get_queryset(self):
-        #All IotData owned by request user
+        #All IotData owned by request user, tag and value type are needed for every serialized row
         queryset = IotData.objects.filter(tag__device__owner=self.request.user)
+        queryset = queryset.select_related('tag__value_type')
 
         #Filter on tag if given
         req_tag = self.kwargs.get('tag', None)
         if req_tag:
             queryset = queryset.filter(tag=req_tag)
 
+        queryset = queryset.filter(**self.get_time_filters())
+
+        #Ordering and max number of records are applied by TimestampCursorPagination
+        return queryset
+
+    def get_time_filters(self):
+        #timestamp lookups of the begin / after / end / before parameters
+        filters = {}
+
         #Filter on begin or after if given
         begin = self.request.query_params.get('begin', None)
         after = self.request.query_params.get('after', None)
         if begin or after:
             if begin:
-                begin_dt = self.validate_date(begin)
-                queryset = queryset.filter(timestamp__gte=begin_dt)
+                filters['timestamp__gte'] = self.validate_date(begin)
             else:
-                after_dt = self.validate_date(after)
-                queryset = queryset.filter(timestamp__gt=after_dt)
+                filters['timestamp__gt'] = self.validate_date(after)
 
         #Filter on end or before if given
         end = self.request.query_params.get('end', None)
         before = self.request.query_params.get('before', None)
         if end or before:
             if end:
-                end_dt = self.validate_date(end)
-                queryset = queryset.filter(timestamp__lte=end_dt)
+                filters['timestamp__lte'] = self.validate_date(end)
             else:
-                before_dt = self.validate_date(before)
-                queryset = queryset.filter(timestamp__lt=before_dt)
+                filters['timestamp__lt'] = self.validate_date(before)
+
+        return filters
+
+    def get_archived_rows(self, position, limit):
+        #(timestamp, id, value) rows of the tag moved to the archive by archive_history, merged into pages by TimestampCursorPagination
+        rows = archive.iter_archived_rows(self.kwargs.get('tag', None), self.get_time_filters(), position)
+        return [(timestamp, pk, value) for block_type, (pk, timestamp, value) in islice(rows, limit)]
 
-        #Limit to max if given, else default to 100 records
-        max = int(self.request.query_params.get('max', 100))
-        queryset = queryset.order_by('timestamp')[:max]
+    def list_rows(self, request):
+        #Page of records built from value tuples, tag type and owner come from the tag metadata cache
+        req_tag = self.kwargs.get('tag', None)
+        lookups = self.get_time_filters()
+        info = tag_cache.get_tag(req_tag)
+        if info is None or info.owner_id != request.user.pk:
+            return Response([])
+        queryset = IotData.objects.filter(tag=req_tag, **lookups)
+        page = self.paginator.paginate_rows(queryset, [tag_value_field(info.type)], request, view=self)
+        return self.paginator.get_paginated_response(tag_data_rows(page, req_tag, info.type))
+
+    def list(self, request, *args, **kwargs):
+        points = self.get_points()
+        if points is None:
+            return self.list_rows(request)
 
+        req_tag = self.kwargs.get('tag', None)
+        tag = Tags.objects.filter(pk=req_tag, device__owner=request.user).select_related('value_type').first()
+        if tag is None:
+            raise serializers.ValidationError({'Tag does not exist': req_tag})
+        tag_type = tag.value_type.type
+        if tag_type not in aggregation.NUMERIC_TYPES:
+            raise serializers.ValidationError({'points is only available for int and dec tags': req_tag})
+        method = self.get_downsample_method()
+        field = aggregation.VALUE_FIELDS[tag_type]
+
+        #Live and archived records are merged into one (timestamp, id) ordered pass
+        queryset = self.get_queryset()
+        lookups = self.get_time_filters()
+        count = queryset.filter(**{f'{field}__isnull': False}).count() + archive.count_archived(tag, lookups)
+        archived = ((timestamp, pk, value) for block_type, (pk, timestamp, value)
+                    in archive.iter_archived_rows(tag, lookups) if value is not None)
+        rows = heapq.merge(downsample.iter_rows(queryset, field), archived, key=lambda row: row[:2])
+        return Response([latest.tag_data_repr(IotData(pk=pk, tag_id=req_tag, timestamp=timestamp, **{field: value}),
+                                              tag_type)
+                         for timestamp, pk, value in downsample.downsample(rows, count, points, method)])
+
+
+class BucketAggregateMixin:
+    """
+    Shared parameter handling for the time bucket aggregation views.
+    Requires a get_queryset that applies the begin/after/end/before parameters and validate_date.
+    Buckets completely covered by the rollup tables are read from them, the rest from raw records.
+    """
+    pagination_class = None
+    timestamp_field = serializers.DateTimeField()
+
+    def get_max_buckets(self):
+        max_buckets = getattr(settings, 'IOT_MAX_BUCKETS', 2000)
+        req_max = self.request.query_params.get('max', max_buckets)
+        try:
+            return max(1, min(int(req_max), max_buckets))
+        except ValueError:
+            raise serializers.ValidationError({'Invalid max parameter': req_max})
+
+    def get_span(self):
+        """
+        Returns (begin, begin inclusive, end, end inclusive) of the requested time span.
+        begin and end are None when not given.
+        """
+        params = self.request.query_params
+        begin, begin_inclusive = None, True
+        if params.get('begin', None):
+            begin = self.validate_date(params['begin'])
+        elif params.get('after', None):
+            begin, begin_inclusive = self.validate_date(params['after']), False
+        end, end_inclusive = None, True
+        if params.get('end', None):
+            end = self.validate_date(params['end'])
+        elif params.get('before', None):
+            end, end_inclusive = self.validate_date(params['before']), False
+        return begin, begin_inclusive, end, end_inclusive
+
+    def get_interval(self, max_buckets):
+        """
+        Returns (interval, seconds) from the interval parameter.
+        auto picks the finest interval that covers the requested span with max buckets.
+        """
+        interval = self.request.query_params.get('interval', 'auto')
+        if interval != 'auto':
+            return interval, aggregation.parse_interval(interval)
+        begin, begin_inclusive, end, end_inclusive = self.get_span()
+        if begin is None:
+            return '1h', aggregation.INTERVALS['1h']
+        span = ((end or timezone.now()) - begin).total_seconds()
+        for interval, seconds in sorted(aggregation.INTERVALS.items(), key=lambda item: item[1]):
+            if span / seconds <= max_buckets:
+                return interval, seconds
+        return '1d', aggregation.INTERVALS['1d']
+
+    def get_bucket_queryset(self, seconds, max_buckets):
+        queryset = self.get_queryset()
+        #Without a start only aggregate the time span that can be returned
+        params = self.request.query_params
+        if not params.get('begin', None) and not params.get('after', None):
+            queryset = queryset.filter(timestamp__gte=timezone.now() - timedelta(seconds=seconds * max_buckets))
         return queryset
 
+    def get_rollup_span(self, interval, seconds, max_buckets, rollup_name):
+        #Bucket range [first, stop) that is complete in the rollup tables, None if rollups can't be used
+        if interval not in rollups.ROLLUP_INTERVALS or not getattr(settings, 'IOT_ROLLUPS_ENABLED', True):
+            return None
+        mark = rollups.high_water(rollup_name)
+        if mark is None:
+            return None
+        begin, begin_inclusive, end, end_inclusive = self.get_span()
+        if begin is None:
+            begin = timezone.now() - timedelta(seconds=seconds * max_buckets)
+        start = begin.timestamp()
+        if begin_inclusive and start % seconds == 0:
+            first = int(start)
+        else:
+            first = (int(start) // seconds + 1) * seconds
+        stop = int(min(end or mark, mark).timestamp()) // seconds * seconds
+        if first >= stop:
+            return None
+        return aggregation.bucket_datetime(first), aggregation.bucket_datetime(stop)
+
+    def get_buckets(self, interval, seconds, fields, functions, max_buckets, rollup_name, rollup_buckets):
+        """
+        Returns aggregate_buckets of the requested span.
+        rollup_buckets(begin, end, max_buckets) returns the rollup buckets in [begin, end).
+        """
+        queryset = self.get_bucket_queryset(seconds, max_buckets)
+        span = self.get_rollup_span(interval, seconds, max_buckets, rollup_name)
+        if span is None:
+            return aggregation.aggregate_buckets(queryset, seconds, fields, functions, max_buckets)
+        first, stop = span
+        raw = queryset.exclude(timestamp__gte=first, timestamp__lt=stop)
+        buckets = dict(aggregation.aggregate_buckets(raw, seconds, fields, functions, max_buckets))
+        buckets.update(rollup_buckets(first, stop, max_buckets))
+        return sorted(buckets.items())[-max_buckets:]
+
+    def bucket_repr(self, bucket):
+        return self.timestamp_field.to_representation(aggregation.bucket_datetime(bucket))
+
+
+class TagDataAggregate(BucketAggregateMixin, TagDataList):
+    """
+    get: Returns data for the given tag aggregated into time buckets.
+    |
+    Allowable URL parameters are:
+    interval=auto|1m|5m|1h|1d -- Width of each bucket (default=auto)
+    functions=min,max,avg,count,last -- Comma separated aggregates to return (default=all)
+    begin=datetime -- Aggregate records from this time (inclusive)
+    after=datetime -- Aggregate records after this time (non-inclusive)
+    end=datetime -- Aggregate records up to this time (inclusive)
+    before=datetime -- Aggregate records occurring before this time (non-inclusive)
+    max=number -- Maximum number of buckets, the most recent are returned (default=2000)
+    |
+    Note1 - min, max and avg are only available for int and dec tags.
+    Note2 - buckets are aligned to UTC, e.g. 1d buckets start at 00:00 UTC.
+    Note3 - auto uses the finest interval that covers the requested span in max buckets, 1h without begin / after.
+    """
+    def list(self, request, *args, **kwargs):
+        req_tag = self.kwargs.get('tag', None)
+        tag_type = Tags.objects.filter(pk=req_tag, device__owner=request.user) \
+                               .values_list('value_type__type', flat=True).first()
+        if tag_type is None:
+            raise serializers.ValidationError({'Tag does not exist': req_tag})
+
+        max_buckets = self.get_max_buckets()
+        interval, seconds = self.get_interval(max_buckets)
+        if tag_type in aggregation.NUMERIC_TYPES:
+            allowed = aggregation.FUNCTIONS
+            rollup_name = rollups.TAG_DATA
+        else:
+            #Only numeric tags are rolled up
+            allowed = ('count', 'last')
+            rollup_name = None
+        functions = aggregation.parse_functions(request.query_params.get('functions', None), allowed)
+        field = aggregation.VALUE_FIELDS.get(tag_type, 'value_text')
+
+        buckets = self.get_buckets(interval, seconds, [field], functions, max_buckets, rollup_name,
+                                   lambda begin, end, limit: rollups.tag_buckets(
+                                       req_tag, interval, field, functions, begin, end, limit))
+        return Response([{'bucket': self.bucket_repr(bucket), **values[field]} for bucket, values in buckets])
+
+
+class TagDataExport(TagDataList):
+    """
+    get: Streams all data for the given tag as a CSV or NDJSON file.
+    |
+    Allowable URL parameters are:
+    output=csv|ndjson -- File format (default=csv)
+    begin=datetime -- Export records from this time (inclusive)
+    after=datetime -- Export records after this time (non-inclusive)
+    end=datetime -- Export records up to this time (inclusive)
+    before=datetime -- Export records occurring before this time (non-inclusive)
+    |
+    Note1 - all datetime values must be given in timezone aware format, e.g. "2010-01-27T18:09:23.123456Z"
+    Note2 - records are ordered by timestamp, there is no limit on the number of records.
+    Note3 - Records moved to the archive by archive_history are included.
+    """
+    pagination_class = None
+
+    def list(self, request, *args, **kwargs):
+        output = export.parse_output(request.query_params.get('output', None))
+        req_tag = self.kwargs.get('tag', None)
+        tag_type = Tags.objects.filter(device__owner=request.user, pk=req_tag) \
+                               .values_list('value_type__type', flat=True).first()
+        if tag_type is None:
+            raise serializers.ValidationError({'Tag does not exist': req_tag})
+        #Archived values of another value type are exported empty like live ones
+        archived = ((timestamp, pk, value if block_type == tag_type else None) for block_type, (pk, timestamp, value)
+                    in archive.iter_archived_rows(req_tag, self.get_time_filters()))
+        chunks = export.tag_rows(self.get_queryset(), req_tag, tag_type, archived)
+        return export.streaming_response(chunks, export.TAG_COLUMNS, output, req_tag)
+
 
 class TagDataCurrent(generics.ListAPIView):
     """
-    get: Returns the most recent record for a given tag
+    get: Returns the most recent record for a given tag.
+    If no tag is given returns the most recent record of every tag that belongs to you.
+    |
+    Allowable URL parameters when no tag is given are:
+    tags=tag1,tag2 -- Only return records for these tags
+    device=device_id -- Only return records for tags of this device
+    |
+    Note1 - A tag whose history was all moved to the archive by archive_history returns its newest archived record.
     """
     serializer_class = TagDataSerializer
-    authentication_classes = (SessionAuthentication, TokenAuthentication,)
+    authentication_classes = (SessionAuthentication, CachedTokenAuthentication,)
     permission_classes = (IsAuthenticated,)
 
     def get_queryset(self):
@@ -265,25 +601,84 @@ class TagDataCurrent(generics.ListAPIView):
             queryset = queryset.filter(tag=req_tag)
         else:
             #return the last record of all owned tags
-            #could throw a ValidationError here
-            pass
+            return self.get_snapshot_queryset(self.get_snapshot_tags())
         #return last record
-        queryset = queryset.order_by('-timestamp')[:1]
+        queryset = queryset.select_related('tag__value_type').order_by('-timestamp')[:1]
 
         return queryset
 
+    def get_snapshot_tags(self):
+        #Owned tags to include in a snapshot, optionally limited by tags or device parameters
+        tags = Tags.objects.filter(device__owner=self.request.user)
+        req_tags = self.request.query_params.get('tags', None)
+        if req_tags:
+            tags = tags.filter(tag_id__in=req_tags.split(','))
+        req_device = self.request.query_params.get('device', None)
+        if req_device:
+            tags = tags.filter(device=req_device)
+        return tags
+
+    def get_snapshot_queryset(self, tags):
+        #Last record of each tag, one query for the record ids and one for the records
+        last_record = IotData.objects.filter(tag=OuterRef('pk')).order_by('-timestamp', '-id')
+        record_ids = tags.annotate(last_id=Subquery(last_record.values('id')[:1])).values_list('last_id', flat=True)
+        queryset = IotData.objects.filter(pk__in=[pk for pk in record_ids if pk is not None])
+        return queryset.select_related('tag__value_type').order_by('tag')
+
+    def get_archived_records(self, tag_ids):
+        #Newest archived record of owned tags, for tags whose history was all moved to the archive
+        tags = Tags.objects.filter(device__owner=self.request.user, tag_id__in=tag_ids).select_related('value_type')
+        archived = archive.last_archived(tag_ids)
+        records = []
+        for tag in tags:
+            if tag.tag_id in archived:
+                block_type, (pk, timestamp, value) = archived[tag.tag_id]
+                records.append(IotData(pk=pk, tag=tag, timestamp=timestamp,
+                                       **{aggregation.VALUE_FIELDS[block_type]: value}))
+        return records
+
+    def list(self, request, *args, **kwargs):
+        req_tag = self.kwargs.get('tag', None)
+        if not req_tag:
+            return self.list_snapshot(request)
+
+        #Serve from the latest value store, query and refill it on a miss
+        data = latest.get_tag_data(req_tag, request.user.pk)
+        if data is None:
+            records = list(self.get_queryset()) or self.get_archived_records([req_tag])
+            if not records:
+                return Response([])
+            record = records[0]
+            latest.store_tag_data(records, {record.tag_id: record.tag.value_type.type}, request.user.pk)
+            data = self.get_serializer(record).data
+        return Response([data])
+
+    def list_snapshot(self, request):
+        #Serve from the latest value store, tags missing from it are queried together
+        tag_ids = list(self.get_snapshot_tags().values_list('tag_id', flat=True))
+        found = latest.get_tag_data_many(tag_ids, request.user.pk)
+        missing = [tag_id for tag_id in tag_ids if tag_id not in found]
+        if missing:
+            records = list(self.get_snapshot_queryset(Tags.objects.filter(tag_id__in=missing)))
+            queried = {r.tag_id for r in records}
+            if len(queried) < len(missing):
+                records += self.get_archived_records([tag_id for tag_id in missing if tag_id not in queried])
+            latest.store_tag_data(records, {r.tag_id: r.tag.value_type.type for r in records}, request.user.pk)
+            found.update({r.tag_id: self.get_serializer(r).data for r in records})
+        return Response([found[tag_id] for tag_id in tag_ids if tag_id in found])
+
 
 class WxStationList(generics.ListAPIView):
     """
     get:
     Returns a list of Weather Stations that belong to you.
     """
-    authentication_classes = (SessionAuthentication, TokenAuthentication,)
+    authentication_classes = (SessionAuthentication, CachedTokenAuthentication,)
     permission_classes = (IsAuthenticated,)
     serializer_class = WxStationSerializer
 
     def get_queryset(self):
-        return WeatherStations.objects.filter(owner=self.request.user)
+        return WeatherStations.objects.filter(owner=self.request.user).select_related('owner')
 
 
 class WxStationCreate(generics.CreateAPIView):
@@ -291,7 +686,7 @@ class WxStationCreate(generics.CreateAPIView):
     post:
     Creates a new Weather Station that belongs to you.
     """
-    authentication_classes = (SessionAuthentication, TokenAuthentication,)
+    authentication_classes = (SessionAuthentication, CachedTokenAuthentication,)
     permission_classes = (IsAuthenticated,)
     serializer_class = WxStationSerializer
 
@@ -304,12 +699,12 @@ class WxStationList(generics.ListAPIView):
     get:
     Returns a list of Weather Stations that belong to you.
     """
-    authentication_classes = (SessionAuthentication, TokenAuthentication,)
+    authentication_classes = (SessionAuthentication, CachedTokenAuthentication,)
     permission_classes = (IsAuthenticated,)
     serializer_class = WxStationSerializer
 
     def get_queryset(self):
-        return WeatherStations.objects.filter(owner=self.request.user)
+        return WeatherStations.objects.filter(owner=self.request.user).select_related('owner')
 
 
 class WxStationDetail(generics.RetrieveUpdateDestroyAPIView):
@@ -319,10 +714,10 @@ class WxStationDetail(generics.RetrieveUpdateDestroyAPIView):
     patch: Update details for the given weather station. (requires only the property to be updated)
     delete: Deletes the given weather station.
     """
-    authentication_classes = (SessionAuthentication, TokenAuthentication,)
+    authentication_classes = (SessionAuthentication, CachedTokenAuthentication,)
     permission_classes = (IsAuthenticated, IsOwner,)
 
-    queryset = WeatherStations.objects.all()
+    queryset = WeatherStations.objects.select_related('owner')
     serializer_class = WxStationSerializer
     lookup_field = 'identifier'
 
@@ -331,20 +726,67 @@ class WxDataCreate(generics.CreateAPIView):
     """
     post:
     Creates a new Weather data record
+    When the server runs in queue ingest mode the record is queued and 202 is returned,
+    503 with a Retry-After header means the queue is full.
     """
-    authentication_classes = (SessionAuthentication, TokenAuthentication,)
+    authentication_classes = (SessionAuthentication, CachedTokenAuthentication,)
     permission_classes = (IsAuthenticated,)
+    parser_classes = (FastJSONParser, FormParser, MultiPartParser)
     serializer_class = WxDataCreateSerializer
 
     def post(self, request, format=None):
         serializer = WxDataCreateSerializer(data=request.data, context={'request': request})
         if serializer.is_valid():
-            serializer.save()
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
+            return save_or_enqueue(serializer)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class WxDataList(generics.ListAPIView):
+class WxDataBatch(APIView):
+    """
+    post: Add weather data records for multiple stations with a single request.
+    data
+    [
+      {"identifier": "string", "temperature": 21.5, "pressure": 1013.2, "timestamp": "<timezone aware datetime>"},
+      {"identifier": "string", "temperature": 20.0}
+    ]
+    |
+    Allowable URL parameters are:
+    dedupe=true -- Skip records for a station and timestamp already stored or repeated in the request
+    |
+    Records are validated together, stations are resolved with a single query and all valid
+    records are saved with a single insert.
+    Invalid records are skipped and returned in "errors" with their list index.
+    Skipped duplicates are counted in "duplicates".
+    If optional timestamp is not supplied the current datetime will be used.
+    When the server runs in queue ingest mode the records are queued and 202 is returned,
+    503 with a Retry-After header means the queue is full.
+    """
+    serializer_class = WxDataBatchSerializer
+    authentication_classes = (SessionAuthentication, CachedTokenAuthentication,)
+    permission_classes = (IsAuthenticated,)
+    parser_classes = (FastJSONParser, FormParser, MultiPartParser)
+
+    def post(self, request, format=None):
+        dedupe = request.query_params.get('dedupe', 'false')
+        try:
+            dedupe = bool(strtobool(dedupe))
+        except ValueError:
+            return Response({'Invalid dedupe parameter': dedupe}, status=status.HTTP_400_BAD_REQUEST)
+        serializer = WxDataBatchSerializer(data=request.data, dedupe=dedupe, context={'request': request})
+        if serializer.is_valid():
+            return save_or_enqueue(serializer)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+class StationMixin:
+    def check_station_exists(self):
+        #Tells a missing station apart from a station without records, only run on an empty result
+        req_identifier = self.kwargs.get('identifier', None)
+        if not WeatherStations.objects.filter(owner=self.request.user, identifier=req_identifier).exists():
+            raise serializers.ValidationError({'Station identifier does not exist': req_identifier})
+
+
+class WxDataList(StationMixin, DownsampleMixin, generics.ListAPIView):
     """
     get:
     Returns a list of Weather data for a given station id.
@@ -354,14 +796,23 @@ class WxDataList(generics.ListAPIView):
     after=datetime -- Return records after this time (non-inclusive)
     end=datetime -- Return records up to this time (inclusive)
     before=datetime -- Return records occurring before this time (non-inclusive)
-    max=number -- Maximum number of records to return (default=100)
+    max=number -- Maximum number of records to return per page (default=100, capped by the server)
+    cursor=token -- Continue from the previous page, given in the Link header of the response
+    points=number -- Downsample the whole span to at most this many records for charts (capped by the server)
+    downsample=lttb|minmax -- Downsampling method used with points (default=lttb)
+    field=temperature|dewpoint|wind_speed|wind_gust|wind_dir|pressure -- Field downsampled with points (default=temperature)
     |
     Note1 - all datetime values must be given in timezone aware format, e.g. "2010-01-27T18:09:23.123456Z"
     Note2 - If begin & after are given begin is used, if end and before are given end is used.
+    Note3 - When more records are available the response has a Link header with the URL of the next page.
+    Note4 - With points the response is not paged, max / cursor are ignored and records only hold identifier,
+            the downsampled field and timestamp.
 
     """
-    authentication_classes = (SessionAuthentication, TokenAuthentication,)
+    authentication_classes = (SessionAuthentication, CachedTokenAuthentication,)
     permission_classes = (IsAuthenticated,)
+    pagination_class = TimestampCursorPagination
+    renderer_classes = (FastJSONRenderer, BrowsableAPIRenderer)
     serializer_class = WxDataSerializer
 
     def validate_date(self, dt):
@@ -377,13 +828,9 @@ class WxDataList(generics.ListAPIView):
 
     def get_queryset(self):
         req_identifier = self.kwargs.get('identifier', None)
-        station_exists = WeatherStations.objects.filter(owner=self.request.user,
-                                                        identifier=req_identifier).count()
-        if not station_exists:
-             raise serializers.ValidationError({'Station identifier does not exist': req_identifier})
-
         queryset = WeatherData.objects.filter(station__owner=self.request.user,
                                               station__identifier=req_identifier)
+        queryset = queryset.select_related('station')
 
         #Filter on begin or after if given
         begin = self.request.query_params.get('begin', None)
@@ -407,34 +854,229 @@ class WxDataList(generics.ListAPIView):
                 before_dt = self.validate_date(before)
                 queryset = queryset.filter(timestamp__lt=before_dt)
 
-        #Limit to max if given, else default to 100 records
-        max = int(self.request.query_params.get('max', 100))
-        queryset = queryset.order_by('timestamp')[:max]
-
+        #Ordering and max number of records are applied by TimestampCursorPagination
         return queryset
 
+    def list(self, request, *args, **kwargs):
+        points = self.get_points()
+        if points is not None:
+            return self.list_downsampled(points)
+        #Page of records built from value tuples
+        page = self.paginator.paginate_rows(self.get_queryset(), WEATHER_VALUE_FIELDS, request, view=self)
+        if not page:
+            self.check_station_exists()
+        return self.paginator.get_paginated_response(weather_data_rows(page, self.kwargs.get('identifier', None)))
+
+    def list_downsampled(self, points):
+        field = self.request.query_params.get('field', 'temperature')
+        if field not in aggregation.WEATHER_FIELDS:
+            raise serializers.ValidationError({'Invalid field': field, 'Valid fields are': list(aggregation.WEATHER_FIELDS)})
+        method = self.get_downsample_method()
+        queryset = self.get_queryset()
+        count = queryset.filter(**{f'{field}__isnull': False}).count()
+        if not count:
+            self.check_station_exists()
+
+        identifier = self.kwargs.get('identifier', None)
+        value_field = WxDataSerializer().fields[field]
+        timestamp_field = WxDataSerializer().fields['timestamp']
+        rows = downsample.downsample(downsample.iter_rows(queryset, field), count, points, method)
+        return Response([{'identifier': identifier, field: value_field.to_representation(value),
+                          'timestamp': timestamp_field.to_representation(timestamp)}
+                         for timestamp, pk, value in rows])
+
+
+class WxDataAggregate(BucketAggregateMixin, WxDataList):
+    """
+    get: Returns Weather data for a given station id aggregated into time buckets.
+    |
+    Allowable URL parameters are:
+    interval=auto|1m|5m|1h|1d -- Width of each bucket (default=auto)
+    fields=temperature,dewpoint,wind_speed,wind_gust,wind_dir,pressure -- Comma separated fields (default=all)
+    functions=min,max,avg,count,last -- Comma separated aggregates to return (default=all)
+    begin=datetime -- Aggregate records from this time (inclusive)
+    after=datetime -- Aggregate records after this time (non-inclusive)
+    end=datetime -- Aggregate records up to this time (inclusive)
+    before=datetime -- Aggregate records occurring before this time (non-inclusive)
+    max=number -- Maximum number of buckets, the most recent are returned (default=2000)
+    |
+    Note1 - buckets are aligned to UTC, e.g. 1d buckets start at 00:00 UTC.
+    Note2 - auto uses the finest interval that covers the requested span in max buckets, 1h without begin / after.
+    """
+    def list(self, request, *args, **kwargs):
+        max_buckets = self.get_max_buckets()
+        interval, seconds = self.get_interval(max_buckets)
+        functions = aggregation.parse_functions(request.query_params.get('functions', None))
+        req_fields = request.query_params.get('fields', None)
+        fields = req_fields.split(',') if req_fields else list(aggregation.WEATHER_FIELDS)
+        invalid = [f for f in fields if f not in aggregation.WEATHER_FIELDS]
+        if invalid:
+            raise serializers.ValidationError({'Invalid fields': invalid,
+                                               'Valid fields are': list(aggregation.WEATHER_FIELDS)})
+
+        req_identifier = self.kwargs.get('identifier', None)
+        station_id = WeatherStations.objects.filter(owner=request.user, identifier=req_identifier) \
+                                            .values_list('pk', flat=True).first()
+        if station_id is None:
+            raise serializers.ValidationError({'Station identifier does not exist': req_identifier})
+        buckets = self.get_buckets(interval, seconds, fields, functions, max_buckets, rollups.WEATHER_DATA,
+                                   lambda begin, end, limit: rollups.station_buckets(
+                                       station_id, interval, fields, functions, begin, end, limit))
+        return Response([{'bucket': self.bucket_repr(bucket), **values} for bucket, values in buckets])
+
 
-class WxDataCurrent(generics.ListAPIView):
+class WxDataExport(WxDataList):
+    """
+    get: Streams all Weather data for a given station id as a CSV or NDJSON file.
+    |
+    Allowable URL parameters are:
+    output=csv|ndjson -- File format (default=csv)
+    begin=datetime -- Export records from this time (inclusive)
+    after=datetime -- Export records after this time (non-inclusive)
+    end=datetime -- Export records up to this time (inclusive)
+    before=datetime -- Export records occurring before this time (non-inclusive)
+    |
+    Note1 - all datetime values must be given in timezone aware format, e.g. "2010-01-27T18:09:23.123456Z"
+    Note2 - records are ordered by timestamp, there is no limit on the number of records.
+    Note3 - Records moved to the archive by archive_history are included.
+    """
+    pagination_class = None
+
+    def list(self, request, *args, **kwargs):
+        output = export.parse_output(request.query_params.get('output', None))
+        req_identifier = self.kwargs.get('identifier', None)
+        #Errors cannot be reported once streaming has started, check the station first
+        self.check_station_exists()
+        chunks = export.weather_rows(self.get_queryset(), req_identifier)
+        return export.streaming_response(chunks, export.WEATHER_COLUMNS, output, req_identifier)
+
+
+class WxDataCurrent(StationMixin, generics.ListAPIView):
     """
     get: Returns the most recent record for a given station id.
     """
     serializer_class = WxDataSerializer
-    authentication_classes = (SessionAuthentication, TokenAuthentication,)
+    authentication_classes = (SessionAuthentication, CachedTokenAuthentication,)
     permission_classes = (IsAuthenticated,)
 
     def get_queryset(self):
         req_identifier = self.kwargs.get('identifier', None)
-        station_exists = WeatherStations.objects.filter(owner=self.request.user,
-                                                        identifier=req_identifier).count()
-        if not station_exists:
-             raise serializers.ValidationError({'Station identifier does not exist': req_identifier})
-
         queryset = WeatherData.objects.filter(station__owner=self.request.user,
                                               station__identifier=req_identifier)
 
-        queryset = queryset.order_by('-timestamp')[:1]
+        queryset = queryset.select_related('station').order_by('-timestamp')[:1]
 
         return queryset
 
+    def list(self, request, *args, **kwargs):
+        #Serve from the latest value store, query and refill it on a miss
+        req_identifier = self.kwargs.get('identifier', None)
+        data = latest.get_weather_data(request.user.pk, req_identifier)
+        if data is None:
+            records = list(self.get_queryset())
+            if not records:
+                self.check_station_exists()
+                return Response([])
+            latest.store_weather_data(records)
+            data = self.get_serializer(records[0]).data
+        return Response([data])
+
+
+class Metrics(APIView):
+    """
+    get: Returns per endpoint request metrics in Prometheus text format (staff only).
+    |
+    Note1 - metrics are recorded when IOT_METRICS_ENABLED is set and api.middleware.MetricsMiddleware is installed.
+    Note2 - each server process keeps its own metrics.
+    """
+    authentication_classes = (SessionAuthentication, CachedTokenAuthentication,)
+    permission_classes = (IsAuthenticated, IsStaff,)
+
+    def get(self, request, format=None):
+        return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class LiveData(APIView):
+    """
+    get: Waits for new readings of the given tags and weather stations (long-poll or Server-Sent Events).
+    |
+    Allowable URL parameters are:
+    tags=tag,tag -- Comma separated tags to watch
+    stations=identifier,identifier -- Comma separated weather station identifiers to watch
+    since=cursor -- Cursor returned by the previous call
+    timeout=seconds -- Longest wait for a reading (default and maximum set by the server, 25)
+    stream=sse -- Keep the connection open and send readings as Server-Sent Events
+    |
+    Note1 - a long-poll returns {"cursor", "reset", "data"} as soon as readings after since arrive.
+    Note2 - reset is true when since is missing or invalid, data then holds the current value of every
+            tag / station watched and the client continues with the new cursor.
+    Note3 - an SSE client reconnecting sends its last event id as the Last-Event-ID header.
+    """
+    authentication_classes = (SessionAuthentication, CachedTokenAuthentication,)
+    permission_classes = (IsAuthenticated,)
 
-    
\ No newline at end of file
+    def get_keys(self):
+        #Watched (tag ids, station identifiers), checked against the tags and stations owned by request user
+        params = self.request.query_params
+        tag_ids = [tag for tag in params.get('tags', '').split(',') if tag]
+        identifiers = [ident for ident in params.get('stations', '').split(',') if ident]
+        max_keys = getattr(settings, 'IOT_LIVE_MAX_KEYS', 100)
+        if not tag_ids and not identifiers:
+            raise serializers.ValidationError({'Missing parameter': 'Give tags and / or stations to watch.'})
+        if len(tag_ids) + len(identifiers) > max_keys:
+            raise serializers.ValidationError({'Too many tags and stations': f'Maximum of {max_keys} per request.'})
+
+        owned = tag_cache.get_owned_types(tag_ids, self.request.user.pk)
+        missing = [tag for tag in tag_ids if tag not in owned]
+        if missing:
+            raise serializers.ValidationError({'Tag does not exist': missing})
+        if identifiers:
+            stations = set(WeatherStations.objects.filter(owner=self.request.user, identifier__in=identifiers)
+                                                  .values_list('identifier', flat=True))
+            missing = [ident for ident in identifiers if ident not in stations]
+            if missing:
+                raise serializers.ValidationError({'Station identifier does not exist': missing})
+        return tag_ids, identifiers
+
+    def get_current(self, tag_ids, identifiers):
+        #Current values held in the latest value store
+        owner_id = self.request.user.pk
+        tags = latest.get_tag_data_many(tag_ids, owner_id)
+        data = [tags[tag] for tag in tag_ids if tag in tags]
+        for ident in identifiers:
+            station = latest.get_weather_data(owner_id, ident)
+            if station is not None:
+                data.append(station)
+        return data
+
+    def get_live_keys(self, tag_ids, identifiers):
+        return ([live.tag_key(tag) for tag in tag_ids] +
+                [live.station_key(self.request.user.pk, ident) for ident in identifiers])
+
+    def get_since(self):
+        return self.request.query_params.get('since', None) or self.request.headers.get('Last-Event-ID', None)
+
+    def get_wait_timeout(self):
+        req_timeout = self.request.query_params.get('timeout', live.get_timeout())
+        try:
+            return max(0, min(float(req_timeout), live.get_timeout()))
+        except ValueError:
+            raise serializers.ValidationError({'Invalid timeout parameter': req_timeout})
+
+    def get(self, request, format=None):
+        tag_ids, identifiers = self.get_keys()
+        keys = self.get_live_keys(tag_ids, identifiers)
+        since = self.get_since()
+
+        if request.query_params.get('stream', None) == 'sse':
+            lines = live.sse_lines(keys, since, lambda: self.get_current(tag_ids, identifiers))
+            response = StreamingHttpResponse(lines, content_type='text/event-stream')
+            response['Cache-Control'] = 'no-cache'
+            response['X-Accel-Buffering'] = 'no'
+            return response
+
+        timeout = self.get_wait_timeout()
+        data, cursor, reset = live.wait(keys, since, timeout)
+        if reset:
+            data = self.get_current(tag_ids, identifiers)
+        return Response({'cursor': cursor, 'reset': reset, 'data': data})